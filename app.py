@@ -1,27 +1,46 @@
 from __future__ import annotations
 
+import atexit
 import base64
-from concurrent.futures import ThreadPoolExecutor
+import dataclasses
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+import hashlib
+import html
 import json
+import mimetypes
+import os
 import re
 import tempfile
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote
 import time
 import random
 import streamlit as st
 import streamlit.components.v1 as components
 
-from utils.pdf_loader import load_and_chunk_pdf, PdfChunk
+try:  # Pillow 为可选依赖：有则把 PNG 素材转成体积小得多的 WebP
+    from PIL import Image
+except Exception:
+    Image = None  # type: ignore
+
+from utils.pdf_loader import iter_chunks, PdfChunk
 from utils.mineru_parser import token_available
-from utils.reading_mode import apply_reading_mode
-from utils.script_engine import ScriptGenerator
+from utils.reading_mode import apply_reading_mode, is_fast_section_title
+from utils.script_cache import ScriptCache, cache_enabled as script_cache_enabled, script_cache_key
+from utils.script_engine import BATCH_MAX_CHUNKS, PROMPT_FINGERPRINT, ScriptGenerator, is_fallback_script
+from utils.semantic_cache import SemanticScriptCache, semantic_cache_enabled
 
 # ──────────────────────────────────────────────
 # 本地资源路径（必须手动放入 assets/ 目录）
 # ──────────────────────────────────────────────
 ROOT_DIR = Path(__file__).resolve().parent
 ASSETS_DIR = ROOT_DIR / "assets"
+# static/ 是指向 assets/ 的软链接，配合 .streamlit/config.toml 的 enableStaticServing，
+# 让浏览器按 URL 缓存图片，而不是每次 rerun 都收到一大段 base64
+STATIC_DIR = ROOT_DIR / "static"
+# PNG/JPEG 素材的 WebP 副本（按源文件 mtime 失效），位于 assets/ 内以便同样走静态路由
+WEBP_CACHE_DIR = ASSETS_DIR / ".cache"
 
 ASSET_BG = ASSETS_DIR / "bg_classroom.png"
 
@@ -79,6 +98,10 @@ DEMO_PDF = ROOT_DIR / "papers" / "ReAct.pdf"
 DEMO_PDF_TITLE = "ReAct: Synergizing Reasoning and Acting in Language Models"
 
 _ALPHA = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# 预生成窗口：始终尝试让 chunk_idx+1 … chunk_idx+PREFETCH_WINDOW 处于已就绪或生成中（P2G_PREFETCH_DEPTH 可调）
+PREFETCH_WINDOW = max(1, int(os.environ.get("P2G_PREFETCH_DEPTH", 3)))
+# 预取窗口里同时缺 ≥2 个 chunk 时合并成一次 LLM 调用；单批正文总字数上限，避免超长提示词
+PREFETCH_BATCH_MAX_CHARS = 6000
 READING_MODE_OPTIONS = ["fast", "detailed"]
 READING_MODE_LABELS = {
     "fast": "极速阅读",
@@ -113,25 +136,112 @@ COMMON_SECTION_KEYWORDS = {
 }
 
 
+mimetypes.add_type("image/webp", ".webp")
+
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def _file_to_data_uri_cached(path_str: str, mtime: float) -> Optional[str]:
+    """按 (路径, mtime) 缓存 base64 结果：素材不变时每个进程只编码一次，文件被替换后自动失效。"""
+    path = Path(path_str)
+    try:
+        data = path.read_bytes()
+    except OSError:
+        return None
+    mime = mimetypes.guess_type(path.name)[0] or "image/png"
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
 def _file_to_data_uri(path: Path) -> Optional[str]:
-    if not path.exists():
+    # 只做一次 stat：既判断文件是否存在，又拿到 mtime 作为缓存键
+    try:
+        mtime = path.stat().st_mtime
+    except OSError:
         return None
-    b64 = base64.b64encode(path.read_bytes()).decode("utf-8")
-    ext = path.suffix.lower().lstrip(".")
-    mime = "image/jpeg" if ext in ("jpg", "jpeg") else "image/png"
-    return f"data:{mime};base64,{b64}"
+    return _file_to_data_uri_cached(str(path), mtime)
+
+
+@st.cache_resource(show_spinner=False)
+def _static_assets_root() -> Optional[Path]:
+    """静态文件服务可用时返回 static/ 的真实路径；未开启或软链接失效（如 Windows 检出）时返回 None。"""
+    try:
+        enabled = bool(st.get_option("server.enableStaticServing"))
+    except Exception:
+        enabled = False
+    if not enabled or not STATIC_DIR.is_dir():
+        return None
+    return STATIC_DIR.resolve()
+
+
+def _webp_variant(path: Path) -> Path:
+    """
+    assets/ 下 PNG/JPEG 素材的 WebP 副本（背景约 4MB → 200KB），首次使用时转码一次并落盘；
+    未安装 Pillow、转码失败或副本并不更小时返回原文件。
+    """
+    if Image is None or path.suffix.lower() not in {".png", ".jpg", ".jpeg"}:
+        return path
+    try:
+        rel = path.resolve().relative_to(ASSETS_DIR.resolve())
+        src_stat = path.stat()
+    except (ValueError, OSError):
+        return path
+    out = WEBP_CACHE_DIR / rel.with_suffix(".webp")
+    try:
+        if out.stat().st_mtime >= src_stat.st_mtime:
+            return out if out.stat().st_size < src_stat.st_size else path
+    except OSError:
+        pass
+    tmp_name: Optional[str] = None
+    try:
+        out.parent.mkdir(parents=True, exist_ok=True)
+        # 每次转码用唯一的临时文件：多个会话同时首次访问同一素材时互不覆盖对方写了一半的文件
+        fd, tmp_name = tempfile.mkstemp(suffix=".webp.tmp", dir=out.parent)
+        with os.fdopen(fd, "wb") as tmp, Image.open(path) as im:
+            # method=4：体积比 6 略大几个百分点，但转码快一个数量级（立绘约 0.3s vs 4s）
+            im.save(tmp, "WEBP", quality=82, method=4)
+        os.replace(tmp_name, out)
+    except Exception:
+        if tmp_name is not None:
+            Path(tmp_name).unlink(missing_ok=True)
+        return path
+    return out if out.stat().st_size < src_stat.st_size else path
+
+
+def _asset_src(path: Path) -> Optional[str]:
+    """
+    本地素材的引用地址：优先走 Streamlit 静态路由（app/static/...，可被浏览器缓存），
+    不可用时回退为 base64 data URI；有 Pillow 时都使用 WebP 副本。
+    """
+    path = _webp_variant(path)
+    root = _static_assets_root()
+    if root is not None and path.exists():
+        try:
+            rel = path.resolve().relative_to(root)
+        except ValueError:
+            rel = None
+        if rel is not None:
+            return "app/static/" + quote(rel.as_posix())
+    return _file_to_data_uri(path)
+
+
+@st.cache_resource(show_spinner=False, ttl=60)
+def _background_src() -> Optional[str]:
+    """背景图引用地址：每个页面每次重跑都要用，缓存后重跑不再触碰磁盘；替换背景图后一分钟内生效。"""
+    return _asset_src(ASSET_BG)
+
+
+@st.cache_resource(show_spinner=False, max_entries=len(CHARACTERS) + 1, ttl=60)
+def _character_sprite_srcs(character_id: str) -> Dict[str, Optional[str]]:
+    """角色表情 → 立绘引用地址（静态 URL 或 data URI，缺失为 None）；每个角色每分钟最多解析一次。"""
+    return {emotion: _asset_src(path) for emotion, path in _load_character_assets(character_id).items()}
 
 
 # ──────────────────────────────────────────────
 # CSS / 全局样式注入
 # ──────────────────────────────────────────────
 
-def inject_game_css(bg_data_uri: Optional[str]) -> None:
-    bg_img = f"url('{bg_data_uri}')" if bg_data_uri else "none"
-
-    st.markdown(
-        f"""
+_GAME_CSS_TEMPLATE = """
 <style>
+/* 说明：各浮层不使用 backdrop-filter（运行时模糊会让整屏每帧重新合成），改用更不透明的底色保证可读性 */
 /* ── 隐藏 Streamlit 默认 Chrome ── */
 #MainMenu, footer, header {{ visibility: hidden; }}
 [data-testid="stDecoration"],
@@ -143,7 +253,6 @@ html, body, .stApp {{
   background-size: cover !important;
   background-position: center center !important;
   background-repeat: no-repeat !important;
-  background-attachment: fixed !important;
 }}
 [data-testid="stAppViewContainer"],
 [data-testid="stAppViewContainer"] > .main,
@@ -173,7 +282,7 @@ html, body, .stApp {{
 /* ── 章节徽章（左上）── */
 .p2g-section-badge {{
   position: fixed; top: 10px; left: 16px;
-  background: rgba(8,6,18,0.72); backdrop-filter: blur(10px);
+  background: rgba(8,6,18,0.88);
   border: 1px solid rgba(130,90,230,0.35); border-radius: 20px;
   padding: 0.22rem 0.9rem;
   color: rgba(195,170,255,0.85);
@@ -202,10 +311,9 @@ html, body, .stApp {{
   font-size: 0.72rem;
   line-height: 1.2;
   letter-spacing: 0.4px;
-  background: rgba(8, 6, 18, 0.72);
+  background: rgba(8, 6, 18, 0.88);
   border: 1px solid rgba(130, 90, 230, 0.28);
   color: rgba(215, 198, 255, 0.88);
-  backdrop-filter: blur(10px);
 }}
 .p2g-prefetch-badge.ready {{
   border-color: rgba(120, 230, 170, 0.35);
@@ -249,9 +357,8 @@ html, body, .stApp {{
   min-height: 172px; z-index: 30;
   /* 右 padding：立绘改为高度控制后，按预期渲染宽度留白 */
   padding: 1.1rem calc(min(28vw, 400px) + 1vw + 2rem) 1.3rem 4.5vw;
-  background: rgba(8,5,20,0.85);
+  background: rgba(8,5,20,0.92);
   border-top: 2px solid rgba(120,75,220,0.55);
-  backdrop-filter: blur(16px);
   box-shadow: 0 -8px 48px rgba(0,0,0,0.55);
   cursor: pointer;
   user-select: none;
@@ -297,7 +404,7 @@ html, body, .stApp {{
 .p2g-figure-card {{
   position: fixed; left: 50%; top: 38%;
   transform: translate(-50%, -50%);
-  background: rgba(7,5,18,0.92); backdrop-filter: blur(18px);
+  background: rgba(7,5,18,0.94);
   border: 1px solid rgba(140,95,255,0.55); border-radius: 16px;
   padding: 1.2rem 1.4rem 1rem; text-align: center; z-index: 46;
   box-shadow: 0 0 60px rgba(100,55,200,0.35);
@@ -331,7 +438,7 @@ html, body, .stApp {{
 .p2g-chapter-card {{
   position: fixed; left: 50%; top: 40%;
   transform: translate(-50%, -50%);
-  background: rgba(7,5,18,0.91); backdrop-filter: blur(18px);
+  background: rgba(7,5,18,0.93);
   border: 1px solid rgba(140,95,255,0.6); border-radius: 18px;
   padding: 2rem 4rem; text-align: center; z-index: 45;
   box-shadow: 0 0 70px rgba(100,55,200,0.35);
@@ -385,10 +492,9 @@ div[data-testid="stButton"] > button {{
   padding: 0.78rem 1.3rem;
   border-radius: 10px;
   border: 1px solid rgba(120,80,220,0.42);
-  background: rgba(10,7,22,0.78);
+  background: rgba(10,7,22,0.88);
   color: rgba(238,228,255,0.94);
   font-size: 0.97rem;
-  backdrop-filter: blur(10px);
   transition: all 0.18s ease;
   letter-spacing: 0.3px;
 }}
@@ -536,49 +642,74 @@ div[data-testid="stButton"] > button:active {{
   }}
 }}
 </style>
-        """,
-        unsafe_allow_html=True,
-    )
+"""
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _game_css(bg_src: Optional[str]) -> str:
+    bg_img = f"url('{bg_src}')" if bg_src else "none"
+    return _GAME_CSS_TEMPLATE.format(bg_img=bg_img)
+
+
+def inject_game_css(bg_src: Optional[str]) -> None:
+    # Streamlit 每次 rerun 都会移除本轮未再次输出的元素，所以样式仍需每轮输出；
+    # 但模板只格式化一次，内容不变时前端也不会重建这个 <style> 节点。
+    st.markdown(_game_css(bg_src), unsafe_allow_html=True)
 
 
 # ──────────────────────────────────────────────
 # 状态初始化
 # ──────────────────────────────────────────────
 
+# 会话状态默认值；init_state 每次重跑只补齐缺失的键
+SESSION_DEFAULTS: Dict[str, Any] = {
+    "state":            "LANDING",
+    "chunks":           [],
+    "chunk_idx":        0,
+    "script_items":     [],
+    "script_idx":       0,
+    "current_feedback": None,
+    "answered":         False,
+    "generator_ready":  False,
+    "use_mineru":       True,
+    "reading_mode":     "detailed",
+    "enable_section_pick": False,
+    "raw_chunks":       [],
+    "available_sections": [],
+    "selected_sections": None,
+    "section_label_to_key": {},
+    "section_filter_applied": False,
+    "parser_used":      "pypdf",
+    "prefetch_cache":   {},
+    "prefetch_futures": {},
+    "prefetch_task_run_token": None,
+    "use_demo_pdf":     False,
+    "script_run_token": 0,
+    "paper_image_map":  {},
+}
+
+
 def init_state() -> None:
-    if "state" not in st.session_state:
-        st.session_state.state = "LANDING"
-
-    st.session_state.setdefault("chunks",          [])
-    st.session_state.setdefault("chunk_idx",       0)
-    st.session_state.setdefault("script_items",    [])
-    st.session_state.setdefault("script_idx",      0)
-    st.session_state.setdefault("current_feedback", None)
-    st.session_state.setdefault("answered",        False)
-    st.session_state.setdefault("generator_ready", False)
-    st.session_state.setdefault("use_mineru",      True)
-    st.session_state.setdefault("reading_mode",    "detailed")
-    st.session_state.setdefault("enable_section_pick", False)
-    st.session_state.setdefault("raw_chunks",      [])
-    st.session_state.setdefault("available_sections", [])
-    st.session_state.setdefault("selected_sections", None)
-    st.session_state.setdefault("section_label_to_key", {})
-    st.session_state.setdefault("section_filter_applied", False)
-    st.session_state.setdefault("parser_used",     "pypdf")
-    st.session_state.setdefault("prefetch_cache",  {})
-    st.session_state.setdefault("prefetch_future", None)
-    st.session_state.setdefault("prefetch_target_idx", None)
-    st.session_state.setdefault("prefetch_task_run_token", None)
-    st.session_state.setdefault("use_demo_pdf",    False)
-    st.session_state.setdefault("script_run_token", 0)
-    st.session_state.setdefault("prefetch_executor", None)
-    st.session_state.setdefault("paper_image_map",   {})
+    ss = st.session_state
+    missing = {k: v for k, v in SESSION_DEFAULTS.items() if k not in ss}
+    if missing:
+        # 可变默认值（list/dict）按会话各拷贝一份，避免不同会话共享同一对象
+        ss.update({k: (v.copy() if isinstance(v, (list, dict)) else v) for k, v in missing.items()})
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _missing_assets() -> Tuple[str, ...]:
+    """缺失的必需素材路径；每分钟最多检查一次，手动补上素材后一分钟内生效。"""
+    return tuple(str(p) for p in (ASSET_BG,) if not p.exists())
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _demo_pdf_available() -> bool:
+    return DEMO_PDF.is_file()
 
 
 def ensure_assets_notice() -> None:
-    missing = []
-    if not ASSET_BG.exists():
-        missing.append(str(ASSET_BG))
+    missing = _missing_assets()
     if missing:
         st.warning(
             "检测到以下本地图片资源缺失，请手动放入（代码只读本地路径，不使用网图）：\n\n- "
@@ -656,26 +787,43 @@ def get_current_item() -> Optional[Dict[str, Any]]:
     return None
 
 
+@st.cache_resource(show_spinner=False)
 def _get_prefetch_executor() -> ThreadPoolExecutor:
-    executor = st.session_state.get("prefetch_executor")
-    if executor is None:
-        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="p2g-prefetch")
-        st.session_state.prefetch_executor = executor
+    """进程级共享的预取线程池：所有会话共用一组有界线程，进程退出时回收。"""
+    executor = ThreadPoolExecutor(
+        max_workers=int(os.environ.get("P2G_PREFETCH_WORKERS", max(4, PREFETCH_WINDOW))),
+        thread_name_prefix="p2g-prefetch",
+    )
+    atexit.register(executor.shutdown, wait=False, cancel_futures=True)
+    return executor
+
+
+@st.cache_resource(show_spinner=False)
+def _get_priority_executor() -> ThreadPoolExecutor:
+    """
+    紧接着要读的那一段（含首段）专用的线程池：用户马上就要等它，
+    不能排在其他会话的远期预取后面。每个会话同一时刻最多在这里占一个任务。
+    """
+    executor = ThreadPoolExecutor(
+        max_workers=int(os.environ.get("P2G_PRIORITY_WORKERS", 4)),
+        thread_name_prefix="p2g-priority",
+    )
+    atexit.register(executor.shutdown, wait=False, cancel_futures=True)
     return executor
 
 
 def _clear_prefetch_buffer(*, bump_run_token: bool = False) -> None:
-    future = st.session_state.get("prefetch_future")
-    if future is not None and not future.done():
-        future.cancel()
+    ss = st.session_state
+    for future in (ss.get("prefetch_futures") or {}).values():
+        if not future.done():
+            future.cancel()
 
-    st.session_state.prefetch_cache = {}
-    st.session_state.prefetch_future = None
-    st.session_state.prefetch_target_idx = None
-    st.session_state.prefetch_task_run_token = None
+    ss.prefetch_cache = {}
+    ss.prefetch_futures = {}
+    ss.prefetch_task_run_token = None
 
     if bump_run_token:
-        st.session_state.script_run_token = int(st.session_state.get("script_run_token", 0)) + 1
+        ss.script_run_token = int(ss.get("script_run_token", 0)) + 1
 
 
 def _merge_show_image_with_dialogue(
@@ -719,8 +867,20 @@ def _merge_show_image_with_dialogue(
     return result
 
 
+def _option_labels(options: List[Any]) -> List[str]:
+    return [f"{_ALPHA[i] if i < len(_ALPHA) else i + 1}. {opt}" for i, opt in enumerate(options)]
+
+
 def _apply_script_items(script: List[Dict[str, Any]]) -> None:
     merged = _merge_show_image_with_dialogue(script)
+    # 选项按钮文案、未知类型条目的兜底显示文本随剧本一起算好，渲染时不再逐次拼接 / 序列化
+    for item in merged:
+        t = item.get("type")
+        opts = item.get("options")
+        if t in {"quiz", "choice"} and isinstance(opts, list):
+            item["option_labels"] = _option_labels(opts)
+        elif t not in {"dialogue", "sub_head"} and not item.get("text"):
+            item["_display"] = json.dumps(item, ensure_ascii=False)
     st.session_state.script_items     = merged
     st.session_state.script_idx       = 0
     st.session_state.current_feedback = None
@@ -728,13 +888,123 @@ def _apply_script_items(script: List[Dict[str, Any]]) -> None:
     st.session_state.generator_ready  = True
 
 
+@st.cache_resource(show_spinner=False)
+def _get_script_generator() -> ScriptGenerator:
+    """进程内所有会话、所有调用共享一个 ScriptGenerator（以及底层 LLM 客户端/连接池）。"""
+    return ScriptGenerator()
+
+
+def _warm_script_generator(*, connect: bool = False) -> None:
+    """
+    在后台先构造共享的 ScriptGenerator，首段剧本生成不再承担初始化开销；
+    connect=True 时顺带与 LLM 服务建立保活连接（开始解析 PDF 时调用）。
+    """
+    # 构造失败（如未配置依赖）时异常留在 future 里，真正生成时会再次抛出并提示
+    if connect:
+        _get_prefetch_executor().submit(lambda: _get_script_generator().warm_up())
+    else:
+        _get_prefetch_executor().submit(_get_script_generator)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_script_cache() -> Optional[ScriptCache]:
+    """剧本磁盘缓存（output/script_cache/）；设置 P2G_SCRIPT_CACHE=0 可关闭。"""
+    return ScriptCache() if script_cache_enabled() else None
+
+
+@st.cache_resource(show_spinner=False)
+def _get_semantic_cache() -> Optional[SemanticScriptCache]:
+    """近似重复 chunk 的语义缓存（进程内）；需 P2G_SEMANTIC_CACHE=1 且安装 fastembed。"""
+    return SemanticScriptCache() if semantic_cache_enabled() else None
+
+
+def _semantic_scope(character_name: str, image_map: Optional[Dict[str, str]]) -> Tuple[Any, ...]:
+    gen = _get_script_generator()
+    return (character_name, gen.model, gen.temperature, tuple(sorted((image_map or {}).items())))
+
+
+def _disk_script_key(
+    chunk_text: str,
+    section_title: Optional[str],
+    character_name: str,
+    image_map: Optional[Dict[str, str]],
+) -> Optional[str]:
+    if _get_script_cache() is None:
+        return None
+    gen = _get_script_generator()
+    return script_cache_key(
+        chunk_text=chunk_text,
+        section_title=section_title,
+        character_name=character_name,
+        image_map=image_map,
+        model=gen.model,
+        temperature=gen.temperature,
+        prompt_fingerprint=PROMPT_FINGERPRINT,
+    )
+
+
+class _UncachedScript(Exception):
+    """携带兜底脚本跳出 st.cache_data，使失败结果不被缓存。"""
+
+    def __init__(self, script: List[Dict[str, Any]]) -> None:
+        super().__init__("fallback script")
+        self.script = script
+
+
+def _chunk_text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _cached_script(
+    text_hash: str,
+    chunk_index: int,
+    section_title: Optional[str],
+    character_name: str,
+    image_items: Tuple[Tuple[str, str], ...],
+    _chunk_text: str,
+    _precomputed: Optional[List[Dict[str, Any]]] = None,
+    _persist: bool = True,
+) -> List[Dict[str, Any]]:
+    # 下划线开头的参数不参与 st.cache_data 的哈希：_chunk_text 由 text_hash 代表，
+    # _precomputed 是批量路径已拿到的剧本，直接使用而不再调用 LLM；
+    # _persist=False 表示它来自缓存（磁盘 / 语义近似命中），不再写入磁盘缓存
+    image_map = dict(image_items) or None
+    disk_key = _disk_script_key(_chunk_text, section_title, character_name, image_map)
+    script = _precomputed
+    if script is None and disk_key:
+        script = _get_script_cache().get(disk_key)
+        if script is not None:
+            return script
+    semantic = _get_semantic_cache()
+    if script is None and semantic is not None:
+        script = semantic.get(_chunk_text, scope=_semantic_scope(character_name, image_map))
+        if script is not None:
+            # 近似命中是为别的正文写的剧本：只在本进程复用，不写进按正文精确匹配的磁盘缓存
+            return script
+    if script is None:
+        script = _get_script_generator().generate_script(
+            _chunk_text,
+            chunk_index=chunk_index,
+            section_title=section_title,
+            character_name=character_name,
+            image_map=image_map,
+        )
+        if semantic is not None and not is_fallback_script(script):
+            semantic.add(_chunk_text, script, scope=_semantic_scope(character_name, image_map))
+    if is_fallback_script(script):
+        raise _UncachedScript(script)
+    if disk_key and _persist:
+        _get_script_cache().set(disk_key, script)
+    return script
+
+
 def _generate_script_for_chunk(chunks: List[PdfChunk], chunk_idx: int) -> List[Dict[str, Any]]:
-    gen = ScriptGenerator()
     chunk = chunks[chunk_idx]
     # 获取当前角色名称
     character_name = _get_character_name(st.session_state.get("selected_character", DEFAULT_CHARACTER))
     image_map = dict(getattr(chunk, "image_map", ())) or None
-    return gen.generate_script(
+    return _generate_script_payload(
         chunk.text,
         chunk_index=chunk.index,
         section_title=getattr(chunk, "section_title", "") or None,
@@ -750,72 +1020,144 @@ def _generate_script_payload(
     section_title: Optional[str],
     character_name: str,
     image_map: Optional[Dict[str, str]] = None,
+    precomputed: Optional[List[Dict[str, Any]]] = None,
+    persist: bool = True,
 ) -> List[Dict[str, Any]]:
-    gen = ScriptGenerator()
-    return gen.generate_script(
-        chunk_text,
-        chunk_index=chunk_index,
-        section_title=section_title,
-        character_name=character_name,
-        image_map=image_map,
-    )
+    try:
+        return _cached_script(
+            _chunk_text_hash(chunk_text),
+            chunk_index,
+            section_title,
+            character_name,
+            tuple(sorted((image_map or {}).items())),
+            chunk_text,
+            precomputed,
+            persist,
+        )
+    except _UncachedScript as e:
+        return e.script
 
 
-def _collect_prefetch_if_ready() -> None:
-    future = st.session_state.get("prefetch_future")
-    target_idx = st.session_state.get("prefetch_target_idx")
-    task_run_token = st.session_state.get("prefetch_task_run_token")
-    current_run_token = int(st.session_state.get("script_run_token", 0))
+def _generate_script_batch_payload(
+    entries: List[Dict[str, Any]],
+    *,
+    character_name: str,
+) -> Dict[int, List[Dict[str, Any]]]:
+    """一次 LLM 调用生成多个 chunk 的剧本，再逐个写回 _cached_script 的缓存；返回 {chunk_index: 剧本}。"""
+    # 磁盘缓存 / 语义缓存已有的 chunk 不再进批量请求
+    scripts: Dict[int, List[Dict[str, Any]]] = {}
+    cache = _get_script_cache()
+    semantic = _get_semantic_cache()
+    for e in entries:
+        key = _disk_script_key(e["chunk_text"], e["section_title"], character_name, e["image_map"])
+        hit = cache.get(key) if cache is not None and key else None
+        if hit is None and semantic is not None:
+            hit = semantic.get(e["chunk_text"], scope=_semantic_scope(character_name, e["image_map"]))
+        if hit is not None:
+            scripts[int(e["chunk_index"])] = hit
+    hits = set(scripts)
+    remaining = [e for e in entries if int(e["chunk_index"]) not in scripts]
+    if remaining:
+        generated = _get_script_generator().generate_scripts_batch(remaining, character_name=character_name)
+        if semantic is not None:
+            for e in remaining:
+                script = generated.get(int(e["chunk_index"]))
+                if script and not is_fallback_script(script):
+                    semantic.add(e["chunk_text"], script, scope=_semantic_scope(character_name, e["image_map"]))
+        scripts.update(generated)
+    return {
+        int(e["chunk_index"]): _generate_script_payload(
+            e["chunk_text"],
+            chunk_index=e["chunk_index"],
+            section_title=e["section_title"],
+            character_name=character_name,
+            image_map=e["image_map"],
+            precomputed=scripts.get(int(e["chunk_index"])),
+            # 缓存命中（含语义近似命中）不回写磁盘，只持久化 LLM 新生成的剧本
+            persist=int(e["chunk_index"]) not in hits,
+        )
+        for e in entries
+    }
 
-    if future is None or target_idx is None:
-        return
-    if not future.done():
-        return
 
-    try:
-        script = future.result()
-    except Exception:
-        script = None
+def _fan_out_batch(batch_future: Future, index_map: Dict[int, int]) -> Dict[int, Future]:
+    """把一个批量 future 拆成按 chunk 位置索引的子 future，沿用逐 chunk 的取用/取消逻辑。"""
+    children: Dict[int, Future] = {pos: Future() for pos in index_map}
 
-    st.session_state.prefetch_future = None
-    st.session_state.prefetch_target_idx = None
-    st.session_state.prefetch_task_run_token = None
+    def _settle(done: Future) -> None:
+        for pos, child in children.items():
+            try:
+                if done.cancelled():
+                    child.cancel()
+                elif done.exception() is not None:
+                    child.set_exception(done.exception())
+                else:
+                    child.set_result(done.result().get(index_map[pos]))
+            except InvalidStateError:  # 子 future 已被取消
+                pass
 
-    if script is None:
+    def _cancel_parent_if_orphaned(_child: Future) -> None:
+        if all(c.cancelled() for c in children.values()):
+            batch_future.cancel()
+
+    for child in children.values():
+        child.add_done_callback(_cancel_parent_if_orphaned)
+    batch_future.add_done_callback(_settle)
+    return children
+
+
+def _collect_prefetch_if_ready() -> None:
+    ss = st.session_state
+    futures = ss.prefetch_futures
+    if not futures:
         return
-    if int(task_run_token or -1) != current_run_token:
+
+    task_run_token = ss.get("prefetch_task_run_token")
+    current_run_token = int(ss.get("script_run_token", 0))
+    cache = ss.prefetch_cache
+    for target_idx, future in list(futures.items()):
+        if not future.done():
+            continue
+        futures.pop(target_idx)
+        try:
+            script = future.result()
+        except Exception:
+            script = None
+        if script is None:
+            continue
+        if int(task_run_token or -1) != current_run_token:
+            continue
+        cache[int(target_idx)] = script
+
+
+def _force_current_speaker(script: Optional[List[Dict[str, Any]]]) -> None:
+    if not script:
         return
+    # 获取当前"应该"显示的名称
+    current_character_name = _get_character_name(st.session_state.get("selected_character", DEFAULT_CHARACTER))
 
-    cache = dict(st.session_state.get("prefetch_cache") or {})
-    cache[int(target_idx)] = script
-    st.session_state.prefetch_cache = cache
+    # 不要直接对比 speaker，因为 AI 可能会写错
+    # 我们在这里强制把预取脚本里的所有 speaker 修正为当前选择的角色
+    for item in script:
+        if item.get("type") == "dialogue":
+            item["speaker"] = current_character_name
 
 
 def _take_prefetched_script(chunk_idx: int, *, wait_if_running: bool = False) -> Optional[List[Dict[str, Any]]]:
     _collect_prefetch_if_ready()
 
-    cache = dict(st.session_state.get("prefetch_cache") or {})
-    if chunk_idx in cache:
-        script = cache.pop(chunk_idx)
+    ss = st.session_state
+    script = ss.prefetch_cache.pop(chunk_idx, None)
+    if script is not None:
         # 验证预取脚本的角色是否与当前选择一致
-        if script:
-            # 获取当前"应该"显示的名称
-            current_character_name = _get_character_name(st.session_state.get("selected_character", DEFAULT_CHARACTER))
-            
-            # 不要直接对比 speaker，因为 AI 可能会写错
-            # 我们在这里强制把预取脚本里的所有 speaker 修正为当前选择的角色
-            for item in script:
-                if item.get("type") == "dialogue":
-                    item["speaker"] = current_character_name
-        
-        st.session_state.prefetch_cache = cache
+        _force_current_speaker(script)
         return script
 
-    future = st.session_state.get("prefetch_future")
-    target_idx = st.session_state.get("prefetch_target_idx")
-    task_run_token = int(st.session_state.get("prefetch_task_run_token") or -1)
-    current_run_token = int(st.session_state.get("script_run_token", 0))
-    if future is None or target_idx != chunk_idx:
+    futures = ss.prefetch_futures
+    future = futures.get(chunk_idx)
+    task_run_token = int(ss.get("prefetch_task_run_token") or -1)
+    current_run_token = int(ss.get("script_run_token", 0))
+    if future is None:
         return None
     if task_run_token != current_run_token:
         return None
@@ -828,59 +1170,109 @@ def _take_prefetched_script(chunk_idx: int, *, wait_if_running: bool = False) ->
         script = None
 
     # 验证预取脚本的角色是否与当前选择一致
-    if script:
-        # 获取当前"应该"显示的名称
-        current_character_name = _get_character_name(st.session_state.get("selected_character", DEFAULT_CHARACTER))
-        
-        # 不要直接对比 speaker，因为 AI 可能会写错
-        # 我们在这里强制把预取脚本里的所有 speaker 修正为当前选择的角色
-        for item in script:
-            if item.get("type") == "dialogue":
-                item["speaker"] = current_character_name
-
-    st.session_state.prefetch_future = None
-    st.session_state.prefetch_target_idx = None
-    st.session_state.prefetch_task_run_token = None
-    return script
+    _force_current_speaker(script)
 
+    futures.pop(chunk_idx, None)
+    return script
 
-def _ensure_next_chunk_prefetch(chunks: List[PdfChunk], current_chunk_idx: int) -> None:
-    next_idx = int(current_chunk_idx) + 1
-    if next_idx < 0 or next_idx >= len(chunks):
-        return
 
+def _ensure_prefetch_window(chunks: List[PdfChunk], current_chunk_idx: int, k: int = PREFETCH_WINDOW) -> None:
+    """让 current+1 … current+k 的剧本都处于"已缓存"或"生成中"，连续快速点击也不会追上生成进度。"""
     _collect_prefetch_if_ready()
 
-    cache = st.session_state.get("prefetch_cache") or {}
-    if next_idx in cache:
-        return
+    ss = st.session_state
+    cache = ss.prefetch_cache
+    futures = ss.prefetch_futures
+    current_run_token = int(ss.get("script_run_token", 0))
 
-    future = st.session_state.get("prefetch_future")
-    target_idx = st.session_state.get("prefetch_target_idx")
-    task_run_token = int(st.session_state.get("prefetch_task_run_token") or -1)
-    current_run_token = int(st.session_state.get("script_run_token", 0))
+    # 已读过的段落不会再用到：丢掉其剩余的缓存 / 任务，内存只随预生成窗口而非论文长度增长
+    for stale_idx in [i for i in cache if i < current_chunk_idx]:
+        del cache[stale_idx]
+    for stale_idx in [i for i in futures if i < current_chunk_idx]:
+        # 还在排队的任务直接取消，别占着共享线程池
+        futures.pop(stale_idx).cancel()
 
-    if future is not None:
-        if target_idx == next_idx and task_run_token == current_run_token:
-            return
-        if not future.done():
-            return
-
-    chunk = chunks[next_idx]
     # 获取当前角色名称，确保预生成也使用正确的角色
-    character_name = _get_character_name(st.session_state.get("selected_character", DEFAULT_CHARACTER))
-    image_map = dict(getattr(chunk, "image_map", ())) or None
-    future = _get_prefetch_executor().submit(
-        _generate_script_payload,
-        chunk.text,
-        chunk_index=chunk.index,
-        section_title=getattr(chunk, "section_title", "") or None,
-        character_name=character_name,  # 显式传递角色名称
-        image_map=image_map,
-    )
-    st.session_state.prefetch_future = future
-    st.session_state.prefetch_target_idx = next_idx
-    st.session_state.prefetch_task_run_token = current_run_token
+    character_name = _get_character_name(ss.get("selected_character", DEFAULT_CHARACTER))
+    start = int(current_chunk_idx) + 1
+    pending = [
+        next_idx
+        for next_idx in range(max(start, 0), min(start + max(0, k), len(chunks)))
+        if next_idx not in cache and next_idx not in futures
+    ]
+
+    # 紧接着要读的下一段单独提交到优先线程池：它不必等模型把整批剧本都写完，也不排在其他会话的预取后面
+    groups: List[List[int]] = []
+    if pending and pending[0] == start:
+        groups.append([pending.pop(0)])
+    # 其余按正文总字数分组：≥2 个的组走一次批量调用，其余逐个提交
+    group_chars = 0
+    batch_start = len(groups)
+    for next_idx in pending:
+        n_chars = len(chunks[next_idx].text)
+        if (
+            len(groups) > batch_start
+            and len(groups[-1]) < BATCH_MAX_CHUNKS
+            and group_chars + n_chars <= PREFETCH_BATCH_MAX_CHARS
+        ):
+            groups[-1].append(next_idx)
+            group_chars += n_chars
+        else:
+            groups.append([next_idx])
+            group_chars = n_chars
+
+    for n, group in enumerate(groups):
+        executor = _get_priority_executor() if n < batch_start else _get_prefetch_executor()
+        entries = [
+            {
+                "chunk_text": chunks[i].text,
+                "chunk_index": chunks[i].index,
+                "section_title": getattr(chunks[i], "section_title", "") or None,
+                "image_map": dict(getattr(chunks[i], "image_map", ())) or None,
+            }
+            for i in group
+        ]
+        if len(group) >= 2 and len({e["chunk_index"] for e in entries}) == len(group):
+            batch_future = executor.submit(
+                _generate_script_batch_payload,
+                entries,
+                character_name=character_name,  # 显式传递角色名称
+            )
+            futures.update(_fan_out_batch(batch_future, {i: chunks[i].index for i in group}))
+            continue
+        for i, entry in zip(group, entries):
+            futures[i] = executor.submit(
+                _generate_script_payload,
+                entry["chunk_text"],
+                chunk_index=entry["chunk_index"],
+                section_title=entry["section_title"],
+                character_name=character_name,  # 显式传递角色名称
+                image_map=entry["image_map"],
+            )
+
+    ss.prefetch_task_run_token = current_run_token
+
+
+def _first_chunk_survives_filters(chunk: PdfChunk, position: int) -> bool:
+    """
+    解析出的第 position 个 chunk 是否必然是最终阅读列表的第一个（调用方保证此前的 chunk 都不满足）。
+    - 标准阅读：原文第一个 chunk
+    - 快速阅读 + MinerU：按章节标题筛选且保持原文顺序，第一个命中核心章节标题的 chunk
+    - 快速阅读 + pypdf 按全文打分挑选、MinerU 章节勾选依赖用户选择：无法提前确定
+    """
+    parser = getattr(chunk, "parser", "")
+    if bool(st.session_state.get("enable_section_pick")) and parser == "mineru":
+        return False
+    mode = str(st.session_state.get("reading_mode") or "detailed").strip().lower()
+    if mode == "fast":
+        return parser == "mineru" and is_fast_section_title(getattr(chunk, "section_title", ""))
+    return position == 0
+
+
+def _start_first_chunk_generation(chunk: PdfChunk) -> None:
+    """在解析尚未结束时就把 chunk 0 的剧本生成提交到预生成线程池。"""
+    _clear_prefetch_buffer(bump_run_token=True)
+    _ensure_prefetch_window([chunk], -1, k=1)
 
 
 def load_script_for_chunk(chunks: List[PdfChunk], chunk_idx: int) -> None:
@@ -904,6 +1296,7 @@ def _reset_session() -> None:
     st.session_state.generator_ready  = False
     _clear_prefetch_buffer(bump_run_token=True)
     st.session_state.paper_image_map  = {}
+    st.session_state._pdf_bytes       = None  # type: ignore[attr-defined]
     # 清理进度状态
     st.session_state.processing_status_idx = 0
     st.session_state.processing_progress = 0
@@ -911,6 +1304,66 @@ def _reset_session() -> None:
     st.session_state.processing_phase = 0
 
 
+def _start_processing(
+    *,
+    pdf_path: Optional[Path] = None,
+    pdf_bytes: Optional[bytes] = None,
+    pdf_name: str = "",
+) -> None:
+    """记录待解析的 PDF（演示文档路径或上传内容）并进入 PROCESSING。"""
+    st.session_state._tmp_pdf_path = str(pdf_path) if pdf_path else ""  # type: ignore[attr-defined]
+    st.session_state._pdf_bytes = pdf_bytes  # type: ignore[attr-defined]
+    st.session_state._pdf_name = pdf_name or (pdf_path.name if pdf_path else "")  # type: ignore[attr-defined]
+    st.session_state.chunks = []
+    st.session_state.raw_chunks = []
+    st.session_state.available_sections = []
+    st.session_state.selected_sections = None
+    st.session_state.section_label_to_key = {}
+    st.session_state.section_filter_applied = False
+    st.session_state.state = "PROCESSING"
+    st.session_state.generator_ready = False
+    _warm_script_generator(connect=True)
+
+
+def _go_to(new_state: str) -> None:
+    """按钮 on_click 回调：在下一次重跑开始前切换页面，不再额外 st.rerun() 一轮。"""
+    st.session_state.state = new_state
+
+
+def _transition(new_state: str) -> None:
+    """渲染过程中发现需要换页时使用：切换状态并立即结束本轮（st.rerun 会抛出，调用方之后的代码不会执行）。"""
+    st.session_state.state = new_state
+    st.rerun()
+
+
+def _enter_from_landing(use_demo_pdf: bool) -> None:
+    _warm_script_generator()
+    st.session_state.use_demo_pdf = use_demo_pdf
+    st.session_state.state = "SETUP" if use_demo_pdf else "GUIDE"
+
+
+def _on_pdf_uploaded() -> None:
+    uploaded = st.session_state.get("pdf_upload")
+    if uploaded is not None:
+        # 直接把上传内容交给解析器（内存中解析），不再落临时文件；
+        # getvalue() 返回上传缓冲区本身（BytesIO 写时复制），不会再多拷贝一份
+        _start_processing(pdf_bytes=uploaded.getvalue(), pdf_name=uploaded.name)
+
+
+def _back_to_setup_from_sections() -> None:
+    # 保存角色选择到临时键，在selectbox渲染前恢复
+    st.session_state.saved_character = st.session_state.get("selected_character", DEFAULT_CHARACTER)
+    st.session_state.state = "SETUP"
+
+
+def _confirm_sections() -> None:
+    if not st.session_state.get("selected_sections"):
+        st.session_state._section_pick_error = True  # type: ignore[attr-defined]
+        return
+    st.session_state.section_filter_applied = True
+    st.session_state.state = "PROCESSING"
+
+
 def advance() -> None:
     items: List[Dict[str, Any]] = st.session_state.script_items
     st.session_state.current_feedback = None
@@ -923,13 +1376,16 @@ def advance() -> None:
 
     if st.session_state.script_idx >= len(items):
         chunks: List[PdfChunk] = st.session_state.chunks
+        done_idx = int(st.session_state.chunk_idx)
+        if 0 <= done_idx < len(chunks):
+            # 读完的段落只保留元数据（章节名、图片），正文不再需要
+            chunks[done_idx] = dataclasses.replace(chunks[done_idx], text="")
         st.session_state.chunk_idx += 1
         if st.session_state.chunk_idx >= len(chunks):
             _reset_session()
             return
         st.session_state.generator_ready = False
         st.session_state.state = "PROCESSING"
-        st.rerun()
 
 
 # ──────────────────────────────────────────────
@@ -937,101 +1393,105 @@ def advance() -> None:
 #              立绘 / 名牌 / 对话框）
 # ──────────────────────────────────────────────
 
-def render_game_screen(item: Optional[Dict[str, Any]]) -> None:
-    inject_game_css(_file_to_data_uri(ASSET_BG))
+# 游戏画面的固定 HTML 骨架，渲染时只填入动态字段
+_PROGRESS_TMPL = """
+<div class="p2g-progress-wrap">
+  <div class="p2g-progress-fill" style="width:{pct}%"></div>
+</div>"""
+_CHAPTER_CARD_TMPL = """
+<div class="p2g-chapter-card">
+  <div class="p2g-chapter-label">Chapter</div>
+  <div class="p2g-chapter-title">{title}</div>
+</div>"""
+_NAMEPLATE_TMPL = '<div class="p2g-nameplate">{speaker}</div>'
+_DIALOGUE_TMPL = """
+<div class="p2g-dialogue">
+  <div class="p2g-text">{text}</div>
+  {fb_html}
+  {arrow_html}
+</div>"""
+_NEXT_ARROW_HTML = '<div class="p2g-next-arrow">▼</div>'
+
 
-    chunks:    List[PdfChunk] = st.session_state.chunks
-    chunk_idx: int            = st.session_state.chunk_idx
+def _dialogue_box_html(speaker: str, text: str, *, fb_html: str = "", show_arrow: bool = True) -> str:
+    """名牌 + 对话框。speaker / text 为原始字符串，在这里统一转义；fb_html 须已转义。"""
+    # 不做 lru_cache：app.py 每次 rerun 都会重新执行，模块级缓存活不过一帧，且两次 format 本身只是微秒级
+    return _NAMEPLATE_TMPL.format(speaker=html.escape(speaker)) + _DIALOGUE_TMPL.format(
+        text=html.escape(text),
+        fb_html=fb_html,
+        arrow_html=_NEXT_ARROW_HTML if show_arrow else "",
+    )
+
+
+def render_game_screen(item: Optional[Dict[str, Any]]) -> None:
+    ss = st.session_state
+    chunks:    List[PdfChunk] = ss.chunks
+    chunk_idx: int            = ss.chunk_idx
     total = len(chunks)
 
+    # 剧本（LLM）与 PDF 解析出的字符串一律经 html.escape 后再拼进 HTML
+    # 全局样式与画面拼成同一个 st.markdown：每帧只产生一个 delta（样式仍需每帧输出，否则会被移除）
+    parts: List[str] = [_game_css(_background_src())]
+
     # ─ 进度条 ─
     pct = int((chunk_idx / max(total - 1, 1)) * 100) if total > 1 else 100
-    progress_html = f"""
-<div class="p2g-progress-wrap">
-  <div class="p2g-progress-fill" style="width:{pct}%"></div>
-</div>"""
+    parts.append(_PROGRESS_TMPL.format(pct=pct))
 
     # ─ 章节徽章 ─
     section_title = ""
     if chunks and 0 <= chunk_idx < total:
         section_title = getattr(chunks[chunk_idx], "section_title", "") or ""
-    badge_html = (
-        f'<div class="p2g-section-badge">📖 {section_title}</div>'
-        if section_title else ""
-    )
+    if section_title:
+        parts.append(f'<div class="p2g-section-badge">📖 {html.escape(section_title)}</div>')
 
     # ─ Debug 徽章 ─
-    p = st.session_state.get("parser_used") or "pypdf"
-    img_count = len(st.session_state.get("paper_image_map") or {})
+    p = ss.get("parser_used") or "pypdf"
+    img_count = len(ss.get("paper_image_map") or {})
     img_str = f" | 🖼 {img_count}张图" if img_count else ""
-    debug_html = f'<div class="p2g-debug-badge">[debug] {p.upper()}{img_str}</div>'
-    mode = str(st.session_state.get("reading_mode") or "detailed").strip().lower()
+    parts.append(f'<div class="p2g-debug-badge">[debug] {html.escape(p.upper())}{img_str}</div>')
+    mode = str(ss.get("reading_mode") or "detailed").strip().lower()
     mode_label = READING_MODE_LABELS.get(mode, "标准阅读（详细）")
-    mode_html = f'<div class="p2g-mode-badge">模式: {mode_label}</div>'
+    parts.append(f'<div class="p2g-mode-badge">模式: {mode_label}</div>')
 
     # ─ 预生成状态徽章（给用户感知下一段是否已准备好）─
-    prefetch_html = ""
     next_chunk_idx = chunk_idx + 1
     if 0 <= next_chunk_idx < total:
-        cache = dict(st.session_state.get("prefetch_cache") or {})
-        future = st.session_state.get("prefetch_future")
-        target_idx = st.session_state.get("prefetch_target_idx")
-        if next_chunk_idx in cache:
-            prefetch_html = '<div class="p2g-prefetch-badge ready">下一段已就绪</div>'
-        elif future is not None and target_idx == next_chunk_idx:
-            prefetch_html = '<div class="p2g-prefetch-badge loading">正在预生成下一段...</div>'
+        if next_chunk_idx in ss.prefetch_cache:
+            parts.append('<div class="p2g-prefetch-badge ready">下一段已就绪</div>')
+        elif next_chunk_idx in ss.prefetch_futures:
+            parts.append('<div class="p2g-prefetch-badge loading">正在预生成下一段...</div>')
 
     # ─ 立绘 ─
     # 获取当前选择的角色
-    current_character = st.session_state.get("selected_character", DEFAULT_CHARACTER)
-    # 使用新角色的图片加载方式
-    char_assets = _load_character_assets(current_character)
-    
-    # 调试信息 - 显示图片路径
-    #st.caption(f"DEBUG: current_character={current_character}, char_assets={char_assets}")
-    
-    # 兼容旧的 emotion key（如 char_normal -> normal）
+    current_character = ss.get("selected_character", DEFAULT_CHARACTER)
+    # 各表情立绘地址已按角色预先解析，这里只做查表
+    char_srcs = _character_sprite_srcs(current_character)
+
+    # 兼容旧的 emotion key（如 normal -> char_normal）
     emotion_key = "char_normal"
     if item and item.get("emotion"):
         emotion_key = str(item["emotion"])
-    # 将 char_xxx 转换为 xxx
-    emotion_file_key = emotion_key.replace("char_", "") if emotion_key.startswith("char_") else emotion_key
-    char_path = char_assets.get(emotion_key) or char_assets.get(f"char_{emotion_file_key}")
-    if not char_path:
-        # 回退到默认
-        char_path = char_assets.get("char_normal")
-    
-    # 调试信息 - 显示实际使用的图片路径
-    #st.caption(f"DEBUG: emotion_key={emotion_key}, char_path={char_path}, exists={char_path.exists() if char_path else False}")
-    
-    char_uri  = _file_to_data_uri(char_path) if char_path else None
-    char_html = f'<img class="p2g-char" src="{char_uri}" />' if char_uri else ""
+    if not emotion_key.startswith("char_"):
+        emotion_key = f"char_{emotion_key}"
+    # 回退到默认表情
+    char_uri = char_srcs.get(emotion_key) or char_srcs.get("char_normal")
+    if char_uri:
+        parts.append(f'<img class="p2g-char" src="{char_uri}" />')
 
     # 获取当前角色名称
     current_character_name = _get_character_name(current_character)
-    #st.caption(f"DEBUG: current_character_name={current_character_name}")
 
     # ─ 内容区（对话框 / 名牌 / 章节标题卡）─
     t = (item or {}).get("type") or "dialogue"
-    feedback = st.session_state.current_feedback or ""
+    feedback = ss.current_feedback or ""
 
     if t == "sub_head":
-        title = (item or {}).get("title") or ""
-        chapter_html = f"""
-<div class="p2g-chapter-card">
-  <div class="p2g-chapter-label">Chapter</div>
-  <div class="p2g-chapter-title">{title}</div>
-</div>"""
-        nameplate_html = f'<div class="p2g-nameplate">{current_character_name}</div>'
-        dialogue_html  = f"""
-<div class="p2g-dialogue">
-  <div class="p2g-text">～ {title} ～</div>
-  <div class="p2g-next-arrow">▼</div>
-</div>"""
+        title = str((item or {}).get("title") or "")
+        parts.append(_CHAPTER_CARD_TMPL.format(title=html.escape(title)))
+        parts.append(_dialogue_box_html(current_character_name, f"～ {title} ～"))
 
     else:
         # ── 对话携带 figure_id 时在上方渲染图片卡 ──
-        chapter_html = ""
         if not item:
             speaker, text = current_character_name, "还没有脚本内容……"
         elif t == "dialogue":
@@ -1041,19 +1501,17 @@ def render_game_screen(item: Optional[Dict[str, Any]]) -> None:
                 speaker = current_character_name
             else:
                 speaker = raw_speaker
-            text = str(item.get("text") or "")
-            speaker   = str(item.get("speaker") or "奈奈")
-            text      = str(item.get("text")    or "")
+            text      = str(item.get("text") or "")
             figure_id = str(item.get("figure_id") or "")
             if figure_id:
                 img_path_str = _lookup_image_path(figure_id)
-                if img_path_str:
-                    img_uri = _file_to_data_uri(Path(img_path_str))
-                    chapter_html = f"""
+                img_uri = _file_to_data_uri(Path(img_path_str)) if img_path_str else None
+                if img_uri:
+                    parts.append(f"""
 <div class="p2g-figure-card with-dialogue">
   <div class="p2g-figure-label">论文插图</div>
-  <img class="p2g-figure-img" src="{img_uri}" alt="{figure_id}" />
-</div>""" if img_uri else ""
+  <img class="p2g-figure-img" src="{img_uri}" alt="{html.escape(figure_id)}" />
+</div>""")
         elif t == "quiz":
             speaker = current_character_name
             text    = str(item.get("question") or f"来做个小测验{current_character_name}！")
@@ -1062,70 +1520,115 @@ def render_game_screen(item: Optional[Dict[str, Any]]) -> None:
             text    = str(item.get("prompt") or "你选哪个？")
         else:
             speaker = current_character_name
-            text    = str(item.get("text") or json.dumps(item, ensure_ascii=False))
+            text    = str(item.get("text") or item.get("_display") or "")
 
         # 反馈气泡 + 解析（quiz 区分对错颜色；choice 统一中性色）
-        if feedback and t == "quiz":
-            correct_fb = str((item or {}).get("feedback_correct") or "")
-            fb_cls     = "correct" if feedback == correct_fb else "wrong"
-            fb_html    = f'<div class="p2g-feedback {fb_cls}">{feedback}</div>'
-            explanation = str((item or {}).get("explanation") or "").strip()
-            if explanation:
-                fb_html += (
-                    f'<div class="p2g-explanation">'
-                    f'<span class="p2g-explanation-label">📖 解析</span>'
-                    f'{explanation}'
-                    f'</div>'
-                )
-        elif feedback and t == "choice":
-            fb_html = f'<div class="p2g-feedback">{feedback}</div>'
+        fb_html = ""
+        if feedback:
+            fb_cls = ""
             explanation = str((item or {}).get("explanation") or "").strip()
+            if t == "quiz":
+                correct_fb = str((item or {}).get("feedback_correct") or "")
+                fb_cls = " correct" if feedback == correct_fb else " wrong"
+                explanation_label = "📖 解析"
+            elif t == "choice":
+                explanation_label = f"💭 {html.escape(current_character_name)}的想法"
+            else:
+                explanation = ""
+            fb_html = f'<div class="p2g-feedback{fb_cls}">{html.escape(str(feedback))}</div>'
             if explanation:
                 fb_html += (
                     f'<div class="p2g-explanation">'
-                    f'<span class="p2g-explanation-label">💭 {current_character_name}的想法</span>'
-                    f'{explanation}'
+                    f'<span class="p2g-explanation-label">{explanation_label}</span>'
+                    f'{html.escape(explanation)}'
                     f'</div>'
                 )
-        elif feedback:
-            fb_html = f'<div class="p2g-feedback">{feedback}</div>'
-        else:
-            fb_html = ""
 
         # ▼ 继续箭头：对话 & 答完题后显示
         show_arrow = t == "dialogue" or t == "sub_head" or bool(feedback)
-        arrow_html = '<div class="p2g-next-arrow">▼</div>' if show_arrow else ""
 
-        nameplate_html = f'<div class="p2g-nameplate">{speaker}</div>'
-        dialogue_html  = f"""
-<div class="p2g-dialogue">
-  <div class="p2g-text">{text}</div>
-  {fb_html}
-  {arrow_html}
-</div>"""
+        parts.append(_dialogue_box_html(speaker, text, fb_html=fb_html, show_arrow=show_arrow))
 
-    st.markdown(
-        "".join([
-            progress_html, badge_html, debug_html, mode_html, prefetch_html,
-            char_html, chapter_html,
-            nameplate_html, dialogue_html,
-        ]),
-        unsafe_allow_html=True,
-    )
+    st.markdown("".join(parts), unsafe_allow_html=True)
 
 
 # ──────────────────────────────────────────────
 # 交互层（Streamlit 组件，必须在 HTML 流里）
 # ──────────────────────────────────────────────
 
+# 对话框脚本：内容固定不变，每个页面只安装一次（window._p2g_dialogue_js 守卫），
+# 之后靠观察者和事件委托跟随每次重跑后的新 DOM，不再需要每次重跑重新挂载。
+_DIALOGUE_JS = """
+<script>
+(function () {
+  // st.html 直接运行在页面中；回退到 components.html 时运行在 iframe 里，取 parent
+  var win = window.parent || window;
+  var doc = win.document;
+  if (win._p2g_dialogue_js) return;
+  win._p2g_dialogue_js = true;
+
+  // ─── ① 实时测量对话框高度，写入 CSS 变量 --p2g-dlg-h ───
+  // 名牌和"继续"按钮的 bottom 都依赖这个变量，确保始终在对话框上方
+  var observed = null;
+  var resizeObs = new win.ResizeObserver(function (entries) {
+    var h = Math.ceil(entries[0].target.getBoundingClientRect().height);
+    if (h > 0) doc.documentElement.style.setProperty('--p2g-dlg-h', h + 'px');
+  });
+  function trackDialogue() {
+    var dlg = doc.querySelector('.p2g-dialogue');
+    if (dlg === observed) return;
+    if (observed) resizeObs.unobserve(observed);
+    observed = dlg;
+    if (dlg) resizeObs.observe(dlg);
+  }
+  // 重跑后对话框节点会被替换：只在节点变化时改挂 ResizeObserver
+  new win.MutationObserver(trackDialogue).observe(doc.body, {childList: true, subtree: true});
+  trackDialogue();
+
+  // ─── ② 点击对话框 = 点击"继续"按钮 ───
+  // 事件委托到 document；未作答的 quiz/choice 不渲染"继续"按钮，查不到即不推进
+  doc.addEventListener('click', function (e) {
+    if (!e.target.closest || !e.target.closest('.p2g-dialogue')) return;
+    var b = doc.querySelector('.st-key-btn_continue button:not([disabled])');
+    if (b) b.click();
+  });
+})();
+</script>
+"""
+
+
+def _inject_dialogue_js() -> None:
+    try:
+        st.html(_DIALOGUE_JS, unsafe_allow_javascript=True)
+    except (AttributeError, TypeError):
+        # 旧版 Streamlit 没有 st.html 或其不支持执行脚本，退回 iframe 组件
+        components.html(_DIALOGUE_JS, height=0)
+
+
+def _select_option(item: Optional[Dict[str, Any]], label: str) -> None:
+    t = (item or {}).get("type") or "dialogue"
+    if t == "quiz":
+        correct = str((item or {}).get("correct_answer") or "").strip()
+        if label == correct:
+            st.session_state.current_feedback = str(
+                (item or {}).get("feedback_correct") or "不错嘛。"
+            )
+        else:
+            st.session_state.current_feedback = str(
+                (item or {}).get("feedback_wrong") or "不对喵！再想想。"
+            )
+    else:
+        st.session_state.current_feedback = f"你选择了：{label}"
+    st.session_state.answered = True
+
+
 def render_interaction(item: Optional[Dict[str, Any]]) -> None:
     t = (item or {}).get("type") or "dialogue"
     is_qa = t in {"quiz", "choice"}
 
+    # 按钮统一走 on_click 回调：状态在本次重跑开始前就已更新，无需再额外 st.rerun()
     # ── 顶部工具栏（退出按钮，极小）──
-    if st.button("✕ 退出", key="btn_exit"):
-        _reset_session()
-        st.rerun()
+    st.button("✕ 退出", key="btn_exit", on_click=_reset_session)
 
     # ── 正文区 ──
     if is_qa and not st.session_state.answered:
@@ -1134,31 +1637,22 @@ def render_interaction(item: Optional[Dict[str, Any]]) -> None:
 
         opts = (item or {}).get("options") or []
         if isinstance(opts, list) and opts:
+            labels = (item or {}).get("option_labels") or _option_labels(opts)
+            key_prefix = f"opt_{st.session_state.chunk_idx}_{st.session_state.script_idx}_"
             _, mid, _ = st.columns([1, 2.2, 1])
             with mid:
                 st.markdown(
                     '<div class="p2g-options-label">— 请选择 —</div>',
                     unsafe_allow_html=True,
                 )
-                for i, opt in enumerate(opts):
-                    label    = str(opt)
-                    btn_key  = f"opt_{st.session_state.chunk_idx}_{st.session_state.script_idx}_{i}"
-                    btn_text = f"{_ALPHA[i] if i < len(_ALPHA) else i+1}. {label}"
-                    if st.button(btn_text, key=btn_key, use_container_width=True):
-                        if t == "quiz":
-                            correct = str((item or {}).get("correct_answer") or "").strip()
-                            if label == correct:
-                                st.session_state.current_feedback = str(
-                                    (item or {}).get("feedback_correct") or "不错嘛。"
-                                )
-                            else:
-                                st.session_state.current_feedback = str(
-                                    (item or {}).get("feedback_wrong") or "不对喵！再想想。"
-                                )
-                        else:
-                            st.session_state.current_feedback = f"你选择了：{label}"
-                        st.session_state.answered = True
-                        st.rerun()
+                for i, (opt, btn_text) in enumerate(zip(opts, labels)):
+                    st.button(
+                        btn_text,
+                        key=f"{key_prefix}{i}",
+                        use_container_width=True,
+                        on_click=_select_option,
+                        args=(item, str(opt)),
+                    )
 
     else:
         # 继续按钮改为 fixed 定位，避免被立绘挤出视口
@@ -1168,79 +1662,16 @@ def render_interaction(item: Optional[Dict[str, Any]]) -> None:
         if is_qa and not st.session_state.answered:
             can_next = False
 
-        if st.button(
+        st.button(
             "继续 ▶",
             key="btn_continue",
             disabled=not can_next,
             use_container_width=False,
-        ):
-            advance()
-            st.rerun()
+            on_click=advance,
+        )
 
     # ── JS 注入：① 对话框高度 → CSS 变量  ② 点击对话框推进 ──
-    _can_click_dialogue = not (is_qa and not st.session_state.answered)
-    components.html(
-        f"""
-<script>
-(function () {{
-  var par = window.parent;
-  if (!par) return;
-  var doc = par.document;
-
-  // ─── ① 实时测量对话框高度，写入 CSS 变量 --p2g-dlg-h ───
-  // 名牌和"继续"按钮的 bottom 都依赖这个变量，确保始终在对话框上方
-  function updateDlgHeight() {{
-    var dlg = doc.querySelector('.p2g-dialogue');
-    if (dlg) {{
-      var h = Math.ceil(dlg.getBoundingClientRect().height);
-      if (h > 0) doc.documentElement.style.setProperty('--p2g-dlg-h', h + 'px');
-    }}
-  }}
-  updateDlgHeight();
-  setTimeout(updateDlgHeight, 150);
-  setTimeout(updateDlgHeight, 600);
-
-  // 窗口大小改变时重算（响应竖屏/横屏切换）
-  if (!par._p2g_resize_bound) {{
-    par.addEventListener('resize', updateDlgHeight, {{passive: true}});
-    par._p2g_resize_bound = true;
-  }}
-
-  // MutationObserver：对话框内容变化时（如解析展开）立即重算
-  if (par._p2g_dlg_observer) par._p2g_dlg_observer.disconnect();
-  var dlgEl = doc.querySelector('.p2g-dialogue');
-  if (dlgEl) {{
-    par._p2g_dlg_observer = new MutationObserver(function() {{
-      updateDlgHeight();
-    }});
-    par._p2g_dlg_observer.observe(dlgEl, {{childList: true, subtree: true}});
-  }}
-
-  // ─── ② 点击对话框 = 点击"继续"按钮 ───
-  if (par._p2g_click_handler) {{
-    doc.removeEventListener('click', par._p2g_click_handler, true);
-  }}
-
-  var canClick = {'true' if _can_click_dialogue else 'false'};
-  par._p2g_click_handler = function (e) {{
-    if (!canClick) return;
-    var dlg = doc.querySelector('.p2g-dialogue');
-    if (!dlg || !dlg.contains(e.target)) return;
-    var btns = doc.querySelectorAll('button');
-    for (var i = 0; i < btns.length; i++) {{
-      var b = btns[i];
-      if (b.textContent.trim().startsWith('\u7ee7\u7eed') && !b.disabled) {{
-        b.click();
-        return;
-      }}
-    }}
-  }};
-  doc.addEventListener('click', par._p2g_click_handler, true);
-}})();
-</script>
-        """,
-        height=0,
-    )
+    _inject_dialogue_js()
 
 
 # ──────────────────────────────────────────────
@@ -1248,15 +1679,14 @@ def render_interaction(item: Optional[Dict[str, Any]]) -> None:
 # ──────────────────────────────────────────────
 
 def render_landing_page() -> None:
-    inject_game_css(_file_to_data_uri(ASSET_BG))
+    inject_game_css(_background_src())
     ensure_assets_notice()
 
     st.markdown(
         """
 <style>
 .p2g-landing-card {
-  background: rgba(8,5,20,0.82);
-  backdrop-filter: blur(18px);
+  background: rgba(8,5,20,0.9);
   border: 1px solid rgba(130,90,230,0.4);
   border-radius: 18px;
   padding: 2.2rem 2.3rem 1.6rem;
@@ -1323,34 +1753,35 @@ def render_landing_page() -> None:
 
     _, mid_l, mid_r, _ = st.columns([0.8, 1, 1, 0.8])
     with mid_l:
-        if st.button("上传论文开始", key="btn_start_game", use_container_width=True):
-            st.session_state.use_demo_pdf = False
-            st.session_state.state = "GUIDE"
-            st.rerun()
+        st.button(
+            "上传论文开始",
+            key="btn_start_game",
+            use_container_width=True,
+            on_click=_enter_from_landing,
+            args=(False,),
+        )
     with mid_r:
-        demo_disabled = not DEMO_PDF.exists()
-        if st.button(
+        demo_disabled = not _demo_pdf_available()
+        st.button(
             "演示体验 (ReAct)",
             key="btn_demo_play",
             use_container_width=True,
             disabled=demo_disabled,
             help=None if not demo_disabled else "找不到 papers/ReAct.pdf，请确认文件存在。",
-        ):
-            st.session_state.use_demo_pdf = True
-            st.session_state.state = "SETUP"
-            st.rerun()
+            on_click=_enter_from_landing,
+            args=(True,),
+        )
 
 
 def render_guide_page() -> None:
-    inject_game_css(_file_to_data_uri(ASSET_BG))
+    inject_game_css(_background_src())
     ensure_assets_notice()
 
     st.markdown(
         """
 <style>
 .p2g-guide-card {
-  background: rgba(8,5,20,0.84);
-  backdrop-filter: blur(18px);
+  background: rgba(8,5,20,0.9);
   border: 1px solid rgba(130,90,230,0.42);
   border-radius: 18px;
   padding: 2rem 2.2rem;
@@ -1415,54 +1846,27 @@ def render_guide_page() -> None:
 
     _, mid, _ = st.columns([1, 1.4, 1])
     with mid:
-        if st.button("前往上传论文", key="btn_go_setup", use_container_width=True):
-            st.session_state.state = "SETUP"
-            st.rerun()
-        if st.button("返回首页", key="btn_back_landing", use_container_width=True):
-            st.session_state.state = "LANDING"
-            st.rerun()
+        st.button("前往上传论文", key="btn_go_setup", use_container_width=True, on_click=_go_to, args=("SETUP",))
+        st.button("返回首页", key="btn_back_landing", use_container_width=True, on_click=_go_to, args=("LANDING",))
 
 
-def main() -> None:
-    st.set_page_config(
-        page_title="Paper2Galgame",
-        page_icon="📖",
-        layout="wide",
-        initial_sidebar_state="collapsed",
-    )
-    init_state()
-    uploaded = None
-    # 强制同步一次，确保无论在哪个页面，selected_character 永远等于 persistent_char
-    if "persistent_char" in st.session_state:
-        st.session_state.selected_character = st.session_state.persistent_char
-    # 确保角色选择始终存在，并验证其值在CHARACTERS中有效
-    elif "selected_character" not in st.session_state:
-        st.session_state.selected_character = DEFAULT_CHARACTER
-    elif st.session_state.selected_character not in CHARACTERS:
-        st.session_state.selected_character = DEFAULT_CHARACTER
+# ════════════════════════════
+# STATE: SETUP
+# ════════════════════════════
+def render_setup_page() -> None:
+    """上传页：选择角色 / 阅读模式 / OCR，上传论文或使用演示文档。"""
+    # 调试信息
+    #st.write(f"DEBUG SETUP: selected_character = {st.session_state.get('selected_character')}")
+
+    # 封面注入背景（无图时只用黑底）
+    inject_game_css(_background_src())
+    ensure_assets_notice()
 
-    if st.session_state.state == "LANDING":
-        render_landing_page()
-
-    elif st.session_state.state == "GUIDE":
-        render_guide_page()
-
-    # ════════════════════════════
-    # STATE: SETUP
-    # ════════════════════════════
-    elif st.session_state.state == "SETUP":
-        # 调试信息
-        #st.write(f"DEBUG SETUP: selected_character = {st.session_state.get('selected_character')}")
-        
-        # 封面注入背景（无图时只用黑底）
-        inject_game_css(_file_to_data_uri(ASSET_BG))
-        ensure_assets_notice()
-
-        st.markdown(
-            """
+    st.markdown(
+        """
 <style>
 .setup-card {
-  background: rgba(8,5,20,0.82); backdrop-filter: blur(18px);
+  background: rgba(8,5,20,0.9);
   border: 1px solid rgba(130,90,230,0.4); border-radius: 18px;
   padding: 2.2rem 2.5rem; max-width: 540px; margin: 8vh auto 0;
 }
@@ -1482,103 +1886,102 @@ def main() -> None:
   <div class="setup-subtitle">把论文变成猫娘陪读视觉小说</div>
 </div>
             """,
-            unsafe_allow_html=True,
-        )
+        unsafe_allow_html=True,
+    )
 
-        with st.container():
-            st.markdown("<div style='max-width:540px; margin:0 auto; padding:0 1rem'>", unsafe_allow_html=True)
+    with st.container():
+        st.markdown("<div style='max-width:540px; margin:0 auto; padding:0 1rem'>", unsafe_allow_html=True)
+
+        st.button("返回说明页", key="btn_back_guide", use_container_width=True, on_click=_go_to, args=("GUIDE",))
+
+        # ── 角色选择 ──
+        # 确保 session_state 中有一个持久化的 key
+        if "persistent_char" not in st.session_state:
+            st.session_state.persistent_char = DEFAULT_CHARACTER
+
+        character_options = list(CHARACTERS.keys())
+        character_labels = {k: f"{v['name']} - {v['description']}" for k, v in CHARACTERS.items()}
+
+        # 找到当前持久化角色在选项中的索引，确保 UI 反显正确
+        try:
+            current_idx = character_options.index(st.session_state.persistent_char)
+        except ValueError:
+            current_idx = 0
+
+        # 渲染 selectbox，使用 key="char_selector" 避免冲突
+        selected_character = st.selectbox(
+            "🎭 选择陪你阅读的角色",
+            options=character_options,
+            index=current_idx,
+            key="char_selector", 
+            format_func=lambda x: character_labels.get(x, x),
+            help="选择不同的角色陪你阅读论文",
+        )
 
-            if st.button("返回说明页", key="btn_back_guide", use_container_width=True):
-                st.session_state.state = "GUIDE"
-                st.rerun()
+        # 实时同步到持久化变量和全局使用的 selected_character
+        st.session_state.persistent_char = selected_character
+        st.session_state.selected_character = selected_character
 
-            # ── 角色选择 ──
-            # 确保 session_state 中有一个持久化的 key
-            if "persistent_char" not in st.session_state:
-                st.session_state.persistent_char = DEFAULT_CHARACTER
-            
-            character_options = list(CHARACTERS.keys())
-            character_labels = {k: f"{v['name']} - {v['description']}" for k, v in CHARACTERS.items()}
+        current_debug = st.session_state.get("selected_character", "NOT_SET")
+        #st.caption(f"DEBUG: selected_character = {current_debug}")
 
-            # 找到当前持久化角色在选项中的索引，确保 UI 反显正确
-            try:
-                current_idx = character_options.index(st.session_state.persistent_char)
-            except ValueError:
-                current_idx = 0
-
-            # 渲染 selectbox，使用 key="char_selector" 避免冲突
-            selected_character = st.selectbox(
-                "🎭 选择陪你阅读的角色",
-                options=character_options,
-                index=current_idx,
-                key="char_selector", 
-                format_func=lambda x: character_labels.get(x, x),
-                help="选择不同的角色陪你阅读论文",
+        # 检查角色资源是否存在（复用已缓存的立绘地址，解析不到的即为缺失）
+        char_srcs = _character_sprite_srcs(selected_character)
+        missing_char_imgs = [
+            str(path)
+            for emotion, path in _load_character_assets(selected_character).items()
+            if not char_srcs.get(emotion)
+        ]
+        if missing_char_imgs:
+            st.warning(
+                f"角色「{_get_character_name(selected_character)}」的图片缺失，将使用默认角色。\n"
+                + "缺失文件：" + ", ".join([str(p) for p in missing_char_imgs])
             )
 
-            # 实时同步到持久化变量和全局使用的 selected_character
-            st.session_state.persistent_char = selected_character
-            st.session_state.selected_character = selected_character
-
-            current_debug = st.session_state.get("selected_character", "NOT_SET")
-            #st.caption(f"DEBUG: selected_character = {current_debug}")
-
-            # 检查角色资源是否存在
-            char_assets = _load_character_assets(selected_character)
-            missing_char_imgs = []
-            for emotion, path in char_assets.items():
-                if not path.exists():
-                    missing_char_imgs.append(str(path))
-            if missing_char_imgs:
-                st.warning(
-                    f"角色「{_get_character_name(selected_character)}」的图片缺失，将使用默认角色。\n"
-                    + "缺失文件：" + ", ".join([str(p) for p in missing_char_imgs])
-                )
-
-            # ── 阅读模式选择 ──
-            if str(st.session_state.get("reading_mode") or "").strip().lower() not in READING_MODE_OPTIONS:
-                st.session_state.reading_mode = "detailed"
-            st.selectbox(
-                "阅读模式",
-                options=READING_MODE_OPTIONS,
-                key="reading_mode",
-                format_func=lambda x: READING_MODE_LABELS.get(str(x), str(x)),
-                help="极速：只读摘要/方法/实验；标准：完整阅读。",
-            )
+        # ── 阅读模式选择 ──
+        if str(st.session_state.get("reading_mode") or "").strip().lower() not in READING_MODE_OPTIONS:
+            st.session_state.reading_mode = "detailed"
+        st.selectbox(
+            "阅读模式",
+            options=READING_MODE_OPTIONS,
+            key="reading_mode",
+            format_func=lambda x: READING_MODE_LABELS.get(str(x), str(x)),
+            help="极速：只读摘要/方法/实验；标准：完整阅读。",
+        )
 
-            # 初始化 enable_section_pick（如果还没有值）
-            st.session_state.setdefault("enable_section_pick", False)
+        # 初始化 enable_section_pick（如果还没有值）
+        st.session_state.setdefault("enable_section_pick", False)
 
-            st.checkbox(
-                "手动勾选阅读章节（需 MinerU 解析）",
-                key="enable_section_pick",
-            )
+        st.checkbox(
+            "手动勾选阅读章节（需 MinerU 解析）",
+            key="enable_section_pick",
+        )
 
-            # 初始化 use_mineru（如果还没有值）
-            st.session_state.setdefault("use_mineru", True)
+        # 初始化 use_mineru（如果还没有值）
+        st.session_state.setdefault("use_mineru", True)
 
-            mineru_ready = token_available()
-            # 如果启用了章节勾选，强制使用 MinerU
-            use_mineru_for_checkbox = mineru_ready and (
-                st.session_state.enable_section_pick or st.session_state.use_mineru
-            )
-            st.checkbox(
-                "🔬 使用 MinerU OCR 解析（按章节，需要 MINERU_API_TOKEN）",
-                key="use_mineru",
-                value=use_mineru_for_checkbox,
-                disabled=(not mineru_ready) or bool(st.session_state.enable_section_pick),
-            )
-            if not mineru_ready:
-                st.caption("💡 设置 MINERU_API_TOKEN 可启用按章节解析。")
-            elif st.session_state.enable_section_pick:
-                st.caption("💡 已启用章节勾选，MinerU OCR 自动开启。")
+        mineru_ready = token_available()
+        # 如果启用了章节勾选，强制使用 MinerU
+        use_mineru_for_checkbox = mineru_ready and (
+            st.session_state.enable_section_pick or st.session_state.use_mineru
+        )
+        st.checkbox(
+            "🔬 使用 MinerU OCR 解析（按章节，需要 MINERU_API_TOKEN）",
+            key="use_mineru",
+            value=use_mineru_for_checkbox,
+            disabled=(not mineru_ready) or bool(st.session_state.enable_section_pick),
+        )
+        if not mineru_ready:
+            st.caption("💡 设置 MINERU_API_TOKEN 可启用按章节解析。")
+        elif st.session_state.enable_section_pick:
+            st.caption("💡 已启用章节勾选，MinerU OCR 自动开启。")
 
-            use_demo: bool = bool(st.session_state.get("use_demo_pdf"))
+        use_demo: bool = bool(st.session_state.get("use_demo_pdf"))
 
-            if use_demo:
-                # ── 演示文档模式：显示信息卡 + 直接开始按钮 ──
-                st.markdown(
-                    f"""
+        if use_demo:
+            # ── 演示文档模式：显示信息卡 + 直接开始按钮 ──
+            st.markdown(
+                f"""
 <div style="
   margin-top:0.8rem; padding:0.9rem 1.1rem;
   background:rgba(100,60,200,0.15); border-radius:12px;
@@ -1593,67 +1996,41 @@ def main() -> None:
     papers/ReAct.pdf &nbsp;·&nbsp; 无需上传，直接开始
   </div>
 </div>""",
-                    unsafe_allow_html=True,
-                )
-                if st.button("开始演示体验", key="btn_start_demo", use_container_width=True):
-                    st.session_state._tmp_pdf_path = str(DEMO_PDF)  # type: ignore[attr-defined]
-                    st.session_state.chunks = []
-                    st.session_state.raw_chunks = []
-                    st.session_state.available_sections = []
-                    st.session_state.selected_sections = None
-                    st.session_state.section_label_to_key = {}
-                    st.session_state.section_filter_applied = False
-                    st.session_state.state = "PROCESSING"
-                    st.rerun()
-            else:
-                # ── 普通上传模式 ──
-                uploaded = st.file_uploader("选择一篇 PDF 论文", type=["pdf"])
-                if uploaded is not None:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as f:
-                        f.write(uploaded.read())
-                        tmp_path = Path(f.name)
-                    st.session_state._tmp_pdf_path = str(tmp_path)  # type: ignore[attr-defined]
-                    st.session_state.chunks = []
-                    st.session_state.raw_chunks = []
-                    st.session_state.available_sections = []
-                    st.session_state.selected_sections = None
-                    st.session_state.section_label_to_key = {}
-                    st.session_state.section_filter_applied = False
-                    st.session_state.state = "PROCESSING"
-                    st.rerun()
-
-            st.markdown("</div>", unsafe_allow_html=True)
-
-        if uploaded is not None:      
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as f:
-                f.write(uploaded.read())
-                tmp_path = Path(f.name)
-            st.session_state._tmp_pdf_path = str(tmp_path)  # type: ignore[attr-defined]
-            st.session_state.chunks = []
-            st.session_state.raw_chunks = []
-            st.session_state.available_sections = []
-            st.session_state.selected_sections = None
-            st.session_state.section_label_to_key = {}
-            st.session_state.section_filter_applied = False
-            st.session_state.state = "PROCESSING"
-            st.rerun()
-
-    elif st.session_state.state == "SECTION_PICKER":
-        # 调试信息
-        #st.write(f"DEBUG SECTION_PICKER: selected_character = {st.session_state.get('selected_character')}")
-        
-        inject_game_css(_file_to_data_uri(ASSET_BG))
-        ensure_assets_notice()
-
-        sections: List[str] = list(st.session_state.get("available_sections") or [])
-        if not sections:
-            st.session_state.state = "PROCESSING"
-            st.rerun()
-
-        st.markdown(
-            """
-<div style="max-width:760px;margin:8vh auto 0;background:rgba(8,5,20,0.82);
-  backdrop-filter:blur(18px);border:1px solid rgba(130,90,230,0.4);
+                unsafe_allow_html=True,
+            )
+            st.button(
+                "开始演示体验",
+                key="btn_start_demo",
+                use_container_width=True,
+                on_click=_start_processing,
+                kwargs={"pdf_path": DEMO_PDF},
+            )
+        else:
+            # ── 普通上传模式 ──
+            st.file_uploader("选择一篇 PDF 论文", type=["pdf"], key="pdf_upload", on_change=_on_pdf_uploaded)
+
+        st.markdown("</div>", unsafe_allow_html=True)
+
+
+# ════════════════════════════
+# STATE: SECTION_PICKER
+# ════════════════════════════
+def render_section_picker_page() -> None:
+    """章节选择页（MinerU 解析时）。"""
+    # 调试信息
+    #st.write(f"DEBUG SECTION_PICKER: selected_character = {st.session_state.get('selected_character')}")
+
+    inject_game_css(_background_src())
+    ensure_assets_notice()
+
+    sections: List[str] = list(st.session_state.get("available_sections") or [])
+    if not sections:
+        _transition("PROCESSING")
+
+    st.markdown(
+        """
+<div style="max-width:760px;margin:8vh auto 0;background:rgba(8,5,20,0.9);
+  border:1px solid rgba(130,90,230,0.4);
   border-radius:18px;padding:1.6rem 1.8rem;">
   <div style="font-size:1.25rem;font-weight:700;color:#ead8ff;letter-spacing:1px;">
     选择要阅读的章节
@@ -1663,101 +2040,31 @@ def main() -> None:
   </div>
 </div>
             """,
-            unsafe_allow_html=True,
-        )
+        unsafe_allow_html=True,
+    )
 
-        # 初始化 session_state 中的 selected_sections（必须在 widget 实例化前完成）
-        if st.session_state.get("selected_sections") is None:
-            st.session_state.selected_sections = sections
+    # 初始化 session_state 中的 selected_sections（必须在 widget 实例化前完成）
+    if st.session_state.get("selected_sections") is None:
+        st.session_state.selected_sections = sections
 
-        # 使用 key 参数直接绑定到 session_state，避免 default 参数导致的点击两次问题
-        st.multiselect(
-            "章节列表",
-            options=sections,
-            key="selected_sections",
-        )
-        # 从 session_state 获取最终选择
-        selected = st.session_state.selected_sections
-
-        col_back, col_ok = st.columns([1, 1])
-        with col_back:
-            if st.button("返回上传页", key="btn_back_setup", use_container_width=True):
-                # 保存当前选择的角色（使用临时键名，在selectbox渲染前恢复）
-                saved_character = st.session_state.get("selected_character", DEFAULT_CHARACTER)
-                st.session_state.state = "SETUP"
-                # 保存角色选择到临时键，在selectbox渲染前恢复
-                st.session_state.saved_character = saved_character
-                st.rerun()
-        with col_ok:
-            if st.button("开始阅读", key="btn_start_with_sections", use_container_width=True):
-                # 调试信息
-                #st.write(f"DEBUG 跳转前: selected_character = {st.session_state.get('selected_character')}")
-                if not selected:
-                    st.error("请至少勾选一个章节，不能空选。")
-                else:
-                    st.session_state.section_filter_applied = True
-                    st.session_state.state = "PROCESSING"
-                    st.rerun()
-
-    # ════════════════════════════
-    # STATE: PROCESSING
-    # ════════════════════════════
-    elif st.session_state.state == "PROCESSING":
-        # 调试信息
-        #st.write(f"DEBUG PROCESSING: selected_character = {st.session_state.get('selected_character')}")
-        
-        inject_game_css(_file_to_data_uri(ASSET_BG))
-
-        st.markdown(
-            """
-<style>
-/* 禁用页面所有可交互元素 */
-section[data-testid="stMainBlockContainer"] button,
-section[data-testid="stMainBlockContainer"] input,
-section[data-testid="stMainBlockContainer"] select,
-section[data-testid="stMainBlockContainer"] textarea,
-section[data-testid="stMainBlockContainer"] .stCheckbox,
-section[data-testid="stMainBlockContainer"] .stSelectbox,
-section[data-testid="stMainBlockContainer"] .stFileUploader,
-div[data-testid="stFileUploader"],
-.stApp button,
-.stApp input,
-.stApp select,
-.stApp textarea,
-div[data-baseweb="select"] > div {
-  pointer-events: none !important;
-  opacity: 0.3 !important;
-  cursor: not-allowed !important;
-  filter: grayscale(80%);
-}
-/* 处理多选框 */
-section[data-testid="stMainBlockContainer"] .stMultiSelect {
-  pointer-events: none !important;
-  opacity: 0.3 !important;
-}
-</style>
-            """,
-            unsafe_allow_html=True,
-        )
-        
-        status_container = st.empty()
-
-        status_messages = [
-            "正在解析论文...",
-            "正在识别章节结构...",
-            "正在处理章节筛选...",
-            "正在生成剧本内容...",
-            "马上就好啦！"
-        ]
+    # 使用 key 参数直接绑定到 session_state，避免 default 参数导致的点击两次问题
+    st.multiselect(
+        "章节列表",
+        options=sections,
+        key="selected_sections",
+    )
 
-        def update_status(idx):
-            msg = status_messages[idx]
-            progress = (idx + 1) * 20
-            extra_hint = ""
-            if idx == 3:
-                extra_hint = '<div style="font-size:11px; color:#a79bff; margin-top:6px;">剧本生成时间较长，请耐心等待</div>'
-            status_container.markdown(
-                f"""
+    col_back, col_ok = st.columns([1, 1])
+    with col_back:
+        st.button("返回上传页", key="btn_back_setup", use_container_width=True, on_click=_back_to_setup_from_sections)
+    with col_ok:
+        st.button("开始阅读", key="btn_start_with_sections", use_container_width=True, on_click=_confirm_sections)
+        if st.session_state.pop("_section_pick_error", False):
+            st.error("请至少勾选一个章节，不能空选。")
+
+
+# 处理中进度卡片（含样式）；update_status 只填入状态文案与进度
+_PROCESSING_CARD_TMPL = """
     <div class="p2g-processing-card">
       <div class="p2g-processing-icon">⚙️</div>
       <div class="p2g-processing-title">正在生成剧本……</div>
@@ -1771,7 +2078,7 @@ section[data-testid="stMainBlockContainer"] .stMultiSelect {
     <style>
     .p2g-processing-card {{
       position:fixed;left:50%;top:45%;transform:translate(-50%,-50%);
-      background:rgba(8,5,20,0.85);backdrop-filter:blur(14px);
+      background:rgba(8,5,20,0.92);
       border:1px solid rgba(130,90,230,0.4);border-radius:16px;
       padding:2rem 3rem;text-align:center;z-index:60;min-width:360px
     }}
@@ -1802,159 +2109,260 @@ section[data-testid="stMainBlockContainer"] .stMultiSelect {
       border-radius:3px;transition:width 0.4s ease;box-shadow:0 0 10px rgba(160,80,255,0.5)
     }}
     </style>
-    """,
-                unsafe_allow_html=True
-            )
+    """
 
-        if not st.session_state.chunks:
-            update_status(0)
-            pdf_path = Path(getattr(st.session_state, "_tmp_pdf_path", ""))
-            if not pdf_path.exists():
-                st.error("临时 PDF 文件丢失了，请回到封面重新上传。")
-                if st.button("回到封面"):
-                    _reset_session()
-                    st.rerun()
-                return
 
-            raw_chunks: List[PdfChunk] = list(st.session_state.get("raw_chunks") or [])
-            if not raw_chunks:
-                with st.spinner("解析 PDF…"):
-                    try:
-                        raw_chunks = load_and_chunk_pdf(
-                            pdf_path,
-                            use_mineru=bool(st.session_state.use_mineru),
-                        )
-                    except Exception as e:
-                        st.error(f"PDF 解析失败：{e}")
-                        if st.button("回到封面"):
-                            _reset_session()
-                            st.rerun()
-                        return
-
-                if not raw_chunks:
-                    st.error("没有解析到任何文本。可能是扫描版 PDF，请启用 MinerU OCR。")
-                    if st.button("回到封面"):
-                        _reset_session()
-                        st.rerun()
+# ════════════════════════════
+# STATE: PROCESSING
+# ════════════════════════════
+def render_processing_page() -> None:
+    """解析 PDF、筛选章节并生成首段剧本。"""
+    # 调试信息
+    #st.write(f"DEBUG PROCESSING: selected_character = {st.session_state.get('selected_character')}")
+
+    inject_game_css(_background_src())
+
+    st.markdown(
+        """
+<style>
+/* 禁用页面所有可交互元素 */
+section[data-testid="stMainBlockContainer"] button,
+section[data-testid="stMainBlockContainer"] input,
+section[data-testid="stMainBlockContainer"] select,
+section[data-testid="stMainBlockContainer"] textarea,
+section[data-testid="stMainBlockContainer"] .stCheckbox,
+section[data-testid="stMainBlockContainer"] .stSelectbox,
+section[data-testid="stMainBlockContainer"] .stFileUploader,
+div[data-testid="stFileUploader"],
+.stApp button,
+.stApp input,
+.stApp select,
+.stApp textarea,
+div[data-baseweb="select"] > div {
+  pointer-events: none !important;
+  opacity: 0.3 !important;
+  cursor: not-allowed !important;
+  filter: grayscale(80%);
+}
+/* 处理多选框 */
+section[data-testid="stMainBlockContainer"] .stMultiSelect {
+  pointer-events: none !important;
+  opacity: 0.3 !important;
+}
+</style>
+            """,
+        unsafe_allow_html=True,
+    )
+
+    status_container = st.empty()
+
+    status_messages = [
+        "正在解析论文...",
+        "正在识别章节结构...",
+        "正在处理章节筛选...",
+        "正在生成剧本内容...",
+        "马上就好啦！"
+    ]
+
+    def update_status(idx):
+        msg = status_messages[idx]
+        progress = (idx + 1) * 20
+        extra_hint = ""
+        if idx == 3:
+            extra_hint = '<div style="font-size:11px; color:#a79bff; margin-top:6px;">剧本生成时间较长，请耐心等待</div>'
+        status_container.markdown(
+            _PROCESSING_CARD_TMPL.format(msg=msg, progress=progress, extra_hint=extra_hint),
+            unsafe_allow_html=True
+        )
+
+    if not st.session_state.chunks:
+        update_status(0)
+        pdf_bytes: Optional[bytes] = st.session_state.get("_pdf_bytes")
+        pdf_path = Path(st.session_state.get("_tmp_pdf_path") or "")
+        if not pdf_bytes and not (st.session_state.get("_tmp_pdf_path") and pdf_path.is_file()):
+            st.error("PDF 内容丢失了，请回到封面重新上传。")
+            st.button("回到封面", on_click=_reset_session)
+            return
+
+        raw_chunks: List[PdfChunk] = list(st.session_state.get("raw_chunks") or [])
+        speculative_first: Optional[PdfChunk] = None
+        if not raw_chunks:
+            with st.spinner("解析 PDF…"):
+                try:
+                    for chunk in iter_chunks(
+                        pdf_bytes or pdf_path,
+                        use_mineru=bool(st.session_state.use_mineru),
+                        source_name=st.session_state.get("_pdf_name") or None,
+                    ):
+                        raw_chunks.append(chunk)
+                        # 能确定为首段的 chunk 一产出就开始生成它的剧本，与后续解析/章节识别重叠
+                        if speculative_first is None and _first_chunk_survives_filters(chunk, len(raw_chunks) - 1):
+                            speculative_first = chunk
+                            _start_first_chunk_generation(chunk)
+                except Exception as e:
+                    st.error(f"PDF 解析失败：{e}")
+                    st.button("回到封面", on_click=_reset_session)
                     return
 
-                st.session_state.raw_chunks = raw_chunks
-                st.session_state.parser_used = raw_chunks[0].parser if raw_chunks else "pypdf"
+            if not raw_chunks:
+                st.error("没有解析到任何文本。可能是扫描版 PDF，请启用 MinerU OCR。")
+                st.button("回到封面", on_click=_reset_session)
+                return
 
-                update_status(1)
-                wait_time = random.uniform(1,2)
-                time.sleep(wait_time)
-                section_mapping = _build_common_section_mapping(raw_chunks)
-                available_keys = [
-                    k for k in COMMON_SECTION_ORDER
-                    if any(v == k for v in section_mapping.values())
-                ]
-                available_labels = [COMMON_SECTION_LABELS[k] for k in available_keys]
-                st.session_state.available_sections = available_labels
-                st.session_state.section_label_to_key = {COMMON_SECTION_LABELS[k]: k for k in available_keys}
-                if st.session_state.get("selected_sections") is None:
-                    st.session_state.selected_sections = list(available_labels)
-
-                if (
-                    bool(st.session_state.get("enable_section_pick"))
-                    and st.session_state.parser_used == "mineru"
-                    and available_labels
-                    and not bool(st.session_state.get("section_filter_applied"))
-                ):
-                    st.session_state.state = "SECTION_PICKER"
-                    st.rerun()
-
-            update_status(2)
-            wait_time = random.uniform(5, 7)
+            st.session_state.raw_chunks = raw_chunks
+            # 解析结果已缓存在 raw_chunks 中，上传内容不再需要
+            st.session_state._pdf_bytes = None  # type: ignore[attr-defined]
+            st.session_state.parser_used = raw_chunks[0].parser if raw_chunks else "pypdf"
+
+            update_status(1)
+            wait_time = random.uniform(1,2)
             time.sleep(wait_time)
-            working_chunks: List[PdfChunk] = list(st.session_state.get("raw_chunks") or [])
+            section_mapping = _build_common_section_mapping(raw_chunks)
+            available_keys = [
+                k for k in COMMON_SECTION_ORDER
+                if any(v == k for v in section_mapping.values())
+            ]
+            available_labels = [COMMON_SECTION_LABELS[k] for k in available_keys]
+            st.session_state.available_sections = available_labels
+            st.session_state.section_label_to_key = {COMMON_SECTION_LABELS[k]: k for k in available_keys}
+            if st.session_state.get("selected_sections") is None:
+                st.session_state.selected_sections = list(available_labels)
+
             if (
                 bool(st.session_state.get("enable_section_pick"))
-                and st.session_state.get("parser_used") == "mineru"
+                and st.session_state.parser_used == "mineru"
+                and available_labels
+                and not bool(st.session_state.get("section_filter_applied"))
             ):
-                label_to_key = dict(st.session_state.get("section_label_to_key") or {})
-                if not label_to_key:
-                    st.warning("未识别到可勾选的标准章节，已跳过章节筛选。")
-                    st.session_state.section_filter_applied = True
+                _transition("SECTION_PICKER")
+
+        update_status(2)
+        wait_time = random.uniform(5, 7)
+        time.sleep(wait_time)
+        working_chunks: List[PdfChunk] = list(st.session_state.get("raw_chunks") or [])
+        if (
+            bool(st.session_state.get("enable_section_pick"))
+            and st.session_state.get("parser_used") == "mineru"
+        ):
+            label_to_key = dict(st.session_state.get("section_label_to_key") or {})
+            if not label_to_key:
+                st.warning("未识别到可勾选的标准章节，已跳过章节筛选。")
+                st.session_state.section_filter_applied = True
+            else:
+                chosen_labels = st.session_state.get("selected_sections")
+                chosen_keys = {
+                    label_to_key[label]
+                    for label in (chosen_labels or [])
+                    if label in label_to_key
+                }
+                section_mapping = _build_common_section_mapping(raw_chunks)
+                if chosen_keys:
+                    working_chunks = [
+                        c for i, c in enumerate(raw_chunks)
+                        if section_mapping.get(i) in chosen_keys
+                    ]
                 else:
-                    chosen_labels = st.session_state.get("selected_sections")
-                    chosen_keys = {
-                        label_to_key[label]
-                        for label in (chosen_labels or [])
-                        if label in label_to_key
-                    }
-                    section_mapping = _build_common_section_mapping(raw_chunks)
-                    if chosen_keys:
-                        working_chunks = [
-                            c for i, c in enumerate(raw_chunks)
-                            if section_mapping.get(i) in chosen_keys
-                        ]
-                    else:
-                        working_chunks = []
-
-            chunks = apply_reading_mode(
-                working_chunks,
-                reading_mode=str(st.session_state.get("reading_mode") or "detailed"),
-            )
+                    working_chunks = []
 
-            if not chunks:
-                st.error("当前筛选条件下没有可读内容。请放宽章节勾选或切换阅读模式。")
-                if st.button("返回上传页"):
-                    st.session_state.state = "SETUP"
-                    st.rerun()
-                return
+        chunks = apply_reading_mode(
+            working_chunks,
+            reading_mode=str(st.session_state.get("reading_mode") or "detailed"),
+        )
+
+        if not chunks:
+            st.error("当前筛选条件下没有可读内容。请放宽章节勾选或切换阅读模式。")
+            st.button("返回上传页", on_click=_go_to, args=("SETUP",))
+            return
 
-            st.session_state.chunks = chunks
-            st.session_state.chunk_idx = 0
-            merged_image_map: Dict[str, str] = {}
-            for _c in chunks:
-                merged_image_map.update(dict(getattr(_c, "image_map", ())))
-            st.session_state.paper_image_map = merged_image_map
+        st.session_state.chunks = chunks
+        # 阅读列表已确定，完整解析结果（raw_chunks）不再需要
+        st.session_state.raw_chunks = []
+        st.session_state.chunk_idx = 0
+        merged_image_map: Dict[str, str] = {}
+        for _c in chunks:
+            merged_image_map.update(dict(getattr(_c, "image_map", ())))
+        st.session_state.paper_image_map = merged_image_map
+        # 提前生成的第一个 chunk 仍是最终第一个时保留其任务，否则作废
+        if speculative_first is None or chunks[0] is not speculative_first:
             _clear_prefetch_buffer(bump_run_token=True)
 
-        update_status(3)
-        idx = int(st.session_state.chunk_idx)
-        idx = max(0, min(idx, len(st.session_state.chunks) - 1))
-        st.session_state.chunk_idx = idx
+    # 上一轮在本段剧本就绪后被打断（如处理中误触发重跑）时直接进入游戏，不再重复生成
+    if st.session_state.generator_ready:
+        _transition("GAME_LOOP")
 
-        with st.spinner(f"生成第 {idx + 1} 段剧本…"):
-            try:
-                prefetched = _take_prefetched_script(idx, wait_if_running=True)
-                if prefetched is not None:
-                    _apply_script_items(prefetched)
-                else:
-                    load_script_for_chunk(st.session_state.chunks, idx)
-            except Exception as e:
-                st.error(str(e))
-                st.info("请检查 .env 中的 API Key 配置。")
-                if st.button("回到封面"):
-                    _reset_session()
-                    st.rerun()
-                return
+    update_status(3)
+    idx = int(st.session_state.chunk_idx)
+    idx = max(0, min(idx, len(st.session_state.chunks) - 1))
+    st.session_state.chunk_idx = idx
+
+    with st.spinner(f"生成第 {idx + 1} 段剧本…"):
+        try:
+            prefetched = _take_prefetched_script(idx, wait_if_running=True)
+            if prefetched is not None:
+                _apply_script_items(prefetched)
+            else:
+                load_script_for_chunk(st.session_state.chunks, idx)
+        except Exception as e:
+            st.error(str(e))
+            st.info("请检查 .env 中的 API Key 配置。")
+            st.button("回到封面", on_click=_reset_session)
+            return
+
+    _ensure_prefetch_window(st.session_state.chunks, idx)
 
-        _ensure_next_chunk_prefetch(st.session_state.chunks, idx)
+    update_status(4)
+    time.sleep(1)
 
-        update_status(4)
-        time.sleep(1)
+    _transition("GAME_LOOP")
 
-        st.session_state.state = "GAME_LOOP"
-        st.rerun()
 
-    # ════════════════════════════
-    # STATE: GAME_LOOP
-    # ════════════════════════════
-    elif st.session_state.state == "GAME_LOOP":
-        if not st.session_state.generator_ready:
-            st.session_state.state = "PROCESSING"
-            st.rerun()
+# ════════════════════════════
+# STATE: GAME_LOOP
+# ════════════════════════════
+def render_game_loop() -> None:
+    """游戏主循环：渲染当前条目与交互按钮，并维持预生成窗口。"""
+    if not st.session_state.generator_ready:
+        _transition("PROCESSING")
 
-        _collect_prefetch_if_ready()
-        if st.session_state.chunks:
-            _ensure_next_chunk_prefetch(st.session_state.chunks, int(st.session_state.chunk_idx))
+    _collect_prefetch_if_ready()
+    if st.session_state.chunks:
+        _ensure_prefetch_window(st.session_state.chunks, int(st.session_state.chunk_idx))
+
+    item = get_current_item()
+    render_game_screen(item)
+    render_interaction(item)
+
+
+# 每个状态对应一个渲染函数；一次 rerun 只会渲染一个状态
+STATE_HANDLERS: Dict[str, Callable[[], None]] = {
+    "LANDING": render_landing_page,
+    "GUIDE": render_guide_page,
+    "SETUP": render_setup_page,
+    "SECTION_PICKER": render_section_picker_page,
+    "PROCESSING": render_processing_page,
+    "GAME_LOOP": render_game_loop,
+}
+
+
+def main() -> None:
+    st.set_page_config(
+        page_title="Paper2Galgame",
+        page_icon="📖",
+        layout="wide",
+        initial_sidebar_state="collapsed",
+    )
+    init_state()
+    # 强制同步一次，确保无论在哪个页面，selected_character 永远等于 persistent_char
+    if "persistent_char" in st.session_state:
+        st.session_state.selected_character = st.session_state.persistent_char
+    # 确保角色选择始终存在，并验证其值在CHARACTERS中有效
+    elif "selected_character" not in st.session_state:
+        st.session_state.selected_character = DEFAULT_CHARACTER
+    elif st.session_state.selected_character not in CHARACTERS:
+        st.session_state.selected_character = DEFAULT_CHARACTER
 
-        item = get_current_item()
-        render_game_screen(item)
-        render_interaction(item)
+    handler = STATE_HANDLERS.get(st.session_state.state) or render_landing_page
+    handler()
 
 
 if __name__ == "__main__":
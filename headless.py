@@ -1,14 +1,25 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
 import json
+import os
+import queue
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional
 
-from utils.pdf_loader import load_and_chunk_pdf
 from utils.reading_mode import ReadingMode, apply_reading_mode
-from utils.script_engine import ScriptGenerator
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖：装了时导出序列化更快，输出与标准库一致
+    orjson = None  # type: ignore
+
+if TYPE_CHECKING:
+    from utils.script_engine import ScriptGenerator
 
 
 ROOT_DIR = Path(__file__).resolve().parent
@@ -19,6 +30,9 @@ DEFAULT_PAPER_NAME = "ReAct"
 DEFAULT_CHARACTER = "nana"
 DEFAULT_CHARACTER_NAME = "奈奈"
 
+# 全自动模式未指定 --concurrency 时同时生成的段数：无需等人阅读，开场即并发生成
+DEFAULT_AUTO_CONCURRENCY = 4
+
 
 def _print_divider(title: str = "") -> None:
     line = "=" * 72
@@ -64,6 +78,8 @@ def _render_item(item: Dict[str, Any]) -> None:
 def _choose_option_interactive(options: List[str]) -> int:
     for i, opt in enumerate(options, start=1):
         print(f"  {i}. {opt}")
+    # 关键字匹配用的小写选项文本，只在进入输入循环前计算一次
+    norm_options = [str(opt).lower() for opt in options]
     while True:
         raw = input("请输入选项编号/字母(A/B/C...)/关键字：").strip()
 
@@ -88,13 +104,13 @@ def _choose_option_interactive(options: List[str]) -> int:
                 if 0 <= idx < len(options):
                     return idx
 
-        # 4) 关键字匹配：允许直接输入/粘贴选项文本的一部分（例如“交替”）
+        # 4) 关键字匹配：允许直接输入/粘贴选项文本的一部分（例如“交替”），不区分大小写
         # 规则：
         # - 若匹配到唯一选项，直接返回
         # - 若匹配到多个，列出候选项并让用户缩小关键字或用编号选择
-        kw = raw.strip()
+        kw = raw.strip().lower()
         if len(kw) >= 2:
-            matches = [i for i, opt in enumerate(options) if kw in str(opt)]
+            matches = [i for i, opt in enumerate(norm_options) if kw in opt]
             if len(matches) == 1:
                 return matches[0]
             if len(matches) > 1:
@@ -119,7 +135,7 @@ def _choose_option_auto(item: Dict[str, Any], options: List[str], strategy: str)
 
 
 def _play_script_items(
-    script_items: List[Dict[str, Any]],
+    script_items: Iterable[Dict[str, Any]],
     *,
     interactive: bool,
     auto_strategy: str,
@@ -156,6 +172,155 @@ def _play_script_items(
             input("回车继续下一句…")
 
 
+def _start_bulk_generation(
+    gen: ScriptGenerator,
+    chunks: List[Any],
+    *,
+    character_name: str,
+    concurrency: int,
+    on_script: Optional[Callable[[int, List[Dict[str, Any]]], None]] = None,
+) -> Callable[[int], List[Dict[str, Any]]]:
+    """
+    在后台线程里并发生成全部 chunk 的剧本（asyncio + 信号量限流），
+    返回 wait(chunk_index) -> 剧本：按阅读顺序取结果，先完成的段无需等待后面的段。
+    on_script 在每段生成完成时（后台线程中）被调用，用于写入缓存。
+    """
+    results: Dict[int, List[Dict[str, Any]]] = {}
+    errors: List[BaseException] = []
+    cond = threading.Condition()
+
+    def _on_result(idx: int, script: List[Dict[str, Any]]) -> None:
+        if on_script is not None:
+            on_script(idx, script)
+        with cond:
+            results[idx] = script
+            cond.notify_all()
+
+    def _run() -> None:
+        entries = [
+            {
+                "chunk_text": c.text,
+                "chunk_index": c.index,
+                "section_title": getattr(c, "section_title", "") or None,
+                "image_map": dict(getattr(c, "image_map", ())) or None,
+            }
+            for c in chunks
+        ]
+        try:
+            asyncio.run(
+                gen.agenerate_scripts(
+                    entries,
+                    character_name=character_name,
+                    concurrency=concurrency,
+                    on_result=_on_result,
+                )
+            )
+        except BaseException as e:  # 交给主线程抛出
+            with cond:
+                errors.append(e)
+                cond.notify_all()
+
+    threading.Thread(target=_run, name="p2g-bulk-generate", daemon=True).start()
+
+    def wait(idx: int) -> List[Dict[str, Any]]:
+        with cond:
+            cond.wait_for(lambda: idx in results or bool(errors))
+            if idx in results:
+                return results[idx]
+            raise errors[0]
+
+    return wait
+
+
+def _json_indent2(obj: Any) -> str:
+    """与 json.dumps(obj, ensure_ascii=False, indent=2) 输出一致；有 orjson 时用 C 实现序列化。"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, indent=2)
+
+
+class _ScriptMemo:
+    """
+    无头模式的剧本缓存：先查磁盘缓存（与 app.py 共用 output/script_cache/，精确匹配），
+    再查语义缓存（近似段落，需 P2G_SEMANTIC_CACHE=1 且安装 fastembed）；命中则不调用 LLM。
+    兜底脚本（LLM 失败）不写入缓存。
+    """
+
+    def __init__(self, gen: ScriptGenerator, *, character_name: str) -> None:
+        from utils.script_cache import ScriptCache, cache_enabled
+        from utils.semantic_cache import SemanticScriptCache, semantic_cache_enabled
+
+        self.gen = gen
+        self.character_name = character_name
+        self.disk = ScriptCache() if cache_enabled() else None
+        self.semantic = SemanticScriptCache() if semantic_cache_enabled() else None
+
+    def _key(self, chunk: Any) -> str:
+        from utils.script_cache import script_cache_key
+        from utils.script_engine import PROMPT_FINGERPRINT
+
+        return script_cache_key(
+            chunk_text=chunk.text,
+            section_title=getattr(chunk, "section_title", "") or None,
+            character_name=self.character_name,
+            image_map=dict(getattr(chunk, "image_map", ())) or None,
+            model=self.gen.model,
+            temperature=self.gen.temperature,
+            prompt_fingerprint=PROMPT_FINGERPRINT,
+        )
+
+    def _scope(self, chunk: Any) -> Any:
+        return (self.character_name, self.gen.model, self.gen.temperature, tuple(sorted(getattr(chunk, "image_map", ()))))
+
+    def get(self, chunk: Any) -> Optional[List[Dict[str, Any]]]:
+        script = self.disk.get(self._key(chunk)) if self.disk is not None else None
+        if script is None and self.semantic is not None:
+            script = self.semantic.get(chunk.text, scope=self._scope(chunk))
+        return script
+
+    def put(self, chunk: Any, script: List[Dict[str, Any]]) -> None:
+        from utils.script_engine import is_fallback_script
+
+        if is_fallback_script(script):
+            return
+        if self.disk is not None:
+            self.disk.set(self._key(chunk), script)
+        if self.semantic is not None:
+            self.semantic.add(chunk.text, script, scope=self._scope(chunk))
+
+
+class _ScriptExporter:
+    """
+    边播放边把每段剧本写入导出文件，不在内存里攒下全部剧本。
+    输出与一次性 json.dumps(payload, indent=2) 逐字节一致；先写临时文件，正常结束才替换目标文件。
+    """
+
+    def __init__(self, path: Path, header: Dict[str, Any]) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._tmp_path = path.with_name(path.name + ".tmp")
+        self._fp = self._tmp_path.open("w", encoding="utf-8")
+        self._count = 0
+        head = _json_indent2({**header, "items": []})
+        # 去掉结尾的 `[]\n}`，items 数组随后逐条写入
+        self._fp.write(head[: -len("[]\n}")] + "[")
+
+    def add(self, record: Dict[str, Any]) -> None:
+        # JSON 字符串里的换行都已转义，按行缩进不会改动内容
+        body = _json_indent2(record).replace("\n", "\n    ")
+        self._fp.write(("," if self._count else "") + "\n    " + body)
+        self._count += 1
+
+    def commit(self) -> None:
+        self._fp.write("\n  ]\n}" if self._count else "]\n}")
+        self._fp.close()
+        os.replace(self._tmp_path, self.path)
+
+    def discard(self) -> None:
+        self._fp.close()
+        self._tmp_path.unlink(missing_ok=True)
+
+
 def run_headless(
     *,
     pdf_path: Path,
@@ -168,15 +333,27 @@ def run_headless(
     use_mineru: bool,
     reading_mode: ReadingMode,
     character_name: str = DEFAULT_CHARACTER_NAME,
+    concurrency: int = 1,
+    use_cache: bool = True,
+    use_script_cache: bool = True,
 ) -> None:
     if not pdf_path.exists():
         raise FileNotFoundError(f"PDF 不存在：{pdf_path}")
 
+    # 重量级依赖（langchain / pypdf / openai）在真正运行时才导入，--help 与参数错误可以立即返回
+    from utils.pdf_loader import load_and_chunk_pdf
+    from utils.script_engine import ScriptGenerator
+
+    gen = ScriptGenerator()
+    # 解析 PDF 的同时预先建立到 LLM 服务的连接
+    threading.Thread(target=gen.warm_up, name="p2g-llm-warm-up", daemon=True).start()
+
     chunks = load_and_chunk_pdf(
         pdf_path,
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
         use_mineru=use_mineru,
+        use_cache=use_cache,
     )
     if not chunks:
         raise RuntimeError("没有解析到任何文本（可能是扫描版图片 PDF）。可尝试配置 MINERU_API_TOKEN 并使用 --use-mineru。")
@@ -187,10 +364,6 @@ def run_headless(
     input_chunk_count = len(chunks)
     chunks = apply_reading_mode(chunks, reading_mode=reading_mode)
 
-    gen = ScriptGenerator()
-
-    export: List[Dict[str, Any]] = []
-
     _print_divider("Paper2Galgame 无头模式（终端）")
     parser_used = getattr(chunks[0], "parser", "pypdf") if chunks else "pypdf"
     print(f"PDF：{pdf_path}")
@@ -199,41 +372,139 @@ def run_headless(
     print(f"chunks：{len(chunks)}（chunk_size={chunk_size}, overlap={chunk_overlap}）")
     print(f"交互：{'是' if interactive else '否'}（auto_strategy={auto_strategy}）")
     print(f"角色：{character_name}")
-
-    for chunk in chunks:
-        section_label = f" {chunk.section_title}" if getattr(chunk, "section_title", "") else ""
-        _print_divider(f"Chunk #{chunk.index}{section_label}")
-        image_map = dict(getattr(chunk, "image_map", ())) or None
-        script_items = gen.generate_script(
-            chunk.text,
-            chunk_index=chunk.index,
-            section_title=getattr(chunk, "section_title", "") or None,
-            character_name=character_name,
-            image_map=image_map,
+    print(f"并发生成：{concurrency}")
+
+    memo = _ScriptMemo(gen, character_name=character_name) if use_script_cache else None
+
+    def _generate(chunk: Any) -> List[Dict[str, Any]]:
+        script = memo.get(chunk) if memo is not None else None
+        if script is None:
+            script = gen.generate_script(
+                chunk.text,
+                chunk_index=chunk.index,
+                section_title=getattr(chunk, "section_title", "") or None,
+                character_name=character_name,
+                image_map=dict(getattr(chunk, "image_map", ())) or None,
+            )
+            if memo is not None:
+                memo.put(chunk, script)
+        return script
+
+    def _generate_live(chunk: Any, out: "queue.Queue[Optional[Dict[str, Any]]]") -> List[Dict[str, Any]]:
+        # 流式生成：每条剧本一出来就放进 out 供主线程播放，结束时放入 None
+        script: List[Dict[str, Any]] = []
+        cached: Optional[List[Dict[str, Any]]] = None
+        try:
+            cached = memo.get(chunk) if memo is not None else None
+            items = cached if cached is not None else gen.stream_script(
+                chunk.text,
+                chunk_index=chunk.index,
+                section_title=getattr(chunk, "section_title", "") or None,
+                character_name=character_name,
+                image_map=dict(getattr(chunk, "image_map", ())) or None,
+            )
+            for item in items:
+                script.append(item)
+                out.put(item)
+        finally:
+            out.put(None)
+        if cached is None and memo is not None:
+            memo.put(chunk, script)
+        return script
+
+    def _drain(out: "queue.Queue[Optional[Dict[str, Any]]]") -> Iterator[Dict[str, Any]]:
+        while True:
+            item = out.get()
+            if item is None:
+                return
+            yield item
+
+    wait_script: Optional[Callable[[int], List[Dict[str, Any]]]] = None
+    if concurrency > 1 and chunks:
+        # 缓存命中的段直接取用，只把未命中的段交给并发生成
+        cached: Dict[int, List[Dict[str, Any]]] = {}
+        if memo is not None:
+            for c in chunks:
+                hit = memo.get(c)
+                if hit is not None:
+                    cached[c.index] = hit
+        pending = [c for c in chunks if c.index not in cached]
+        by_index = {c.index: c for c in pending}
+        wait_bulk = (
+            _start_bulk_generation(
+                gen,
+                pending,
+                character_name=character_name,
+                concurrency=concurrency,
+                on_script=(lambda idx, script: memo.put(by_index[idx], script)) if memo is not None else None,
+            )
+            if pending
+            else None
         )
 
-        export.append(
+        def _wait_cached_or_bulk(idx: int) -> List[Dict[str, Any]]:
+            if idx in cached:
+                return cached[idx]
+            assert wait_bulk is not None
+            return wait_bulk(idx)
+
+        wait_script = _wait_cached_or_bulk
+
+    exporter: Optional[_ScriptExporter] = None
+    if export_path:
+        exporter = _ScriptExporter(
+            export_path,
             {
-                "chunk_index": chunk.index,
-                "source": chunk.source,
-                "script": script_items,
-            }
+                "reading_mode": reading_mode,
+                "input_chunk_count": input_chunk_count,
+                "output_chunk_count": len(chunks),
+            },
         )
 
-        _play_script_items(script_items, interactive=interactive, auto_strategy=auto_strategy)
+    # 逐段模式：播放当前段时后台生成下一段（单个工作线程，同时最多一个 LLM 请求）
+    prefetch = ThreadPoolExecutor(max_workers=1, thread_name_prefix="p2g-prefetch")
+    next_future: Optional[Future] = None
+    try:
+        for i, chunk in enumerate(chunks):
+            section_label = f" {chunk.section_title}" if getattr(chunk, "section_title", "") else ""
+            _print_divider(f"Chunk #{chunk.index}{section_label}")
+            if wait_script is not None:
+                script_items = wait_script(chunk.index)
+                _play_script_items(script_items, interactive=interactive, auto_strategy=auto_strategy)
+            elif next_future is not None:
+                future = next_future
+                next_future = prefetch.submit(_generate, chunks[i + 1]) if i + 1 < len(chunks) else None
+                script_items = future.result()
+                _play_script_items(script_items, interactive=interactive, auto_strategy=auto_strategy)
+            else:
+                # 没有预生成结果可等（首段）：流式生成，边生成边播放；下一段排在其后预生成
+                live: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+                future = prefetch.submit(_generate_live, chunk, live)
+                next_future = prefetch.submit(_generate, chunks[i + 1]) if i + 1 < len(chunks) else None
+                _play_script_items(_drain(live), interactive=interactive, auto_strategy=auto_strategy)
+                script_items = future.result()
+
+            if exporter is not None:
+                exporter.add(
+                    {
+                        "chunk_index": chunk.index,
+                        "source": chunk.source,
+                        "script": script_items,
+                    }
+                )
+    except BaseException:
+        if exporter is not None:
+            exporter.discard()
+        raise
+    finally:
+        # 中途退出（如 Ctrl+C）时不等待排队中的预生成
+        prefetch.shutdown(wait=False, cancel_futures=True)
 
     _print_divider("结束")
     print("读完啦喵。")
 
-    if export_path:
-        payload: Dict[str, Any] = {
-            "reading_mode": reading_mode,
-            "input_chunk_count": input_chunk_count,
-            "output_chunk_count": len(chunks),
-            "items": export,
-        }
-        export_path.parent.mkdir(parents=True, exist_ok=True)
-        export_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    if exporter is not None:
+        exporter.commit()
         print(f"已导出脚本：{export_path}")
 
 
@@ -277,6 +548,22 @@ def build_parser() -> argparse.ArgumentParser:
         help="自动模式的选择策略：first/correct/last",
     )
     p.add_argument("--export", default=None, help="导出所有 chunk 的脚本到 JSON 文件路径")
+    p.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help=(
+            "同时生成多少个 chunk 的剧本（>1 时开场即并发预生成全部 chunk；1=逐段生成，播放当前段时预生成下一段）。"
+            f"默认：auto 模式 {DEFAULT_AUTO_CONCURRENCY}，interactive 模式 1"
+        ),
+    )
+    p.add_argument("--no-cache", action="store_true", help="不读写 PDF 解析缓存（output/chunk_cache/），强制重新解析")
+    p.add_argument(
+        "--script-cache",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="复用已生成的剧本（output/script_cache/，与网页版共用；--no-script-cache 强制重新调用 LLM）",
+    )
     return p
 
 
@@ -303,6 +590,12 @@ def main(argv: Optional[List[str]] = None) -> int:
         mode = "auto"
     interactive = mode == "interactive"
 
+    # 交互模式逐段阅读，预生成下一段即可；全自动模式默认并发生成
+    if args.concurrency is not None:
+        concurrency = max(1, int(args.concurrency))
+    else:
+        concurrency = 1 if interactive else DEFAULT_AUTO_CONCURRENCY
+
     try:
         run_headless(
             pdf_path=pdf_path,
@@ -315,6 +608,9 @@ def main(argv: Optional[List[str]] = None) -> int:
             use_mineru=False if bool(args.no_mineru) else True,
             reading_mode=str(args.reading_mode),
             character_name=str(args.character) if args.character else DEFAULT_CHARACTER_NAME,
+            concurrency=concurrency,
+            use_cache=not bool(args.no_cache),
+            use_script_cache=bool(args.script_cache),
         )
         return 0
     except Exception as e:
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+import utils.pdf_loader as pdf_loader
+from utils.pdf_loader import load_and_chunk_pdf
+
+DEMO_PDF = Path(__file__).resolve().parents[1] / "papers" / "ReAct.pdf"
+
+
+@pytest.fixture
+def chunk_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("P2G_CHUNK_CACHE_DIR", str(tmp_path))
+    monkeypatch.delenv("P2G_CHUNK_CACHE", raising=False)
+    return tmp_path
+
+
+def test_second_parse_is_served_from_cache(chunk_cache_dir, monkeypatch) -> None:
+    data = DEMO_PDF.read_bytes()
+    first = load_and_chunk_pdf(data, use_mineru=False, source_name="ReAct.pdf")
+    assert first
+    assert list(chunk_cache_dir.rglob("*.json"))
+
+    def _no_parse(*args, **kwargs):
+        raise AssertionError("cache hit expected")
+
+    monkeypatch.setattr(pdf_loader, "_iter_chunks_uncached", _no_parse)
+    assert load_and_chunk_pdf(data, use_mineru=False, source_name="ReAct.pdf") == first
+
+
+def test_parameters_and_opt_out_bypass_cache(chunk_cache_dir) -> None:
+    data = DEMO_PDF.read_bytes()
+    load_and_chunk_pdf(data, use_mineru=False, source_name="ReAct.pdf")
+    assert load_and_chunk_pdf(data, use_mineru=False, source_name="ReAct.pdf", chunk_size=700)
+    assert len(list(chunk_cache_dir.rglob("*.json"))) == 2
+
+    load_and_chunk_pdf(data, use_mineru=False, source_name="ReAct.pdf", chunk_size=500, use_cache=False)
+    assert len(list(chunk_cache_dir.rglob("*.json"))) == 2
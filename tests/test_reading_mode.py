@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 
-from utils.reading_mode import apply_reading_mode
+from utils.reading_mode import apply_reading_mode, is_fast_section_title
 
 
 @dataclass
@@ -68,6 +68,14 @@ def test_mineru_fast_does_not_include_introduction_even_if_text_mentions_method(
     assert "Abstract" in titles
 
 
+def test_mineru_fast_starts_with_first_fast_title() -> None:
+    chunks = _mk_mineru_chunks(["Cover", "1 Introduction", "2 Method", "Abstract", "4 Experiments"])
+    first = next(c for c in chunks if is_fast_section_title(c.section_title))
+    out = apply_reading_mode(chunks, "fast")
+    assert out[0] is first
+    assert not is_fast_section_title("1 Introduction")
+
+
 def test_mineru_standard_keeps_full_content() -> None:
     titles = [
         "Cover",
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import os
+import time
+
+from utils.script_cache import ScriptCache, script_cache_key
+
+
+def _key(**overrides) -> str:
+    kwargs = dict(
+        chunk_text="some chunk",
+        section_title="Abstract",
+        character_name="奈奈",
+        image_map={"Figure 1": "a.png"},
+        model="deepseek-chat",
+        temperature=0.7,
+    )
+    kwargs.update(overrides)
+    return script_cache_key(**kwargs)
+
+
+def test_key_depends_on_every_generation_input() -> None:
+    base = _key()
+    assert _key() == base
+    assert _key(chunk_text="other") != base
+    assert _key(section_title="Method") != base
+    assert _key(character_name="贝儿") != base
+    assert _key(image_map=None) != base
+    assert _key(model="gpt-4o") != base
+    assert _key(temperature=0.0) != base
+    assert _key(prompt_fingerprint="edited") != base
+
+
+def test_roundtrip_and_miss(tmp_path) -> None:
+    cache = ScriptCache(tmp_path)
+    script = [{"type": "dialogue", "speaker": "奈奈", "text": "喵", "emotion": "char_normal"}]
+    assert cache.get(_key()) is None
+    cache.set(_key(), script)
+    assert cache.get(_key()) == script
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_expired_and_corrupt_entries_are_misses(tmp_path) -> None:
+    cache = ScriptCache(tmp_path, ttl_seconds=60)
+    key = _key()
+    cache.set(key, [{"type": "sub_head", "title": "1"}])
+    path = next(tmp_path.rglob("*.json"))
+    old = time.time() - 120
+    os.utime(path, (old, old))
+    assert cache.get(key) is None
+
+    path.write_text("{not json", encoding="utf-8")
+    os.utime(path, None)
+    assert cache.get(key) is None
+
+
+def test_key_changes_when_any_prompt_template_changes() -> None:
+    from utils import script_engine
+
+    assert script_engine._prompt_fingerprint(*script_engine._PROMPT_TEMPLATES) == script_engine.PROMPT_FINGERPRINT
+    base = _key(prompt_fingerprint=script_engine.PROMPT_FINGERPRINT)
+    for edited in (script_engine.USER_PROMPT_TEMPLATE, script_engine.BATCH_PROMPT_TEMPLATE):
+        templates = list(script_engine._PROMPT_TEMPLATES)
+        templates[templates.index(edited)] = edited + "\n请认真读。"
+        assert _key(prompt_fingerprint=script_engine._prompt_fingerprint(*templates)) != base
@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import pytest
+
+from utils.script_engine import ScriptGenerator, _JsonArrayItemScanner, _split_chunk
+
+ITEMS = [
+    {"type": "sub_head", "title": "1 概述 [x] {y}"},
+    {"type": "dialogue", "speaker": "奈奈", "text": "如图1所示，\"引号\" 和 } ] 都在字符串里喵", "emotion": "char_happy"},
+    {"type": "quiz", "question": "q", "options": ["A. 交替", "(B) 只推理"], "correct_answer": "B", "explanation": "e"},
+]
+
+
+@pytest.fixture
+def gen(monkeypatch) -> ScriptGenerator:
+    # 只测解析逻辑：构造客户端不会发起任何请求
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    return ScriptGenerator()
+
+
+def test_scanner_yields_items_as_they_close() -> None:
+    text = "```json\n" + json.dumps(ITEMS, ensure_ascii=False, indent=2) + "\n```"
+    scanner = _JsonArrayItemScanner()
+    seen = []
+    for i in range(0, len(text), 5):
+        seen.extend(scanner.feed(text[i : i + 5]))
+    assert seen == ITEMS
+
+
+def test_parse_json_list_salvages_truncated_reply(gen) -> None:
+    full = json.dumps(ITEMS, ensure_ascii=False)
+    truncated = full[: full.rindex('{"type": "quiz"') + 20]
+    assert gen._parse_json_list(truncated) == ITEMS[:2]
+
+
+def test_parse_json_list_skips_only_the_broken_item(gen, monkeypatch) -> None:
+    import utils.script_engine as script_engine
+
+    monkeypatch.setattr(script_engine, "json_repair", None)
+    raw = '[{"type": "sub_head", "title": "a"}, {"type": "dialogue", "text": oops}, {"type": "sub_head", "title": "b"}]'
+    assert gen._parse_json_list(raw) == [{"type": "sub_head", "title": "a"}, {"type": "sub_head", "title": "b"}]
+
+    with pytest.raises(ValueError):
+        gen._parse_json_list("抱歉，这段我没法改编。")
+
+
+def test_normalize_strips_option_labels(gen) -> None:
+    script = gen._normalize_script(ITEMS)
+    quiz = script[2]
+    assert quiz["options"] == ["交替", "只推理"]
+    assert quiz["correct_answer"] == "只推理"
+
+
+def test_generators_share_client_per_config(gen) -> None:
+    assert ScriptGenerator().llm is gen.llm
+    other = ScriptGenerator(temperature=0.2)
+    assert other.llm is not gen.llm
+    assert other.llm.root_client._client is gen.llm.root_client._client
+
+
+def test_long_chunk_is_split_and_joined(gen) -> None:
+    text = "\n\n".join(["intro " * 800, "## 3.2 Training", "loss " * 800, "eval " * 800])
+    parts = _split_chunk(text, 1500)
+    assert [p.split()[0] for p in parts] == ["intro", "##", "eval"]
+    assert _split_chunk("short", 1500) == ["short"]
+
+    def _script(text: str) -> list:
+        return [
+            {"type": "sub_head", "title": "3 Method"},
+            {"type": "dialogue", "speaker": "奈奈", "text": text, "emotion": "char_normal"},
+        ]
+
+    joined = gen._join_parts(parts, [_script("a"), _script("b"), _script("c")], section_title="3 Method")
+    assert [it.get("title") or it.get("text") for it in joined] == ["3 Method", "a", "3.2 Training", "b", "c"]
+
+
+def test_parse_json_list_accepts_json_mode_wrapper(gen) -> None:
+    assert gen._parse_json_list(json.dumps({"items": ITEMS}, ensure_ascii=False)) == ITEMS
+
+
+def test_identical_chunks_are_generated_once(gen, monkeypatch) -> None:
+    calls = []
+
+    async def _fake(chunk_text, *, chunk_index, **kwargs):
+        calls.append(chunk_index)
+        return [{"type": "dialogue", "speaker": "奈奈", "text": chunk_text, "emotion": "char_normal"}]
+
+    monkeypatch.setattr(gen, "agenerate_script", _fake)
+    chunks = [
+        {"chunk_index": 0, "chunk_text": "same"},
+        {"chunk_index": 1, "chunk_text": "other"},
+        {"chunk_index": 2, "chunk_text": "same "},
+        {"chunk_index": 3, "chunk_text": "same", "section_title": "Method"},
+    ]
+    seen = []
+    results = asyncio.run(gen.agenerate_scripts(chunks, on_result=lambda idx, _: seen.append(idx)))
+    assert sorted(calls) == [0, 1, 3]
+    assert sorted(seen) == [0, 1, 2, 3]
+    assert results[2] == results[0] and results[2] is not results[0]
+
+
+def test_json_mode_rejection_falls_back_per_call(monkeypatch) -> None:
+    import httpx
+    import openai
+    from langchain_core.messages import AIMessage
+
+    import utils.script_engine as script_engine
+
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    gen = ScriptGenerator(structured_output=True)
+
+    def _bad_request(message: str) -> openai.BadRequestError:
+        response = httpx.Response(400, request=httpx.Request("POST", "http://test/chat/completions"))
+        return openai.BadRequestError(message, response=response, body=None)
+
+    class _Rejecting:
+        def __init__(self, message: str) -> None:
+            self.message = message
+
+        def invoke(self, messages):
+            raise _bad_request(self.message)
+
+    class _Plain:
+        def invoke(self, messages):
+            assert '"items"' not in messages[-1].content
+            return AIMessage(content=json.dumps(ITEMS[:2], ensure_ascii=False))
+
+    monkeypatch.setattr(script_engine, "_chat_model", lambda **kwargs: _Plain())
+
+    gen.llm = _Rejecting("response_format json_object is not supported by this model")
+    assert gen.generate_script("text", chunk_index=0) == ITEMS[:2]
+    assert gen.structured_output is True
+
+    gen.llm = _Rejecting("This model's maximum context length is 65536 tokens")
+    assert script_engine.is_fallback_script(gen.generate_script("text", chunk_index=0))
+    assert gen.structured_output is True
+
+
+def test_batch_keeps_completed_sections_of_truncated_reply(gen, monkeypatch) -> None:
+    from langchain_core.messages import AIMessage
+
+    import utils.script_engine as script_engine
+
+    full = json.dumps({"0": ITEMS[:2], "1": ITEMS[2:]}, ensure_ascii=False)
+    truncated = full[: full.index('"1"') + 30]
+    assert gen._parse_json_dict(truncated) == {"0": ITEMS[:2]}
+
+    seen = {}
+
+    class _Llm:
+        def invoke(self, messages, **kwargs):
+            seen.update(kwargs)
+            return AIMessage(content=truncated)
+
+    monkeypatch.setattr(gen, "llm", _Llm())
+    monkeypatch.setattr(gen, "generate_script", lambda text, *, chunk_index, **kw: [{"type": "sub_head", "title": text}])
+    chunks = [{"chunk_index": 0, "chunk_text": "a"}, {"chunk_index": 1, "chunk_text": "b"}]
+    results = gen.generate_scripts_batch(chunks)
+    assert seen["max_tokens"] == min(2 * gen.max_tokens, script_engine.BATCH_MAX_OUTPUT_TOKENS)
+    assert results[0][0]["type"] == "sub_head" and results[0][0]["title"] == ITEMS[0]["title"]
+    assert results[1] == [{"type": "sub_head", "title": "b"}]
+
+
+def test_batch_fallback_regenerates_missing_chunks_concurrently(gen, monkeypatch) -> None:
+    import threading
+
+    class _Failing:
+        def invoke(self, messages, **kwargs):
+            raise RuntimeError("batch failed")
+
+    barrier = threading.Barrier(3, timeout=5)
+
+    def _generate(text, *, chunk_index, **kwargs):
+        barrier.wait()  # 三段都在途时才会一起放行，串行执行会超时
+        return [{"type": "sub_head", "title": text}]
+
+    monkeypatch.setattr(gen, "llm", _Failing())
+    monkeypatch.setattr(gen, "generate_script", _generate)
+    chunks = [{"chunk_index": i, "chunk_text": t} for i, t in enumerate("abc")]
+    results = gen.generate_scripts_batch(chunks)
+    assert [results[i][0]["title"] for i in range(3)] == ["a", "b", "c"]
+
+
+def test_truncated_stream_is_marked_as_fallback(gen, monkeypatch) -> None:
+    from langchain_core.messages import AIMessageChunk
+
+    from utils.script_engine import is_fallback_script
+
+    full = json.dumps(ITEMS, ensure_ascii=False)
+
+    class _Llm:
+        def __init__(self, text):
+            self.text = text
+
+        def stream(self, messages):
+            for i in range(0, len(self.text), 7):
+                yield AIMessageChunk(content=self.text[i : i + 7])
+
+    monkeypatch.setattr(gen, "llm", _Llm(full))
+    assert not is_fallback_script(list(gen.stream_script("正文", chunk_index=0)))
+
+    # 截断在第二条之后：已播出的两条保留，末尾补一条兜底说明，缓存层据此跳过
+    monkeypatch.setattr(gen, "llm", _Llm(full[: full.index('{"type": "quiz"')]))
+    script = list(gen.stream_script("正文", chunk_index=0))
+    assert [it["type"] for it in script[:2]] == ["sub_head", "dialogue"]
+    assert len(script) == 3 and is_fallback_script(script)
+
+
+def test_split_parts_are_prompted_as_parts(gen, monkeypatch) -> None:
+    assert "本节全文" in gen._build_user_prompt(chunk_text="x", chunk_index=0)
+    prompt = gen._build_user_prompt(chunk_text="x", chunk_index=0, part=(2, 3))
+    assert "本节第 2/3 部分" in prompt and "本节全文" not in prompt
+
+    seen = []
+
+    def _one(text, *, part=None, **kwargs):
+        seen.append(part)
+        return [{"type": "dialogue", "speaker": "奈奈", "text": text, "emotion": "char_normal"}]
+
+    monkeypatch.setattr(gen, "_generate_one", _one)
+    gen.generate_script("\n\n".join(["intro " * 800, "loss " * 800, "eval " * 800]), chunk_index=0)
+    assert sorted(seen) == [(1, 3), (2, 3), (3, 3)]
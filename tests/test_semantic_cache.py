@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+from utils.semantic_cache import SemanticScriptCache
+
+_VOCAB = ["author", "university", "reasoning", "acting", "table", "results"]
+
+
+def _bag_of_words(text: str) -> list:
+    words = text.lower().split()
+    return [float(words.count(w)) for w in _VOCAB]
+
+
+def test_reuses_script_for_near_duplicate_within_scope() -> None:
+    cache = SemanticScriptCache(threshold=0.9, embed_fn=_bag_of_words)
+    script = [{"type": "dialogue", "speaker": "奈奈", "text": "hi", "emotion": "char_normal"}]
+    cache.add("author university author", script, scope="奈奈")
+
+    assert cache.get("university author author", scope="奈奈") == script
+    assert cache.get("reasoning acting results", scope="奈奈") is None
+    assert cache.get("author university author", scope="贝儿") is None
+
+
+def test_keeps_at_most_max_entries_per_scope() -> None:
+    cache = SemanticScriptCache(threshold=0.99, embed_fn=_bag_of_words, max_entries_per_scope=2)
+    for word in ("author", "reasoning", "table"):
+        cache.add(word, [{"type": "dialogue", "text": word}], scope="s")
+
+    assert cache.get("author", scope="s") is None
+    assert cache.get("table", scope="s") == [{"type": "dialogue", "text": "table"}]
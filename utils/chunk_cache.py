@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+from utils.script_cache import ScriptCache
+
+# 切分逻辑 / PdfChunk 字段变化时递增，旧缓存自然失效
+CHUNKER_VERSION = "1"
+
+
+def default_cache_dir() -> Path:
+    env_dir = (os.getenv("P2G_CHUNK_CACHE_DIR") or "").strip()
+    if env_dir:
+        return Path(env_dir).expanduser()
+    return Path(__file__).resolve().parents[1] / "output" / "chunk_cache"
+
+
+def cache_enabled() -> bool:
+    return (os.getenv("P2G_CHUNK_CACHE") or "1").strip().lower() not in {"0", "false", "off", "no"}
+
+
+def pdf_digest(pdf: bytes | Path) -> str:
+    """PDF 内容的 sha256：路径按 1MB 分块读取，不把整份文件读进内存。"""
+    h = hashlib.sha256()
+    if isinstance(pdf, bytes):
+        h.update(pdf)
+    else:
+        with open(pdf, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def chunk_cache_key(
+    *,
+    digest: str,
+    source: str,
+    parser: str,
+    chunk_size: int,
+    chunk_overlap: int,
+) -> str:
+    """同一份 PDF + 同一种解析方式与切分参数 → 同一个键。"""
+    payload = json.dumps([CHUNKER_VERSION, digest, source, parser, chunk_size, chunk_overlap], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ChunkCache(ScriptCache):
+    """
+    PDF 解析 / 切分结果的磁盘缓存（output/chunk_cache/），同一篇论文再次打开时跳过解析。
+
+    沿用 ScriptCache 的存储方式（每个键一个 JSON 文件、原子写入、读失败即未命中）；
+    解析结果只取决于文件内容与参数，默认不过期。
+    """
+
+    def __init__(self, cache_dir: Optional[str | Path] = None, *, ttl_seconds: Optional[int] = None) -> None:
+        super().__init__(cache_dir or default_cache_dir(), ttl_seconds=ttl_seconds)
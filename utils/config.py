@@ -5,7 +5,7 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
 
-from dotenv import load_dotenv
+from utils.env import load_env_once
 
 
 @dataclass(frozen=True)
@@ -24,6 +24,8 @@ class LLMConfig:
     temperature: float
     request_timeout: int
     max_retries: int
+    max_tokens: int
+    structured_output: bool
 
 
 @dataclass(frozen=True)
@@ -46,15 +48,8 @@ def load_config() -> AppConfig:
 
     # 先加载 .env（敏感信息建议放这里）
     # 规则：优先尝试“当前工作目录”的 .env，其次尝试“项目根目录”的 .env，最后尝试 utils/.env
-    cwd_env = Path.cwd() / ".env"
-    root_env = root / ".env"
-    utils_env = root / "utils" / ".env"
-    if cwd_env.exists():
-        load_dotenv(dotenv_path=str(cwd_env), override=False)
-    elif root_env.exists():
-        load_dotenv(dotenv_path=str(root_env), override=False)
-    elif utils_env.exists():
-        load_dotenv(dotenv_path=str(utils_env), override=False)
+    # 同一组路径只查找一次，重复调用 load_config 不再反复 stat
+    load_env_once(Path.cwd() / ".env", root / ".env", root / "utils" / ".env")
 
     # -----------------------------
     # 非敏感默认配置：直接写死在这里
@@ -63,6 +58,10 @@ def load_config() -> AppConfig:
     temperature = 0.7
     request_timeout = 60
     max_retries = 2
+    # 单次回复的 token 上限：一节剧本通常 1.5k~3k token，留出余量，同时避免失控的长输出拖慢整段
+    max_tokens = 4096
+    # JSON mode（response_format=json_object）：服务端约束输出必为合法 JSON；默认关闭，LLM_STRUCTURED_OUTPUT=1 开启
+    structured_output = (os.getenv("LLM_STRUCTURED_OUTPUT") or "").strip().lower() in {"1", "true", "on", "yes"}
 
     # -----------------------------
     # 敏感配置：只从 .env 读（支持 DeepSeek / OpenAI 兼容接口）
@@ -96,6 +95,8 @@ def load_config() -> AppConfig:
         temperature=temperature,
         request_timeout=request_timeout,
         max_retries=max_retries,
+        max_tokens=max_tokens,
+        structured_output=structured_output,
     )
     return AppConfig(llm=llm)
 
@@ -0,0 +1,21 @@
+from __future__ import annotations
+
+import functools
+from pathlib import Path
+from typing import Optional
+
+from dotenv import load_dotenv
+
+
+@functools.lru_cache(maxsize=None)
+def load_env_once(*candidates: Path) -> Optional[Path]:
+    """
+    按顺序加载第一个存在的 .env（override=False，不覆盖已有环境变量），返回其路径。
+
+    同一组候选路径只查找、加载一次；各调用方保留自己的优先级顺序。
+    """
+    for path in candidates:
+        if path.exists():
+            load_dotenv(dotenv_path=str(path), override=False)
+            return path
+    return None
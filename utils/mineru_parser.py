@@ -1,36 +1,64 @@
 from __future__ import annotations
 
-import io
+import hashlib
+import json
 import os
 import re
+import tempfile
 import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Iterable, Optional
 
 import requests
-from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.env import load_env_once
 
 DEFAULT_API_BASE = "https://mineru.net/api/v4"
-DEFAULT_INTERVAL = 5
+# Adaptive polling: start short, back off while the job keeps running.
+POLL_INITIAL_DELAY = 1.0
+POLL_MAX_DELAY = 15.0
+POLL_BACKOFF = 1.5
 DEFAULT_TIMEOUT = 300
-_DOTENV_LOADED = False
+# Result zips are streamed to disk in blocks of this size instead of held in memory.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+def _build_session() -> requests.Session:
+    """
+    One keep-alive session for all MinerU traffic, so the dozens of status
+    polls per paper reuse a single TLS connection instead of a handshake each.
+
+    Transient failures (429 / 5xx / connection errors) are retried with
+    backoff for GET only: the batch POST is not idempotent, and the upload
+    PUT streams a file object that cannot be replayed.
+    """
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Shared by all threads (Streamlit sessions); Authorization is sent per request
+# because the upload goes to a presigned storage URL that must not receive it.
+_session = _build_session()
 
 
 def _load_dotenv_once() -> None:
-    global _DOTENV_LOADED
-    if _DOTENV_LOADED:
-        return
     root = Path(__file__).resolve().parents[1]
-    utils_env = root / "utils" / ".env"
-    root_env = root / ".env"
-    cwd_env = Path.cwd() / ".env"
     # 只加载一个 .env：优先项目内（utils > root），最后才 cwd，避免 Streamlit 从别处启动时用到错误的 .env 导致 401
-    for path in (utils_env, root_env, cwd_env):
-        if path.exists():
-            load_dotenv(dotenv_path=str(path), override=False)
-            break
-    _DOTENV_LOADED = True
+    load_env_once(root / "utils" / ".env", root / ".env", Path.cwd() / ".env")
 
 
 def _get_token(explicit: Optional[str] = None) -> Optional[str]:
@@ -64,9 +92,12 @@ def _get_api_base(explicit: Optional[str] = None) -> str:
     return (env_base or DEFAULT_API_BASE).rstrip("/")
 
 
+_SAFE_STEM_RE = re.compile(r"[^A-Za-z0-9._-]+")
+
+
 def _safe_stem(path: Path) -> str:
     stem = path.stem.strip() or "pdf"
-    return re.sub(r"[^A-Za-z0-9._-]+", "_", stem)
+    return _SAFE_STEM_RE.sub("_", stem)
 
 
 def _default_output_dir(pdf_path: Path) -> Path:
@@ -115,7 +146,7 @@ def upload_pdf_to_mineru(
         ],
     }
 
-    resp = requests.post(url, headers=headers, json=payload, timeout=30)
+    resp = _session.post(url, headers=headers, json=payload, timeout=30)
     resp.raise_for_status()
     data = resp.json()
     if data.get("code") != 0:
@@ -127,25 +158,65 @@ def upload_pdf_to_mineru(
     if not urls:
         raise RuntimeError("MinerU upload URL list is empty")
 
-    for put_url in urls:
+    def _put(put_url: str) -> None:
+        # Each upload streams from its own file handle: no shared offset, no in-memory copy.
+        # An mmap would not help: http.client reads it in blocks exactly like this file object.
         with pdf_path.open("rb") as f:
-            put_resp = requests.put(put_url, data=f, timeout=60)
+            put_resp = _session.put(put_url, data=f, timeout=60)
             put_resp.raise_for_status()
 
+    if len(urls) == 1:
+        _put(urls[0])
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(urls), 4), thread_name_prefix="mineru-put") as pool:
+            # list() re-raises the first failed upload
+            list(pool.map(_put, urls))
+
     return batch_id
 
 
+def _download_and_extract_zip(zip_url: str, output_dir: Path) -> None:
+    """
+    Stream the result zip into a temporary file next to output_dir and extract
+    it from there, so peak memory stays at one download block regardless of
+    the archive size.
+    """
+    fd, tmp_name = tempfile.mkstemp(suffix=".zip", dir=output_dir)
+    try:
+        with os.fdopen(fd, "wb") as tmp, _session.get(zip_url, timeout=60, stream=True) as resp:
+            resp.raise_for_status()
+            for block in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                tmp.write(block)
+        with zipfile.ZipFile(tmp_name) as zf:
+            zf.extractall(output_dir)
+    finally:
+        Path(tmp_name).unlink(missing_ok=True)
+
+
+def _retry_after_seconds(resp: requests.Response) -> float:
+    value = resp.headers.get("Retry-After")
+    try:
+        return max(0.0, float(value)) if value else 0.0
+    except ValueError:  # HTTP-date form: not used by MinerU, fall back to our own delay
+        return 0.0
+
+
 def download_mineru_result(
     batch_id: str,
     *,
     output_dir: str | Path,
     token: Optional[str] = None,
     api_base: Optional[str] = None,
-    interval: int = DEFAULT_INTERVAL,
+    interval: Optional[float] = None,
     timeout: int = DEFAULT_TIMEOUT,
 ) -> Path:
     """
     Poll MinerU for extraction result, download, and unzip into output_dir.
+
+    Polls start POLL_INITIAL_DELAY apart and grow by POLL_BACKOFF up to
+    POLL_MAX_DELAY, restarting from the initial delay whenever the job
+    changes state (e.g. pending -> running). A Retry-After header raises the
+    next delay. Pass `interval` to poll at a fixed period instead.
     """
     token = _get_token(token)
     if not token:
@@ -162,9 +233,11 @@ def download_mineru_result(
 
     url = f"{api_base}/extract-results/batch/{batch_id}"
     start_time = time.time()
+    delay = float(interval) if interval else POLL_INITIAL_DELAY
+    last_state: Optional[str] = None
 
     while True:
-        resp = requests.get(url, headers=headers, timeout=30)
+        resp = _session.get(url, headers=headers, timeout=30)
         resp.raise_for_status()
         data = resp.json()
 
@@ -175,17 +248,25 @@ def download_mineru_result(
         state = extract_info.get("state")
 
         if state == "done":
-            zip_url = extract_info["full_zip_url"]
-            zip_resp = requests.get(zip_url, timeout=60)
-            zip_resp.raise_for_status()
-            with zipfile.ZipFile(io.BytesIO(zip_resp.content)) as zf:
-                zf.extractall(output_dir)
+            _download_and_extract_zip(extract_info["full_zip_url"], output_dir)
             return output_dir
 
-        if time.time() - start_time > timeout:
+        if state == "failed":
+            raise RuntimeError(f"MinerU extraction failed: {extract_info.get('err_msg') or extract_info}")
+
+        elapsed = time.time() - start_time
+        if elapsed > timeout:
             raise TimeoutError("MinerU extraction timed out")
 
-        time.sleep(max(1, int(interval)))
+        if not interval:
+            if state != last_state:
+                delay = POLL_INITIAL_DELAY
+            else:
+                delay = min(POLL_MAX_DELAY, delay * POLL_BACKOFF)
+        last_state = state
+        wait = max(delay, _retry_after_seconds(resp))
+        # Never sleep past the deadline: one last poll right at the timeout.
+        time.sleep(max(0.0, min(wait, timeout - elapsed)))
 
 
 def find_markdown_file(extracted_dir: Path) -> Path:
@@ -196,13 +277,53 @@ def find_markdown_file(extracted_dir: Path) -> Path:
     if full_md.exists():
         return full_md
 
-    md_files = list(extracted_dir.rglob("*.md"))
+    # MinerU puts the markdown at the top level; only walk the tree (which can
+    # hold thousands of extracted images) when nothing is found there.
+    with os.scandir(extracted_dir) as entries:
+        md_files = [Path(e.path) for e in entries if e.name.endswith(".md") and e.is_file()]
+    if not md_files:
+        md_files = list(extracted_dir.rglob("*.md"))
     if not md_files:
         raise FileNotFoundError(f"No markdown files found in: {extracted_dir}")
 
     return max(md_files, key=lambda p: p.stat().st_size)
 
 
+# Per-document cache record written next to the extracted markdown.
+CACHE_INDEX_NAME = "index.json"
+
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _read_cache_index(out_dir: Path, digest: str) -> Optional[Path]:
+    """Markdown path recorded for this exact PDF content, or None if stale / missing."""
+    try:
+        data = json.loads((out_dir / CACHE_INDEX_NAME).read_text(encoding="utf-8"))
+        md_path = out_dir / data["md_path"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if data.get("sha256") != digest or not md_path.is_file():
+        return None
+    return md_path
+
+
+def _write_cache_index(out_dir: Path, digest: str, md_path: Path) -> None:
+    index_path = out_dir / CACHE_INDEX_NAME
+    tmp_path = index_path.with_suffix(".tmp")
+    record = {"md_path": md_path.relative_to(out_dir).as_posix(), "sha256": digest, "ts": time.time()}
+    try:
+        tmp_path.write_text(json.dumps(record), encoding="utf-8")
+        os.replace(tmp_path, index_path)
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+
+
 def parse_pdf_to_markdown(
     pdf_path: str | Path,
     *,
@@ -210,20 +331,26 @@ def parse_pdf_to_markdown(
     token: Optional[str] = None,
     api_base: Optional[str] = None,
     use_cache: bool = True,
-    interval: int = DEFAULT_INTERVAL,
+    interval: Optional[float] = None,
     timeout: int = DEFAULT_TIMEOUT,
 ) -> Path:
     """
     Parse a PDF with MinerU and return the markdown file path.
+
+    Results are cached per PDF content: the default output directory is
+    output/mineru/<stem>/<sha256 prefix>/, and an index.json there records the
+    markdown path and the full hash. A cache hit is one small JSON read; a
+    changed file under the same name gets a new directory and is re-parsed.
     """
     pdf_path = Path(pdf_path)
-    out_dir = Path(output_dir) if output_dir else _default_output_dir(pdf_path)
+    digest = _file_sha256(pdf_path)
+    out_dir = Path(output_dir) if output_dir else _default_output_dir(pdf_path) / digest[:16]
     out_dir.mkdir(parents=True, exist_ok=True)
 
     if use_cache:
-        md_candidates = list(out_dir.rglob("*.md"))
-        if md_candidates:
-            return max(md_candidates, key=lambda p: p.stat().st_size)
+        cached = _read_cache_index(out_dir, digest)
+        if cached is not None:
+            return cached
 
     batch_id = upload_pdf_to_mineru(pdf_path, token=token, api_base=api_base)
     download_mineru_result(
@@ -234,4 +361,6 @@ def parse_pdf_to_markdown(
         interval=interval,
         timeout=timeout,
     )
-    return find_markdown_file(out_dir)
+    md_path = find_markdown_file(out_dir)
+    _write_cache_index(out_dir, digest, md_path)
+    return md_path
@@ -1,17 +1,46 @@
 from __future__ import annotations
 
+import contextlib
+import dataclasses
+import hashlib
+import io
+import multiprocessing
+import os
 import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pypdf import PdfReader
 import requests
 
+try:  # PyMuPDF is optional: much faster text extraction than pypdf when installed
+    import pymupdf
+except ImportError:  # pragma: no cover - older PyMuPDF releases only ship `fitz`
+    try:
+        import fitz as pymupdf
+    except ImportError:
+        pymupdf = None
+
+try:  # pypdfium2 (PDFium bindings) is optional: native-speed fallback when PyMuPDF is absent
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+from utils.chunk_cache import ChunkCache, cache_enabled as chunk_cache_enabled, chunk_cache_key, pdf_digest
 from utils.mineru_parser import parse_pdf_to_markdown, token_available
 
+# PDFium is not thread-safe; Streamlit sessions parse on different threads.
+_PDFIUM_LOCK = threading.Lock()
+# MuPDF's shared context is not safe for concurrent use either (PyMuPDF does not
+# support multithreading), so opening, page reads and closing are serialised too.
+_PYMUPDF_LOCK = threading.Lock()
+
 
 @dataclass(frozen=True)
 class PdfChunk:
@@ -21,52 +50,213 @@ class PdfChunk:
     text: str
     source: str
     section_title: str = ""  # 章节名，如 Abstract / 1 Introduction（MinerU 时有值）
-    parser: str = "pypdf"  # "mineru" | "pypdf"，用于 debug 显示当前解析方式
+    parser: str = "pypdf"  # "mineru" | "pymupdf" | "pdfium" | "pypdf"，用于 debug 显示当前解析方式
     images_dir: str = ""   # MinerU 提取图片所在目录
     image_map: Tuple[Tuple[str, str], ...] = ()  # ((figure_label, abs_image_path), ...)
 
 
-def _load_docs_with_pypdf(pdf_path: Path) -> List[Document]:
-    reader = PdfReader(str(pdf_path))
-    docs: List[Document] = []
-    for page_idx, page in enumerate(reader.pages):
+# A PDF given either as a filesystem path or as the raw bytes of an upload.
+PdfSource = Union[str, Path, bytes]
+
+
+# pypdf is pure Python (~20-50 ms/page); below this many pages starting worker
+# processes (~0.5 s each) costs more than it saves.
+PYPDF_PARALLEL_MIN_PAGES = 24
+# Pages per worker task: small enough that the first pages come back quickly.
+_PYPDF_PAGES_PER_TASK = 4
+
+
+def _extract_pypdf_text(page: Any) -> str:
+    # pypdf already skips image XObjects on `Do` without decoding them, and its
+    # visitor callbacks only observe operators (they cannot skip any), so there
+    # is no image work to cut here; the cost is in the text operators themselves.
+    try:
+        return (page.extract_text() or "").strip()
+    except Exception:
+        return ""
+
+
+# Per-worker-process reader, built once by the pool initializer.
+_PYPDF_WORKER_READER: Any = None
+
+
+def _init_pypdf_worker(pdf: Union[str, bytes]) -> None:
+    """Worker initializer: parse the PDF once per process, not once per batch."""
+    global _PYPDF_WORKER_READER
+    _PYPDF_WORKER_READER = PdfReader(io.BytesIO(pdf) if isinstance(pdf, bytes) else pdf)
+
+
+def _pypdf_page_texts(page_indices: List[int]) -> List[str]:
+    """Worker: extract the given pages with this process's reader."""
+    reader = _PYPDF_WORKER_READER
+    return [_extract_pypdf_text(reader.pages[i]) for i in page_indices]
+
+
+def _iter_pypdf_texts_parallel(pdf: Union[str, bytes], n_pages: int, workers: int) -> Iterator[str]:
+    """
+    Extract page texts across a process pool (pypdf is CPU-bound and holds the
+    GIL). Results are yielded in page order as soon as each batch finishes.
+    Workers come from a fork server (spawn on Windows) rather than plain fork,
+    so they never inherit locks held by other threads (Streamlit, prefetch).
+    """
+    batches = [
+        list(range(start, min(start + _PYPDF_PAGES_PER_TASK, n_pages)))
+        for start in range(0, n_pages, _PYPDF_PAGES_PER_TASK)
+    ]
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    # The PDF (bytes or path) is sent to each worker once; tasks carry only page indices.
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(method),
+        initializer=_init_pypdf_worker,
+        initargs=(pdf,),
+    ) as pool:
+        for texts in pool.map(_pypdf_page_texts, batches):
+            yield from texts
+
+
+def _iter_docs_with_pypdf(pdf: Union[Path, bytes], *, source: Optional[str] = None) -> Iterator[Document]:
+    # Given a path, pypdf loads the file with a single read() into its own buffer,
+    # so memory-mapping it would not save a copy (measured: no difference).
+    reader = PdfReader(io.BytesIO(pdf) if isinstance(pdf, bytes) else str(pdf))
+    source = source or str(pdf)
+    n_pages = len(reader.pages)
+    workers = min(os.cpu_count() or 1, -(-n_pages // _PYPDF_PAGES_PER_TASK))
+
+    page_idx = 0
+    if n_pages >= PYPDF_PARALLEL_MIN_PAGES and workers > 1:
         try:
-            text = (page.extract_text() or "").strip()
+            for text in _iter_pypdf_texts_parallel(
+                pdf if isinstance(pdf, bytes) else str(pdf), n_pages, workers
+            ):
+                if text:
+                    yield _pypdf_document(text, source=source, page_idx=page_idx)
+                page_idx += 1
         except Exception:
-            text = ""
-        if not text:
-            continue
-        docs.append(
-            Document(
+            # Pool could not start or a worker died: finish the remaining pages here.
+            pass
+
+    for page_idx in range(page_idx, n_pages):
+        text = _extract_pypdf_text(reader.pages[page_idx])
+        if text:
+            yield _pypdf_document(text, source=source, page_idx=page_idx)
+
+
+def _pypdf_document(text: str, *, source: str, page_idx: int) -> Document:
+    return Document(
+        page_content=text,
+        metadata={
+            "source": source,
+            "page": page_idx,
+            "parser": "pypdf",
+        },
+    )
+
+
+def _iter_docs_with_pymupdf(doc: Any, *, source: str) -> Iterator[Document]:
+    try:
+        for page_idx in range(len(doc)):
+            # Hold the lock per page only, so other sessions are not blocked while we yield.
+            with _PYMUPDF_LOCK:
+                text = (doc.load_page(page_idx).get_text("text") or "").strip()
+            if not text:
+                continue
+            yield Document(
                 page_content=text,
                 metadata={
-                    "source": str(pdf_path),
+                    "source": source,
                     "page": page_idx,
-                    "parser": "pypdf",
+                    "parser": "pymupdf",
                 },
             )
-        )
-    return docs
+    finally:
+        with _PYMUPDF_LOCK:
+            doc.close()
+
+
+def _iter_docs_with_pdfium(doc: Any, *, source: str) -> Iterator[Document]:
+    try:
+        for page_idx in range(len(doc)):
+            # Hold the lock per page only, so other sessions are not blocked while we yield.
+            with _PDFIUM_LOCK:
+                page = doc[page_idx]
+                try:
+                    textpage = page.get_textpage()
+                    try:
+                        text = textpage.get_text_range()
+                    finally:
+                        textpage.close()
+                finally:
+                    page.close()
+            text = (text or "").replace("\r\n", "\n").strip()
+            if not text:
+                continue
+            yield Document(
+                page_content=text,
+                metadata={
+                    "source": source,
+                    "page": page_idx,
+                    "parser": "pdfium",
+                },
+            )
+    finally:
+        with _PDFIUM_LOCK:
+            doc.close()
+
+
+def _open_pdfium(pdf: Union[Path, bytes]) -> Any:
+    if pdfium is None:
+        return None
+    try:
+        with _PDFIUM_LOCK:
+            return pdfium.PdfDocument(pdf if isinstance(pdf, bytes) else str(pdf))
+    except Exception:
+        return None
+
+
+def _iter_docs_locally(pdf: Union[Path, bytes], *, source: Optional[str] = None) -> Iterator[Document]:
+    """
+    Local (non-OCR) text extraction, one page at a time: PyMuPDF when
+    installed, then PDFium (pypdfium2), then pypdf. Pages are yielded as soon
+    as they are read so the first chunks can be consumed before the rest of
+    the file is parsed.
+    """
+    source = source or str(pdf)
+    if pymupdf is not None:
+        try:
+            with _PYMUPDF_LOCK:
+                if isinstance(pdf, bytes):
+                    doc = pymupdf.open(stream=pdf, filetype="pdf")
+                else:
+                    doc = pymupdf.open(str(pdf))
+        except Exception:
+            # Files MuPDF refuses to open still get a chance with pypdf.
+            doc = None
+        if doc is not None:
+            yield from _iter_docs_with_pymupdf(doc, source=source)
+            return
+    doc = _open_pdfium(pdf)
+    if doc is not None:
+        yield from _iter_docs_with_pdfium(doc, source=source)
+        return
+    yield from _iter_docs_with_pypdf(pdf, source=source)
+
+
+# 图号识别，按优先级排列：Figure / Fig、Table / Tab、图N（中文）、表N（中文）
+_FIGURE_LABEL_RES = (
+    re.compile(r"(fig(?:ure)?\.?\s*\d+[a-z]?)", re.I),
+    re.compile(r"(tab(?:le)?\.?\s*\d+[a-z]?)", re.I),
+    re.compile(r"(图\s*\d+[a-z]?)"),
+    re.compile(r"(表\s*\d+[a-z]?)"),
+)
 
 
 def _extract_figure_label(caption: str) -> Optional[str]:
     """从图注中提取标准图号：Figure N / Fig. N / 图N / Table N / Tab. N / 表N。"""
-    # Figure / Fig
-    m = re.search(r"(fig(?:ure)?\.?\s*\d+[a-z]?)", caption, re.I)
-    if m:
-        return m.group(1).strip()
-    # Table / Tab
-    m = re.search(r"(tab(?:le)?\.?\s*\d+[a-z]?)", caption, re.I)
-    if m:
-        return m.group(1).strip()
-    # 图N（中文）
-    m = re.search(r"(图\s*\d+[a-z]?)", caption)
-    if m:
-        return m.group(1).strip()
-    # 表N（中文）
-    m = re.search(r"(表\s*\d+[a-z]?)", caption)
-    if m:
-        return m.group(1).strip()
+    for pattern in _FIGURE_LABEL_RES:
+        m = pattern.search(caption)
+        if m:
+            return m.group(1).strip()
     return None
 
 
@@ -75,6 +265,8 @@ _IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp", ".gif"}
 _LINE_IMG_RE = re.compile(r"^!\[([^\]]*)\]\(([^)]+)\)\s*$")
 # 行内图片引用（句子中夹杂图片）
 _INLINE_IMG_RE = re.compile(r"!\[([^\]]*)\]\(([^)]+)\)")
+# HTML 形式的图片标签
+_IMG_HTML_RE = re.compile(r"<img[^>]*>", re.I)
 
 
 def _extract_images_and_clean(
@@ -142,7 +334,7 @@ def _extract_images_and_clean(
             def _replace_inline(mm: re.Match) -> str:
                 return _register_image(mm.group(1).strip(), mm.group(2).strip(), [])
             line = _INLINE_IMG_RE.sub(_replace_inline, line)
-            line = re.sub(r"<img[^>]*>", "[图片]", line, flags=re.I)
+            line = _IMG_HTML_RE.sub("[图片]", line)
 
         result_lines.append(line)
         i += 1
@@ -151,6 +343,7 @@ def _extract_images_and_clean(
 
 
 _HEX_HASH_RE = re.compile(r"^[0-9a-f]{16,}$", re.I)
+_DIGITS_RE = re.compile(r"(\d+)")
 
 
 def _collect_dir_images(images_dir: Path, image_map: Dict[str, str]) -> None:
@@ -163,7 +356,7 @@ def _collect_dir_images(images_dir: Path, image_map: Dict[str, str]) -> None:
     if not images_dir.exists() or not images_dir.is_dir():
         return
     existing_paths = set(image_map.values())
-    existing_nums: set = {re.search(r"(\d+)", k).group(1) for k in image_map if re.search(r"(\d+)", k)}
+    existing_nums: set = {m.group(1) for m in map(_DIGITS_RE.search, image_map) if m}
     fallback_n = max((int(n) for n in existing_nums if n.isdigit()), default=0)
 
     for img_file in sorted(images_dir.iterdir()):
@@ -176,7 +369,7 @@ def _collect_dir_images(images_dir: Path, image_map: Dict[str, str]) -> None:
         if _HEX_HASH_RE.match(stem):
             continue
         # 有意义文件名：提取数字
-        num_m = re.search(r"(\d+)", stem)
+        num_m = _DIGITS_RE.search(stem)
         if num_m:
             num = num_m.group(1)
             label = f"Figure {num}"
@@ -191,42 +384,71 @@ def _collect_dir_images(images_dir: Path, image_map: Dict[str, str]) -> None:
                 image_map[label] = str(img_file)
 
 
+# 标题行；只匹配行内空白，避免 \s 跨行把 "#" 与下一行拼成标题
+_HEADING_RE = re.compile(r"^(#{1,6})[^\S\n]+(.+?)[^\S\n]*$", re.M)
+# 除 \n 以外 str.splitlines() 也视为换行的字符（\r、分页符、U+2028 等）
+_OTHER_LINE_BREAK_RE = re.compile(r"[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+
+
 def _split_markdown_sections(md_text: str) -> List[Tuple[str, int, str]]:
     """
     Split markdown into sections by headings.
     Returns a list of (title, level, content).
+
+    Single pass over the heading matches: each section's content is one slice
+    of the text between consecutive headings, not a per-line list re-joined.
     """
-    lines = md_text.splitlines()
-    sections: List[Tuple[str, int, List[str]]] = []
-    current_title = "Preamble"
-    current_level = 0
-    buffer: List[str] = []
+    if _OTHER_LINE_BREAK_RE.search(md_text):
+        md_text = "\n".join(md_text.splitlines())
 
-    heading_re = re.compile(r"^(#{1,6})\s+(.+?)\s*$")
+    sections: List[Tuple[str, int, str]] = []
+    title, level, start = "Preamble", 0, 0
+    for m in _HEADING_RE.finditer(md_text):
+        content = md_text[start:m.start()].strip()
+        if content:
+            sections.append((title, level, content))
+        title, level, start = m.group(2).strip(), len(m.group(1)), m.end()
 
-    for line in lines:
-        m = heading_re.match(line)
-        if m:
-            if buffer:
-                sections.append((current_title, current_level, buffer))
-                buffer = []
-            current_level = len(m.group(1))
-            current_title = m.group(2).strip()
-            continue
-        buffer.append(line)
+    content = md_text[start:].strip()
+    if content:
+        sections.append((title, level, content))
+    return sections
 
-    if buffer:
-        sections.append((current_title, current_level, buffer))
 
-    normalized: List[Tuple[str, int, str]] = []
-    for title, level, buf in sections:
-        content = "\n".join(buf).strip()
-        if content:
-            normalized.append((title, level, content))
-    return normalized
+_SAFE_STEM_RE = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+@contextlib.contextmanager
+def _materialized_pdf(data: bytes, name: str) -> Iterator[Path]:
+    """
+    Write in-memory PDF bytes to a temporary file for consumers that need a path
+    (MinerU upload), and remove it afterwards. The file name carries a content
+    hash so MinerU's per-stem output cache is reused for the same document.
+    """
+    stem = _SAFE_STEM_RE.sub("_", Path(name).stem.strip()) or "pdf"
+    digest = hashlib.sha1(data).hexdigest()[:12]
+    tmp_dir = Path(tempfile.mkdtemp(prefix="p2g-"))
+    try:
+        pdf_path = tmp_dir / f"{stem}-{digest}.pdf"
+        pdf_path.write_bytes(data)
+        yield pdf_path
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _load_docs_with_mineru_source(
+    pdf: Union[Path, bytes],
+    *,
+    name: str,
+    output_dir: Optional[Path] = None,
+) -> List[Document]:
+    if isinstance(pdf, bytes):
+        with _materialized_pdf(pdf, name) as pdf_path:
+            return _load_docs_with_mineru(pdf_path, output_dir=output_dir, source=name)
+    return _load_docs_with_mineru(pdf, output_dir=output_dir)
 
 
-def _load_docs_with_mineru(pdf_path: Path, *, output_dir: Optional[Path] = None) -> List[Document]:
+def _load_docs_with_mineru(pdf_path: Path, *, output_dir: Optional[Path] = None, source: Optional[str] = None) -> List[Document]:
     md_path = parse_pdf_to_markdown(pdf_path, output_dir=output_dir)
     raw_md = md_path.read_text(encoding="utf-8", errors="ignore")
 
@@ -256,7 +478,7 @@ def _load_docs_with_mineru(pdf_path: Path, *, output_dir: Optional[Path] = None)
             Document(
                 page_content=content,
                 metadata={
-                    "source": str(pdf_path),
+                    "source": source or str(pdf_path),
                     "parser": "mineru",
                     "md_path": str(md_path),
                     "section_title": title,
@@ -270,82 +492,238 @@ def _load_docs_with_mineru(pdf_path: Path, *, output_dir: Optional[Path] = None)
     return docs
 
 
-def load_and_chunk_pdf(
-    pdf_path: str | Path,
+def iter_chunks(
+    pdf: PdfSource,
     *,
     chunk_size: int = 1400,
     chunk_overlap: int = 180,
     use_mineru: bool = True,
     mineru_fallback: bool = True,
     mineru_output_dir: Optional[str | Path] = None,
-) -> List[PdfChunk]:
+    source_name: Optional[str] = None,
+    use_cache: bool = True,
+) -> Iterator[PdfChunk]:
     """
-    Parse a PDF and split it into chunks for downstream script generation.
+    Parse a PDF and yield chunks one by one, so callers can start script
+    generation on chunk 0 while the rest is still being split.
+
+    `pdf` is a path or the raw bytes of an uploaded file. Bytes are parsed in
+    memory; a temporary file is only written when MinerU needs one.
+    `source_name` labels chunks parsed from bytes (defaults to "upload.pdf").
 
     - Default: MinerU OCR (if token available)
-    - Fallback: pypdf text extraction
+    - Fallback: local text extraction (PyMuPDF or PDFium if installed, else pypdf)
+
+    With `use_cache` (and P2G_CHUNK_CACHE not disabled) the result is stored
+    under output/chunk_cache/, keyed by the PDF's sha256 and the parse
+    parameters; the same file is not parsed twice.
     """
-    pdf_path = Path(pdf_path)
-    if not pdf_path.exists():
-        raise FileNotFoundError(f"PDF not found: {pdf_path}")
+    if isinstance(pdf, (bytes, bytearray)):
+        pdf_src: Union[Path, bytes] = bytes(pdf)
+        name = source_name or "upload.pdf"
+        source = name
+    else:
+        pdf_src = Path(pdf)
+        if not pdf_src.exists():
+            raise FileNotFoundError(f"PDF not found: {pdf_src}")
+        name = pdf_src.name
+        source = str(pdf_src)
 
     output_dir = Path(mineru_output_dir) if mineru_output_dir else None
+    mineru_first = bool(use_mineru and token_available())
+    parse_kwargs: Dict[str, Any] = dict(
+        name=name,
+        source=source,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        mineru_first=mineru_first,
+        mineru_fallback=mineru_fallback,
+        output_dir=output_dir,
+    )
+    if not (use_cache and chunk_cache_enabled()):
+        yield from _iter_chunks_uncached(pdf_src, **parse_kwargs)
+        return
 
-    docs: List[Document] = []
-    if use_mineru and token_available():
+    # 确定走本地解析时只读一次文件：同一份字节既算摘要又交给解析器
+    pdf_bytes: Optional[bytes] = None
+    if isinstance(pdf_src, Path) and not mineru_first:
+        pdf_bytes = pdf_src.read_bytes()
+        parse_kwargs["pdf_bytes"] = pdf_bytes
+
+    cache = ChunkCache()
+    key = chunk_cache_key(
+        digest=pdf_digest(pdf_bytes if pdf_bytes is not None else pdf_src),
+        source=source,
+        parser="mineru" if mineru_first else _local_parser_name(),
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+    cached = _chunks_from_cache(cache.get(key))
+    if cached is not None:
+        yield from cached
+        return
+
+    chunks: List[PdfChunk] = []
+    for chunk in _iter_chunks_uncached(pdf_src, **parse_kwargs):
+        chunks.append(chunk)
+        yield chunk
+    # MinerU 请求失败而回退到本地解析的结果不缓存，下次仍会先尝试 MinerU
+    if chunks and not (mineru_first and any(c.parser != "mineru" for c in chunks)):
+        cache.set(key, [dataclasses.asdict(c) for c in chunks])
+
+
+def _local_parser_name() -> str:
+    # Different backends split text differently, so they never share cache entries.
+    if pymupdf is not None:
+        return "pymupdf"
+    if pdfium is not None:
+        return "pdfium"
+    return "pypdf"
+
+
+def _chunks_from_cache(data: Optional[List[Dict[str, Any]]]) -> Optional[List[PdfChunk]]:
+    if not data:
+        return None
+    try:
+        chunks = [
+            PdfChunk(**{**d, "image_map": tuple(tuple(pair) for pair in d.get("image_map") or ())})
+            for d in data
+        ]
+    except TypeError:
+        return None
+    # MinerU 图片目录被清理后缓存已无法使用
+    if any(c.images_dir and not Path(c.images_dir).is_dir() for c in chunks):
+        return None
+    return chunks
+
+
+def _iter_chunks_uncached(
+    pdf_src: Union[Path, bytes],
+    *,
+    name: str,
+    source: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    mineru_first: bool,
+    mineru_fallback: bool,
+    output_dir: Optional[Path],
+    pdf_bytes: Optional[bytes] = None,
+) -> Iterator[PdfChunk]:
+    # pdf_bytes：调用方已读出的文件内容，本地解析直接复用；MinerU 仍上传原文件
+    local_src: Union[Path, bytes] = pdf_bytes if pdf_bytes is not None else pdf_src
+    if mineru_first:
+        docs: List[Document] = []
         try:
-            docs = _load_docs_with_mineru(pdf_path, output_dir=output_dir)
+            docs = _load_docs_with_mineru_source(pdf_src, name=name, output_dir=output_dir)
         except (requests.exceptions.HTTPError, requests.exceptions.RequestException) as e:
-            # 401 Unauthorized 或网络错误时自动回退到 pypdf，避免 UI 直接报错
-            if mineru_fallback:
-                docs = _load_docs_with_pypdf(pdf_path)
-            else:
+            # 401 Unauthorized 或网络错误时自动回退到本地解析，避免 UI 直接报错
+            if not mineru_fallback:
                 raise RuntimeError(f"MinerU 请求失败（{e}），可关闭「Use MinerU OCR」或检查 MINERU_API_TOKEN。") from e
-        if not docs and mineru_fallback:
-            docs = _load_docs_with_pypdf(pdf_path)
-    else:
-        docs = _load_docs_with_pypdf(pdf_path)
-        if not docs and mineru_fallback and token_available():
-            try:
-                docs = _load_docs_with_mineru(pdf_path, output_dir=output_dir)
-            except (requests.exceptions.HTTPError, requests.exceptions.RequestException):
-                pass
+        if docs:
+            yield from _iter_mineru_chunks(docs, name=name)
+        elif mineru_fallback:
+            yield from _iter_local_chunks(
+                _iter_docs_locally(local_src, source=source),
+                name=name,
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+            )
+        return
 
-    chunks: List[PdfChunk] = []
+    n_chunks = 0
+    for chunk in _iter_local_chunks(
+        _iter_docs_locally(local_src, source=source),
+        name=name,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    ):
+        yield chunk
+        n_chunks += 1
+    if n_chunks == 0 and mineru_fallback and token_available():
+        try:
+            docs = _load_docs_with_mineru_source(pdf_src, name=name, output_dir=output_dir)
+        except (requests.exceptions.HTTPError, requests.exceptions.RequestException):
+            docs = []
+        yield from _iter_mineru_chunks(docs, name=name)
+
+
+def _iter_mineru_chunks(docs: List[Document], *, name: str) -> Iterator[PdfChunk]:
     # MinerU：按 section 为粒度，不再对 section 内做字符切分，保持连贯
-    is_mineru = docs and str((docs[0].metadata or {}).get("parser")) == "mineru"
-    if is_mineru:
-        for d in docs:
-            text = (d.page_content or "").strip()
-            if not text:
-                continue
-            source = str(d.metadata.get("source") or pdf_path.name)
-            section_title = str(d.metadata.get("section_title") or "").strip()
-            images_dir = str(d.metadata.get("images_dir") or "")
-            image_map_dict: Dict[str, str] = d.metadata.get("image_map") or {}
-            image_map_tuple: Tuple[Tuple[str, str], ...] = tuple(sorted(image_map_dict.items()))
-            chunks.append(PdfChunk(
-                index=len(chunks),
-                text=text,
-                source=source,
-                section_title=section_title,
-                parser="mineru",
-                images_dir=images_dir,
-                image_map=image_map_tuple,
-            ))
-        return chunks
-
-    # pypdf 或无 section 时：按字符分块
+    n_chunks = 0
+    for d in docs:
+        text = (d.page_content or "").strip()
+        if not text:
+            continue
+        source = str(d.metadata.get("source") or name)
+        section_title = str(d.metadata.get("section_title") or "").strip()
+        images_dir = str(d.metadata.get("images_dir") or "")
+        image_map_dict: Dict[str, str] = d.metadata.get("image_map") or {}
+        image_map_tuple: Tuple[Tuple[str, str], ...] = tuple(sorted(image_map_dict.items()))
+        yield PdfChunk(
+            index=n_chunks,
+            text=text,
+            source=source,
+            section_title=section_title,
+            parser="mineru",
+            images_dir=images_dir,
+            image_map=image_map_tuple,
+        )
+        n_chunks += 1
+
+
+def _iter_local_chunks(
+    page_docs: Iterator[Document],
+    *,
+    name: str,
+    chunk_size: int,
+    chunk_overlap: int,
+) -> Iterator[PdfChunk]:
+    # 本地解析（PyMuPDF / PDFium / pypdf）：按字符分块
+    # 切分器只在本地解析时用到，延迟导入（约 140ms）：MinerU 与切分缓存命中时无需加载
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
     splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
         separators=["\n\n", "\n", "。", "，", ";", "；", ",", " ", ""],
     )
-    for d in splitter.split_documents(docs):
-        text = (d.page_content or "").strip()
-        if not text:
-            continue
-        source = str(d.metadata.get("source") or pdf_path.name)
-        chunks.append(PdfChunk(index=len(chunks), text=text, source=source, parser="pypdf"))
+    # 逐页读取、逐页切分（与整体 split_documents 结果一致），每得到一个 chunk 立即产出
+    n_chunks = 0
+    for page_doc in page_docs:
+        for d in splitter.split_documents([page_doc]):
+            text = (d.page_content or "").strip()
+            if not text:
+                continue
+            source = str(d.metadata.get("source") or name)
+            parser = str(d.metadata.get("parser") or "pypdf")
+            yield PdfChunk(index=n_chunks, text=text, source=source, parser=parser)
+            n_chunks += 1
 
-    return chunks
+
+def load_and_chunk_pdf(
+    pdf: PdfSource,
+    *,
+    chunk_size: int = 1400,
+    chunk_overlap: int = 180,
+    use_mineru: bool = True,
+    mineru_fallback: bool = True,
+    mineru_output_dir: Optional[str | Path] = None,
+    source_name: Optional[str] = None,
+    use_cache: bool = True,
+) -> List[PdfChunk]:
+    """
+    Parse a PDF (path or bytes) and split it into chunks for downstream script
+    generation. Eager counterpart of `iter_chunks`.
+    """
+    return list(
+        iter_chunks(
+            pdf,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            use_mineru=use_mineru,
+            mineru_fallback=mineru_fallback,
+            mineru_output_dir=mineru_output_dir,
+            source_name=source_name,
+            use_cache=use_cache,
+        )
+    )
@@ -56,15 +56,18 @@ def _target_fast(total: int) -> int:
     return min(total, max(4, math.ceil(total * 0.25)))
 
 
+def is_fast_section_title(title: str) -> bool:
+    """Whether a MinerU section title belongs to the categories kept by fast mode."""
+    title_hits = _category_hits(str(title or ""))
+    return any(title_hits[cat] for cat in _FAST_CATEGORIES)
+
+
 def _apply_mineru_fast(chunks: List["PdfChunk"]) -> List["PdfChunk"]:
     n = len(chunks)
     target = _target_fast(n)
     candidates: List[int] = []
     for i, c in enumerate(chunks):
-        title = str(getattr(c, "section_title", "") or "")
-        title_hits = _category_hits(title)
-        is_fast_title = any(title_hits[cat] for cat in _FAST_CATEGORIES)
-        if is_fast_title:
+        if is_fast_section_title(getattr(c, "section_title", "")):
             candidates.append(i)
 
     if not candidates:
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# 提示词 / 剧本结构变化时递增，旧缓存自然失效
+PROMPT_VERSION = "2"
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+
+
+def default_cache_dir() -> Path:
+    env_dir = (os.getenv("P2G_SCRIPT_CACHE_DIR") or "").strip()
+    if env_dir:
+        return Path(env_dir).expanduser()
+    return Path(__file__).resolve().parents[1] / "output" / "script_cache"
+
+
+def cache_enabled() -> bool:
+    return (os.getenv("P2G_SCRIPT_CACHE") or "1").strip().lower() not in {"0", "false", "off", "no"}
+
+
+def script_cache_key(
+    *,
+    chunk_text: str,
+    section_title: Optional[str],
+    character_name: str,
+    image_map: Optional[Dict[str, str]],
+    model: str,
+    temperature: float,
+    prompt_fingerprint: str = "",
+) -> str:
+    """同一段正文 + 同一套生成参数 → 同一个键（sha256）。prompt_fingerprint 为提示词模板的指纹。"""
+    payload = json.dumps(
+        [
+            PROMPT_VERSION,
+            prompt_fingerprint,
+            model,
+            temperature,
+            character_name,
+            section_title or "",
+            sorted((image_map or {}).items()),
+            chunk_text,
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ScriptCache:
+    """
+    剧本的磁盘缓存：每个键一个 JSON 文件（output/script_cache/ab/abcdef….json）。
+
+    说明：
+    - 只用标准库，读写失败一律当作未命中，不影响正常生成
+    - 写入先落临时文件再原子替换，多个进程/线程同时写同一个键也不会读到半截文件
+    - 以文件 mtime 判断过期（默认 7 天）
+    """
+
+    def __init__(self, cache_dir: Optional[str | Path] = None, *, ttl_seconds: Optional[int] = DEFAULT_TTL_SECONDS) -> None:
+        self.cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+        self.ttl_seconds = ttl_seconds
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        path = self._path(key)
+        try:
+            if self.ttl_seconds and time.time() - path.stat().st_mtime > self.ttl_seconds:
+                return None
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return data if isinstance(data, list) and data else None
+
+    def set(self, key: str, script: List[Dict[str, Any]]) -> None:
+        path = self._path(key)
+        tmp_name: Optional[str] = None
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", dir=path.parent, suffix=".tmp", delete=False
+            ) as f:
+                tmp_name = f.name
+                json.dump(script, f, ensure_ascii=False)
+            os.replace(tmp_name, path)
+        except OSError:
+            if tmp_name:
+                Path(tmp_name).unlink(missing_ok=True)
@@ -1,12 +1,18 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import hashlib
+import importlib.util
 import json
 import os
+import random
 import re
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
 
-from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.messages import AIMessage, SystemMessage, HumanMessage
 
 from utils.config import load_config
 
@@ -14,6 +20,55 @@ try:
     from langchain_openai import ChatOpenAI
 except Exception as e:  # pragma: no cover
     ChatOpenAI = None  # type: ignore
+
+try:
+    import httpx
+except Exception:  # pragma: no cover - openai 依赖 httpx，正常安装时总能导入
+    httpx = None  # type: ignore
+
+try:
+    import json_repair
+except ImportError:  # json_repair 为可选依赖：装了时能修好单引号、尾逗号等小格式错误的条目
+    json_repair = None  # type: ignore
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖：装了时解析 LLM 输出更快
+    orjson = None  # type: ignore
+
+try:
+    import openai
+except Exception:  # pragma: no cover - langchain_openai 依赖 openai，正常安装时总能导入
+    openai = None  # type: ignore
+
+# SDK 自身已对这些错误做过带退避的重试，到这里说明服务端仍未恢复：等一会儿再整段重试
+_TRANSIENT_LLM_ERRORS: tuple = (
+    (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+    if openai is not None
+    else ()
+)
+# 鉴权 / 请求本身有误：重试也不会成功，直接走兜底脚本
+_FATAL_LLM_ERRORS: tuple = (
+    (openai.AuthenticationError, openai.PermissionDeniedError, openai.BadRequestError, openai.NotFoundError)
+    if openai is not None
+    else ()
+)
+
+# 瞬时错误后的退避：第 n 次重试前等待 uniform(2, 4) × n 秒（带抖动，避免并发请求同时重试）
+RETRY_BACKOFF_RANGE = (2.0, 4.0)
+# 建连 / 等待连接池的超时：握手正常只要几百毫秒，卡住时尽快失败交给重试，而不是空等整个 request_timeout
+LLM_CONNECT_TIMEOUT = 5.0
+# 空闲连接保留时长（httpx 默认 5 秒，读完一段剧本再请求下一段时连接早已断开，需重新 TCP + TLS 握手）
+LLM_KEEPALIVE_SECONDS = 60.0
+# 装了 h2 时走 HTTP/2：所有会话 / 预生成线程的请求在少量连接上多路复用（httpx 开 http2 但缺 h2 会直接报错）
+LLM_HTTP2 = httpx is not None and importlib.util.find_spec("h2") is not None
+# 估算超过这么多 token 的 chunk（MinerU 的长章节）按段落拆开、各小段并发生成：预填充耗时随提示词长度线性增长
+SPLIT_CHUNK_TOKENS = 1500
+# 合并请求（generate_scripts_batch）的输出上限：各节的 max_tokens 相加，但不超过服务端单次输出的上限（DeepSeek 为 8k）
+BATCH_MAX_OUTPUT_TOKENS = 8192
+# 一节剧本的输出 token 数按 1.5k~3k 的上沿估算：一次合并请求最多放几节，保证各节剧本都写得完
+SCRIPT_OUTPUT_TOKENS_ESTIMATE = 3000
+BATCH_MAX_CHUNKS = max(1, BATCH_MAX_OUTPUT_TOKENS // SCRIPT_OUTPUT_TOKENS_ESTIMATE)
 # 角色性格与自称配置
 CHARACTER_CONFIGS = {
     "奈奈": {
@@ -38,44 +93,441 @@ CHARACTER_CONFIGS = {
     }
 }
 
-SYSTEM_PROMPT = """你现在是一个{character_style}，你的名字是{character_name}，在对话中必须自称"{self_name}"。你的任务是陪用户读论文。
-输入是论文的**一整节**（例如 Abstract、Introduction、或 3 Method）。你需要把它改编成一段"对话剧本"。
+SYSTEM_PROMPT = """你现在是一个{character_style}，你的名字是{character_name}，在对话中必须自称"{self_name}"。你的任务是陪用户读论文：把输入的论文**一整节**（如 Abstract、3 Method）改编成一段"对话剧本"。
 
 要求：
-1. **去学术化**：用口语、比喻来解释复杂的概念（比如把"神经网络"比作"连接起来的猫脑"）。
-2. **情绪价值**：不要只讲课。根据性格穿插吐槽、鼓励或活泼的互动（比如"这个作者写的句子好长啊！"）、撒娇或严厉。
-3. **互动设计**：在关键知识点，设计一个"选项"让用户选，或者设计一个"小测验"。
-4. **层次划分**：若本节内容较多（如 Method、Related Work），请**按层次划分子节**。在子节开头插入一条 type="sub_head"，且带 "title" 字段（子节标题，如 "3.1 概述"）。子节内再写 dialogue/quiz/choice。这样用户能分层次理解，每层可含多个对话和题目。
-5. **解析**：quiz 和 choice 都必须附上 "explanation" 字段（50~120 字）。quiz 的解析解释为什么正确答案是对的；choice 的解析则针对用户的选择，给出思考角度或拓展观点，帮助加深理解。无论哪种，都要口语化，可以吐槽，有{character_name}的风格。
-6. **图片/表格同屏展示**：若正文中有「[图片: ...]」标记，说明原论文该处有插图或表格图。规则：
-   - show_image 会与紧随其后的 dialogue **同屏显示**（图片在上，对话在下）。因此：
-     * **每当** dialogue 的 text 中提到某张图/表（如"如图1所示""见 Figure 2""如 Figure 1(d) 展示的那样"），**必须紧接在该 dialogue 前面**插入对应的 type="show_image"。
-     * 同一张图被多次提及时，每次都要插入 show_image，因为图片会和当前对话文字同屏，帮助理解。
-     * **show_image 后紧跟的 dialogue 文字必须真正解释这张图**：描述图里的关键内容、实验结果、趋势对比——不要只说"来看这张图"，而是说"你看这条曲线……这说明……"。
-     * show_image 同样适用于表格，figure_id 格式如 "Table 1" / "表1"。
-   - **只能**引用"可用图片"列表里列出的图号；列表为空则不生成 show_image。
-7. **格式严格**：输出为 JSON 列表。type 只能是 dialogue / quiz / choice / sub_head / show_image。sub_head 项只需 type 与 title；dialogue 需 speaker/text/emotion/type；quiz 需 question/options/correct_answer/feedback_correct/feedback_wrong/explanation；choice 需 prompt/options/emotion/explanation；show_image 需 figure_id 和 caption。
-7.**语气特色**：{character_tone}
-8.**人设高度一致**：严格遵循"{character_style}"的设定。
+1. **去学术化**：用口语、比喻解释复杂概念（比如把"神经网络"比作"连接起来的猫脑"）。
+2. **情绪价值**：不要只讲课，按性格穿插吐槽、鼓励、撒娇或严厉（比如"这个作者写的句子好长啊！"）。
+3. **互动设计**：在关键知识点设计一个 choice（选项）或 quiz（小测验）；解析要口语化、有{character_name}的风格。
+4. **层次划分**：内容较多时（如 Method、Related Work）用 sub_head 按层次划分子节，子节内再写 dialogue/quiz/choice。
+5. **图片/表格**：正文中的「[图片: ...]」表示原文该处有图或表。show_image 与紧随其后的 dialogue 同屏显示（图在上、对话在下），
+   所以每当 dialogue 提到某图/表（如"如图1所示""见 Figure 2""Table 1"），都要紧接在它前面插入 show_image，同一张图每次提到都插；
+   这条 dialogue 必须真正讲解图中内容（关键结果、趋势对比），不要只说"来看这张图"。
+6. **语气特色**：{character_tone}
+7. **人设高度一致**：严格遵循"{character_style}"的设定。
 """.strip()
 
-@dataclass
-class ScriptItem:
-    type: str  # dialogue / quiz / choice / sub_head
-    speaker: Optional[str] = None
-    text: Optional[str] = None
-    emotion: Optional[str] = None
+# 解析 LLM 输出与选项文本用到的正则，模块加载时编译一次
+_RE_FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.I | re.M)
+_RE_JSON_OBJECT = re.compile(r"\{[\s\S]*\}")
+_RE_JSON_ARRAY = re.compile(r"\[[\s\S]*\]")
+# 选项标号 "A" / "(b)" / "（2）" / "3." / "C、"：group(1) 为字母，group(2) 为 1~2 位数字
+_RE_OPTION_LABEL = re.compile(r"[（(]?\s*(?:([A-Za-z])|(\d{1,2}))\s*[）)]?[\.\)、,:：]?\s*")
+_RE_DIGITS = re.compile(r"\d+")
+# 合并输出里每节剧本的开头："编号": [
+_RE_BATCH_KEY = re.compile(r'"(\d+)"\s*:\s*\[')
+
+
+def _estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中文等非 ASCII 字符约 1 字 1 token，英文约 4 个字符 1 token。"""
+    n_ascii = len(text.encode("ascii", "ignore"))
+    return (len(text) - n_ascii) + n_ascii // 4
+
+
+def _split_chunk(text: str, max_tokens: int = SPLIT_CHUNK_TOKENS) -> List[str]:
+    """
+    把过长的 chunk 按空行拆成若干估算不超过 max_tokens 的小段：贪心装入整个段落，不在段落中间切开；
+    Markdown 标题行总是开启新的小段，单个段落本身超长时单独成段。无需拆分时返回 [text]。
+    """
+    if max_tokens <= 0 or _estimate_tokens(text) <= max_tokens:
+        return [text]
+    parts: List[str] = []
+    buf: List[str] = []
+    used = 0
+    has_body = False  # 只有标题行时不切开，标题总是跟着它后面的正文
+    for para in text.split("\n\n"):
+        para = para.strip()
+        if not para:
+            continue
+        cost = _estimate_tokens(para)
+        is_heading = para.startswith("#")
+        if has_body and (is_heading or used + cost > max_tokens):
+            parts.append("\n\n".join(buf))
+            buf, used, has_body = [], 0, False
+        buf.append(para)
+        used += cost
+        has_body = has_body or not is_heading
+    if buf:
+        parts.append("\n\n".join(buf))
+    return parts or [text]
+
+
+def _leading_heading(text: str) -> str:
+    """小段以 Markdown 标题行开头时返回标题文字，否则返回空串。"""
+    first_line = text.split("\n", 1)[0]
+    return first_line.lstrip("#").strip() if first_line.startswith("#") else ""
+
+
+def _last_sub_head_title(items: List[Dict[str, Any]], default: str) -> str:
+    for it in reversed(items):
+        if it.get("type") == "sub_head":
+            return str(it.get("title") or "").strip()
+    return default
+
+
+def _is_response_format_error(err: Exception) -> bool:
+    """400 是否因为服务端 / 模型不支持 response_format（JSON mode），而不是上下文超长、内容审核等别的原因。"""
+    if openai is None or not isinstance(err, openai.BadRequestError):
+        return False
+    detail = " ".join(str(x) for x in (err, getattr(err, "param", None), getattr(err, "code", None)) if x).lower()
+    return "response_format" in detail or "json_object" in detail
+
+
+def _retry_backoff(attempt: int) -> float:
+    low, high = RETRY_BACKOFF_RANGE
+    return random.uniform(low, high) * (attempt + 1)
+
+
+def _strip_code_fence(raw: str) -> str:
+    """去掉首尾的 ``` / ```json 围栏；最常见的输出形态，用字符串操作即可，不走正则。"""
+    s = raw.strip()
+    if s.startswith("```"):
+        s = s[3:]
+        if s[:4].lower() == "json":
+            s = s[4:]
+        s = s.lstrip()
+    if s.endswith("```"):
+        s = s[:-3].rstrip()
+    return s
+
+
+_OPTION_LABEL_DELIMS = frozenset(".)、,:：")
+
+
+def _skip_spaces(text: str, i: int) -> int:
+    n = len(text)
+    while i < n and text[i].isspace():
+        i += 1
+    return i
+
+
+def _scan_option_label(text: str, i: int) -> int:
+    """从 i 起匹配一个选项标号（单个英文字母或 1~2 位数字），返回其结束位置，不匹配返回 -1。"""
+    if i >= len(text):
+        return -1
+    ch = text[i]
+    if ch.isascii() and ch.isalpha():
+        return i + 1
+    if ch.isdecimal():
+        return i + 2 if i + 1 < len(text) and text[i + 1].isdecimal() else i + 1
+    return -1
+
+
+def _is_option_label_head(ch: str) -> bool:
+    # 可能开启一个选项标号的字符："(" / "（" / 英文字母 / 数字
+    return ch in "（(" or ch.isdecimal() or (ch.isascii() and ch.isalpha())
+
+
+def _skip_option_label(text: str, i: int) -> int:
+    """
+    从下标 i（非空白处）起跳过一层 "(A)" / "（1）" 前缀，再跳过一层 "A." / "1、" / "B)" 前缀及其后的空白，
+    返回新的起点；只移动下标，不产生中间字符串。
+    手写的前缀扫描（空白 / 数字按 str.isspace / str.isdecimal 判断），结果与原先两次正则替换一致。
+    """
+    n = len(text)
+    if i < n and text[i] in "（(":
+        j = _scan_option_label(text, _skip_spaces(text, i + 1))
+        if j >= 0:
+            if j < n and text[j].isspace():
+                j = _skip_spaces(text, j)
+            if j < n and text[j] in "）)":
+                i = _skip_spaces(text, j + 1)
+    j = _scan_option_label(text, i)
+    if j >= 0:
+        if j < n and text[j].isspace():
+            j = _skip_spaces(text, j)
+        if j < n and text[j] in _OPTION_LABEL_DELIMS:
+            i = _skip_spaces(text, j + 1)
+    return i
+
+
+@functools.lru_cache(maxsize=256)
+def _figure_mention_pattern(label: str) -> Optional[re.Pattern[str]]:
+    """图号 label 在小写正文里的提及写法（"Figure 1" ↔ "图1" / "Fig.1" / "figure1" 等），每个图号只编译一次。"""
+    nums = _RE_DIGITS.findall(label)
+    if not nums:
+        return None
+    num = nums[0]
+    if "tab" in label.lower():
+        return re.compile(rf"tab(?:le)?\.?\s*{num}|表\s*{num}")
+    return re.compile(rf"fig(?:ure)?\.?\s*{num}|图\s*{num}")
+
+
+@functools.lru_cache(maxsize=None)
+def _system_prompt_for(character_name: str) -> str:
+    """
+    角色的完整 system prompt：人设 + 输出约束，对同一角色逐字不变。
+    不变的内容全部放在消息最前面，OpenAI / DeepSeek 等服务端的前缀缓存（prompt caching）
+    可以跨请求复用这部分的 prefill；每段变化的正文只出现在其后的 user 消息里。
+    """
+    # 根据角色名称构建动态 system prompt
+    conf = CHARACTER_CONFIGS.get(character_name, CHARACTER_CONFIGS["默认"])
+    persona = SYSTEM_PROMPT.format(
+        character_name=character_name,
+        character_style=conf["style"],
+        self_name=conf["self_name"],      # 注入自称：奈奈子/贝儿
+        character_tone=conf["tone"],
+        character_pronoun="她",
+    )
+    return persona + "\n\n" + _rules_block(character_name)
+
+
+def _rules_block(character_name: str) -> str:
+    return f"""
+输出格式：每段剧本是一个 JSON 数组，每项为以下之一（emotion ∈ char_normal / char_happy / char_angry / char_shy）：
+- {{"type":"dialogue","speaker":"{character_name}","text":...,"emotion":...}}
+- {{"type":"quiz","question":...,"options":[...],"correct_answer":...,"feedback_correct":...,"feedback_wrong":...,"explanation":"50~120字，为什么正确答案是对的"}}
+- {{"type":"choice","prompt":...,"options":[...],"emotion":...,"explanation":"50~120字，{character_name}对这道思考题的观点或思路拓展"}}
+- {{"type":"sub_head","title":"子节标题，如 3.1 概述"}}
+- {{"type":"show_image","figure_id":"必须与可用图片列表中的图号完全一致","caption":"简短说明"}}（没有可用图片时不生成）
+解释都写进对话文本里，而不是 JSON 外面。
+""".strip()
+
+
+# 单节请求的 user prompt；section_line / figures_line / part_line 为空或以空行结尾
+USER_PROMPT_TEMPLATE = """
+{section_line}{figures_line}{part_line}输入论文{text_label}（chunk #{chunk_index}）：
+\"\"\"{chunk_text}\"\"\"
+
+{output_line}
+""".strip()
+SECTION_LINE_TEMPLATE = "当前章节：{section_title}"
+FIGURES_LINE_TEMPLATE = "可用图片（只能引用这些图号）：{figure_ids}"
+# 过长的节拆成多个小段分别生成时，告诉模型手里只是其中一部分
+PART_LINE_TEMPLATE = "本节较长，已按段落拆成 {n_parts} 部分分别改编；下面只是其中一部分，只改编这部分内容，不要重复本节开场，也不要替整节做总结。"
+TEXT_LABEL_FULL = "本节全文"
+TEXT_LABEL_PART = "本节第 {part}/{n_parts} 部分"
+OUTPUT_LINE_ARRAY = "请只输出 JSON 数组（list），不要输出任何额外文本、不要用 ``` 包裹。"
+OUTPUT_LINE_JSON_MODE = '请只输出一个 JSON 对象 {"items": [...]}，items 为本节的剧本数组，不要输出任何额外文本。'
+
+# 多节合并请求（generate_scripts_batch）的 user prompt 与其中每一节的格式
+BATCH_PROMPT_TEMPLATE = """
+下面是同一篇论文的 {n_chunks} 节内容，每节以 ===CHUNK 编号=== 开头。请为每一节**分别**改编一段剧本。
+
+{chunk_blocks}
+
+请只输出一个 JSON 对象（dict），键为 chunk 编号字符串（{keys}），值为该节的剧本 JSON 数组（list）；不要输出任何额外文本、不要用 ``` 包裹。
+每节的 show_image 只能引用该节自己列出的可用图片。
+""".strip()
+BATCH_CHUNK_TEMPLATE = '===CHUNK {chunk_index}===\n{section_line}{figures_line}"""{chunk_text}"""'
+
+
+def _prompt_fingerprint(*templates: str) -> str:
+    return hashlib.blake2b("\0".join(templates).encode("utf-8"), digest_size=8).hexdigest()
+
+
+# 参与生成的全部提示词模板：任何一个改动都会改变 PROMPT_FINGERPRINT
+_PROMPT_TEMPLATES = (
+    SYSTEM_PROMPT,
+    _rules_block("{character_name}"),
+    USER_PROMPT_TEMPLATE,
+    SECTION_LINE_TEMPLATE,
+    FIGURES_LINE_TEMPLATE,
+    PART_LINE_TEMPLATE,
+    TEXT_LABEL_FULL,
+    TEXT_LABEL_PART,
+    OUTPUT_LINE_ARRAY,
+    OUTPUT_LINE_JSON_MODE,
+    BATCH_PROMPT_TEMPLATE,
+    BATCH_CHUNK_TEMPLATE,
+)
+# 提示词模板的指纹：写进剧本缓存键，改了任何模板却忘了递增 PROMPT_VERSION 时旧缓存也会失效
+PROMPT_FINGERPRINT = _prompt_fingerprint(*_PROMPT_TEMPLATES)
+
+
+def _json_loads(text: str) -> Any:
+    """
+    json.loads；有 orjson 时先用它解析，它不接受的输入（NaN、孤立代理项、格式错误）再交给标准库。
+
+    唯一差别是超出 64 位的整数会被 orjson 读成 float，剧本 JSON 里不会出现这种数。
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    # 格式错误时抛出标准库的 JSONDecodeError，出错位置与说明保持原样
+    return json.loads(text)
+
+
+def _loads_lenient(text: str) -> Any:
+    """_json_loads；失败且装了 json_repair 时再尝试修复（尾逗号、单引号、漏引号等），仍失败抛 ValueError。"""
+    try:
+        return _json_loads(text)
+    except ValueError:
+        if json_repair is None:
+            raise
+    repaired = json_repair.loads(text)
+    if repaired in ("", None):
+        raise ValueError("JSON 无法修复")
+    return repaired
+
+
+def _salvage_batch_arrays(text: str) -> Dict[str, List[Any]]:
+    """合并输出不完整（如被 max_tokens 截断）时，取出每个已完整闭合的 "编号": [...]，没写完的那节丢掉。"""
+    out: Dict[str, List[Any]] = {}
+    for m in _RE_BATCH_KEY.finditer(text):
+        key = m.group(1)
+        if key in out:
+            continue
+        scanner = _JsonArrayItemScanner()
+        items = scanner.feed(text[m.end() - 1 :])
+        if scanner.closed:
+            out[key] = items
+    return out
+
+
+class _JsonArrayItemScanner:
+    """
+    增量扫描流式输出的 JSON 数组：每当一个顶层元素（对象）完整出现就把它解析出来。
+
+    只跟踪括号深度与字符串/转义状态；第一个 "[" 之前的内容（如 ```json）直接忽略，
+    单个元素解析失败（json_repair 也修不好）时跳过该元素。
+    closed 表示已经读到数组的结尾 "]"，之后的内容不再处理；输出被截断时它保持 False。
+    """
+
+    def __init__(self) -> None:
+        self._buf: List[str] = []
+        self._depth = 0
+        self._started = False
+        self._in_str = False
+        self._escape = False
+        self.closed = False
+
+    def feed(self, text: str) -> List[Any]:
+        items: List[Any] = []
+        if self.closed:
+            return items
+        for ch in text:
+            if not self._started:
+                if ch == "[":
+                    self._started = True
+                    self._depth = 1
+                continue
+            if self._depth <= 1:
+                # 元素之间：只关心下一个对象的开头与数组结尾
+                if self._depth == 1 and ch == "{":
+                    self._buf = [ch]
+                    self._depth = 2
+                elif ch == "]":
+                    self._depth = 0
+                    self.closed = True
+                    break
+                continue
+
+            self._buf.append(ch)
+            if self._in_str:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 1:
+                    try:
+                        items.append(_loads_lenient("".join(self._buf)))
+                    except ValueError:
+                        pass
+                    self._buf = []
+        return items
+
+
+@functools.lru_cache(maxsize=1)
+def _http_client() -> Any:
+    """进程内共用的 httpx.Client：所有生成器、会话与预生成线程复用同一批保活连接。"""
+    return httpx.Client(
+        http2=LLM_HTTP2,
+        limits=httpx.Limits(
+            max_connections=128,
+            max_keepalive_connections=64,
+            keepalive_expiry=LLM_KEEPALIVE_SECONDS,
+        ),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _chat_model(
+    *,
+    model: str,
+    temperature: float,
+    api_key: str,
+    base_url: Optional[str],
+    request_timeout: int,
+    max_tokens: int,
+    max_retries: int,
+    json_mode: bool = False,
+) -> Any:
+    """按配置缓存的 ChatOpenAI：同一组参数在进程内只创建一次。json_mode 时请求带 response_format=json_object。"""
+    # 读超时保持 request_timeout：非流式请求在整段剧本生成完之前不会收到任何字节，不能设得太短
+    timeout: Any = request_timeout
+    if httpx is not None:
+        timeout = httpx.Timeout(
+            request_timeout,
+            connect=min(LLM_CONNECT_TIMEOUT, request_timeout),
+            pool=min(LLM_CONNECT_TIMEOUT, request_timeout),
+        )
+
+    kwargs: Dict[str, Any] = {
+        "model": model,
+        "temperature": temperature,
+        "api_key": api_key,
+        "timeout": timeout,
+        "max_tokens": max_tokens,
+        # SDK 层只重试 429 / 5xx / 连接错误；输出不可用时的重试由 generate_script 的循环负责
+        "max_retries": max_retries,
+    }
+    if base_url:
+        kwargs["base_url"] = base_url
+        kwargs["openai_api_base"] = base_url
+    if httpx is not None:
+        kwargs["http_client"] = _http_client()
+    if json_mode:
+        kwargs["model_kwargs"] = {"response_format": {"type": "json_object"}}
+
+    try:
+        return ChatOpenAI(**kwargs)
+    except TypeError:
+        kwargs.pop("openai_api_base", None)
+        return ChatOpenAI(**kwargs)
+
+
+def _dedupe_chunks(chunks: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[int, List[int]]]:
+    """
+    按 (正文, 章节名, 可用图片) 去重：返回每组第一个 chunk 组成的列表，以及 {代表 chunk_index: [重复的 chunk_index]}。
+    这三项相同的 chunk 提示词完全一样，只需请求一次。
+    """
+    unique: List[Dict[str, Any]] = []
+    first_of: Dict[Tuple[Any, ...], int] = {}
+    dups: Dict[int, List[int]] = {}
+    for c in chunks:
+        idx = int(c["chunk_index"])
+        key = (
+            str(c.get("chunk_text") or "").strip(),
+            c.get("section_title") or "",
+            tuple(sorted((c.get("image_map") or {}).items())),
+        )
+        rep = first_of.setdefault(key, idx)
+        if rep == idx:
+            unique.append(c)
+        else:
+            dups.setdefault(rep, []).append(idx)
+    return unique, dups
+
 
-    # quiz
-    question: Optional[str] = None
-    options: Optional[List[str]] = None
-    correct_answer: Optional[str] = None
-    feedback_correct: Optional[str] = None
-    feedback_wrong: Optional[str] = None
-    explanation: Optional[str] = None  # 答题解析，无论对错都展示
+def _copy_script(script: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # 重复 chunk 各拿一份，调用方原地修改条目时互不影响
+    return [dict(it) for it in script]
 
-    # choice（非测验选择）
-    prompt: Optional[str] = None
+
+def is_fallback_script(script: List[Dict[str, Any]]) -> bool:
+    """是否为 _fallback_script 生成的兜底脚本（LLM 失败/空输入），这类结果不应被缓存。"""
+    return any(bool(it.get("fallback")) for it in script)
 
 
 class ScriptGenerator:
@@ -94,6 +546,11 @@ class ScriptGenerator:
         temperature: float = 0.7,
         max_retries: int = 2,
         request_timeout: int = 60,
+        max_concurrency: int = 8,
+        max_tokens: Optional[int] = None,
+        max_repair_retries: int = 2,
+        split_chunk_tokens: int = SPLIT_CHUNK_TOKENS,
+        structured_output: Optional[bool] = None,
     ) -> None:
         if ChatOpenAI is None:
             raise RuntimeError(
@@ -106,25 +563,41 @@ class ScriptGenerator:
         self.temperature = temperature if temperature is not None else cfg.llm.temperature
         self.max_retries = max_retries if max_retries is not None else cfg.llm.max_retries
         self.request_timeout = request_timeout if request_timeout is not None else cfg.llm.request_timeout
+        self.max_tokens = max_tokens if max_tokens is not None else cfg.llm.max_tokens
+        # 输出不是合法 JSON 时，先请模型修复上一条输出的次数，用完才整段重新生成
+        self.max_repair_retries = max(0, int(max_repair_retries))
+        # agenerate_scripts 未指定 concurrency 时同时在途的请求数
+        self.max_concurrency = max(1, int(max_concurrency))
+        # 估算超过这么多 token 的 chunk 拆成小段并发生成后拼接；<= 0 表示不拆
+        self.split_chunk_tokens = int(split_chunk_tokens)
 
-        api_key = cfg.llm.api_key
-        base_url = cfg.llm.base_url
+        # JSON mode：剧本包在 {"items": [...]} 里输出（json_object 要求顶层是对象）；服务端不支持时自动退回普通模式
+        self.structured_output = bool(structured_output if structured_output is not None else cfg.llm.structured_output)
 
-        kwargs: Dict[str, Any] = {
-            "model": self.model,
-            "temperature": self.temperature,
-            "api_key": api_key,
-            "timeout": self.request_timeout,
-        }
-        if base_url:
-            kwargs["base_url"] = base_url
-            kwargs["openai_api_base"] = base_url
+        self._llm_params: Dict[str, Any] = dict(
+            model=self.model,
+            temperature=self.temperature,
+            api_key=cfg.llm.api_key,
+            base_url=cfg.llm.base_url,
+            request_timeout=self.request_timeout,
+            max_tokens=self.max_tokens,
+            max_retries=self.max_retries,
+        )
+        # 同样配置的生成器共用一个 ChatOpenAI（及其连接池），重复创建也不会重新握手
+        self.llm = _chat_model(**self._llm_params, json_mode=self.structured_output)
 
+    def warm_up(self) -> None:
+        """
+        预先与 LLM 服务建立连接（TCP + TLS），与 PDF 解析重叠，首段剧本请求直接复用该连接。
+        只发一个轻量的 GET /models；服务不支持或网络失败时静默忽略。
+        """
+        client = getattr(self.llm, "root_client", None)
+        if client is None:
+            return
         try:
-            self.llm = ChatOpenAI(**kwargs)
-        except TypeError:
-            kwargs.pop("openai_api_base", None)
-            self.llm = ChatOpenAI(**kwargs)
+            client.with_options(max_retries=0, timeout=5).models.list()
+        except Exception:
+            pass
 
     def generate_script(
         self,
@@ -139,50 +612,556 @@ class ScriptGenerator:
         返回一个 JSON 列表（Python list[dict]），供前端逐条播放。
         section_title 为当前章节名（如 Abstract / 3 Method），用于提示 LLM。
         character_name 为当前角色名称，用于 prompt 中。
+        估算超过 split_chunk_tokens 的 chunk 按段落拆成小段并发生成，再按原顺序拼成一段剧本。
         """
-        conf = CHARACTER_CONFIGS.get(character_name, CHARACTER_CONFIGS["默认"])
-        style = conf["style"]
         chunk_text = (chunk_text or "").strip()
         if not chunk_text:
             return self._fallback_script("这一段好像是空的……你是不是上传了扫描版？", chunk_index=chunk_index)
 
-        user_prompt = self._build_user_prompt(
+        kwargs: Dict[str, Any] = dict(
+            chunk_index=chunk_index, section_title=section_title, image_map=image_map, character_name=character_name
+        )
+        parts = _split_chunk(chunk_text, self.split_chunk_tokens)
+        if len(parts) == 1:
+            return self._generate_one(chunk_text, **kwargs)
+        # 过长的 chunk：各小段并发生成，按原顺序拼接
+        with ThreadPoolExecutor(max_workers=min(len(parts), self.max_concurrency), thread_name_prefix="p2g-split") as pool:
+            scripts = list(
+                pool.map(lambda ip: self._generate_one(ip[1], part=(ip[0], len(parts)), **kwargs), enumerate(parts, 1))
+            )
+        return self._join_parts(parts, scripts, section_title=section_title)
+
+    def _generate_one(
+        self,
+        chunk_text: str,
+        *,
+        chunk_index: int,
+        section_title: Optional[str],
+        image_map: Optional[Dict[str, str]],
+        character_name: str,
+        part: Optional[Tuple[int, int]] = None,
+    ) -> List[Dict[str, Any]]:
+        """单次请求生成整段剧本（含重试、修复与兜底），不再拆分。"""
+        messages = self._build_messages(
             chunk_text=chunk_text,
             chunk_index=chunk_index,
-            section_title=section_title or "",
-            image_map=image_map or {},
+            section_title=section_title,
+            image_map=image_map,
             character_name=character_name,
+            part=part,
         )
 
+        # 本次调用用的客户端 / 输出格式：JSON mode 被拒时只在这次调用里退回普通模式，不改动共享的生成器
+        llm, json_mode = self.llm, self.structured_output
         last_err: Optional[Exception] = None
-        for _ in range(self.max_retries + 1):
+        for attempt in range(self.max_retries + 1):
+            resp: Any = None
             try:
-                # 根据角色名称构建动态 system prompt
-                dynamic_system_prompt = SYSTEM_PROMPT.format(
+                resp = llm.invoke(messages)
+                script = self._script_from_response(resp, image_map=image_map, character_name=character_name)
+                if script:
+                    return script
+            except _FATAL_LLM_ERRORS as e:
+                last_err = e
+                if not (json_mode and _is_response_format_error(e)):
+                    break
+                llm, json_mode = _chat_model(**self._llm_params), False
+                messages = self._build_messages(
+                    chunk_text=chunk_text,
+                    chunk_index=chunk_index,
+                    section_title=section_title,
+                    image_map=image_map,
                     character_name=character_name,
-                    character_style=conf["style"],
-                    self_name=conf["self_name"],      # 注入自称：奈奈子/贝儿
-                    character_tone=conf["tone"],
-                    character_pronoun="她",
+                    part=part,
+                    json_mode=False,
                 )
-                resp = self.llm.invoke(
-                    [
-                        SystemMessage(content=dynamic_system_prompt),
-                        HumanMessage(content=user_prompt),
-                    ]
+            except _TRANSIENT_LLM_ERRORS as e:
+                last_err = e
+                if attempt < self.max_retries:
+                    time.sleep(_retry_backoff(attempt))
+            except ValueError as e:
+                # 输出不是合法 JSON：先让模型修复上一条输出（比整段重新生成省得多），修不好再重新生成
+                last_err = e
+                script = self._repair_script(
+                    messages, resp, e, llm=llm, json_mode=json_mode, image_map=image_map, character_name=character_name
                 )
-                content = (getattr(resp, "content", "") or "").strip()
-                parsed = self._parse_json_list(content)
-                normalized = self._normalize_script(parsed, character_name=character_name)
-                if normalized:
-                    # 兜底：对 dialogue 中提及的图号自动注入 show_image
-                    if image_map:
-                        normalized = self._inject_figure_images(normalized, image_map)
-                    return normalized
+                if script:
+                    return script
             except Exception as e:
+                # 输出不是合法剧本：换一次采样，立即重试
                 last_err = e
                 continue
 
+        return self._generation_failed_script(last_err, chunk_text=chunk_text, chunk_index=chunk_index, character_name=character_name)
+
+    async def agenerate_script(
+        self,
+        chunk_text: str,
+        *,
+        chunk_index: int,
+        section_title: Optional[str] = None,
+        image_map: Optional[Dict[str, str]] = None,
+        character_name: str = "奈奈",
+    ) -> List[Dict[str, Any]]:
+        """generate_script 的异步版本（llm.ainvoke），提示词、拆分、重试与兜底完全一致。"""
+        chunk_text = (chunk_text or "").strip()
+        if not chunk_text:
+            return self._fallback_script("这一段好像是空的……你是不是上传了扫描版？", chunk_index=chunk_index)
+
+        kwargs: Dict[str, Any] = dict(
+            chunk_index=chunk_index, section_title=section_title, image_map=image_map, character_name=character_name
+        )
+        parts = _split_chunk(chunk_text, self.split_chunk_tokens)
+        if len(parts) == 1:
+            return await self._agenerate_one(chunk_text, **kwargs)
+        scripts = await asyncio.gather(
+            *(self._agenerate_one(p, part=(i, len(parts)), **kwargs) for i, p in enumerate(parts, 1))
+        )
+        return self._join_parts(parts, list(scripts), section_title=section_title)
+
+    async def _agenerate_one(
+        self,
+        chunk_text: str,
+        *,
+        chunk_index: int,
+        section_title: Optional[str],
+        image_map: Optional[Dict[str, str]],
+        character_name: str,
+        part: Optional[Tuple[int, int]] = None,
+    ) -> List[Dict[str, Any]]:
+        """_generate_one 的异步版本。"""
+        messages = self._build_messages(
+            chunk_text=chunk_text,
+            chunk_index=chunk_index,
+            section_title=section_title,
+            image_map=image_map,
+            character_name=character_name,
+            part=part,
+        )
+
+        # 本次调用用的客户端 / 输出格式：JSON mode 被拒时只在这次调用里退回普通模式，不改动共享的生成器
+        llm, json_mode = self.llm, self.structured_output
+        last_err: Optional[Exception] = None
+        for attempt in range(self.max_retries + 1):
+            resp: Any = None
+            try:
+                resp = await llm.ainvoke(messages)
+                script = self._script_from_response(resp, image_map=image_map, character_name=character_name)
+                if script:
+                    return script
+            except _FATAL_LLM_ERRORS as e:
+                last_err = e
+                if not (json_mode and _is_response_format_error(e)):
+                    break
+                llm, json_mode = _chat_model(**self._llm_params), False
+                messages = self._build_messages(
+                    chunk_text=chunk_text,
+                    chunk_index=chunk_index,
+                    section_title=section_title,
+                    image_map=image_map,
+                    character_name=character_name,
+                    part=part,
+                    json_mode=False,
+                )
+            except _TRANSIENT_LLM_ERRORS as e:
+                last_err = e
+                if attempt < self.max_retries:
+                    await asyncio.sleep(_retry_backoff(attempt))
+            except ValueError as e:
+                # 输出不是合法 JSON：先让模型修复上一条输出（比整段重新生成省得多），修不好再重新生成
+                last_err = e
+                script = await self._arepair_script(
+                    messages, resp, e, llm=llm, json_mode=json_mode, image_map=image_map, character_name=character_name
+                )
+                if script:
+                    return script
+            except Exception as e:
+                # 输出不是合法剧本：换一次采样，立即重试
+                last_err = e
+                continue
+
+        return self._generation_failed_script(last_err, chunk_text=chunk_text, chunk_index=chunk_index, character_name=character_name)
+
+    def stream_script(
+        self,
+        chunk_text: str,
+        *,
+        chunk_index: int,
+        section_title: Optional[str] = None,
+        image_map: Optional[Dict[str, str]] = None,
+        character_name: str = "奈奈",
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        generate_script 的流式版本（llm.stream）：每条剧本一生成完就规范化并 yield，
+        前端不必等整段 JSON 返回即可开始播放。逐条 yield 的结果与 generate_script 一致。
+        没有产出任何可用条目时，回退到 generate_script（含重试与兜底）；已经产出条目后流才出错或被截断
+        （没读到数组结尾 "]"）时，末尾补一条带 fallback 标记的说明，缓存层据此不缓存这份不完整的剧本。
+        过长的 chunk 只流式生成第一个小段，其余小段同时在后台生成，播完第一段后依次产出。
+        """
+        chunk_text = (chunk_text or "").strip()
+        if not chunk_text:
+            yield from self._fallback_script("这一段好像是空的……你是不是上传了扫描版？", chunk_index=chunk_index)
+            return
+
+        kwargs: Dict[str, Any] = dict(
+            chunk_index=chunk_index, section_title=section_title, image_map=image_map, character_name=character_name
+        )
+        parts = _split_chunk(chunk_text, self.split_chunk_tokens)
+        if len(parts) == 1:
+            yield from self._stream_one(chunk_text, **kwargs)
+            return
+
+        pool = ThreadPoolExecutor(max_workers=min(len(parts) - 1, self.max_concurrency), thread_name_prefix="p2g-split")
+        try:
+            rest = [
+                pool.submit(self._generate_one, p, part=(i, len(parts)), **kwargs) for i, p in enumerate(parts[1:], 2)
+            ]
+            prev_title = (section_title or "").strip()
+            for item in self._stream_one(parts[0], part=(1, len(parts)), **kwargs):
+                if item.get("type") == "sub_head":
+                    prev_title = str(item.get("title") or "").strip()
+                yield item
+            for part, future in zip(parts[1:], rest):
+                items = self._join_part(part, future.result(), prev_title=prev_title, section_title=section_title)
+                prev_title = _last_sub_head_title(items, prev_title)
+                yield from items
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _stream_one(
+        self,
+        chunk_text: str,
+        *,
+        chunk_index: int,
+        section_title: Optional[str],
+        image_map: Optional[Dict[str, str]],
+        character_name: str,
+        part: Optional[Tuple[int, int]] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        messages = self._build_messages(
+            chunk_text=chunk_text,
+            chunk_index=chunk_index,
+            section_title=section_title,
+            image_map=image_map,
+            character_name=character_name,
+            part=part,
+        )
+        scanner = _JsonArrayItemScanner()
+        emitted = 0
+        try:
+            for piece in self.llm.stream(messages):
+                for raw in scanner.feed(str(getattr(piece, "content", "") or "")):
+                    for item in self._stream_items(raw, image_map=image_map, character_name=character_name):
+                        emitted += 1
+                        yield item
+        except Exception:
+            # 已经播出去的条目无法收回，只有一条都没产出时才整段重来
+            if emitted:
+                yield from self._stream_interrupted_script(chunk_index=chunk_index, character_name=character_name)
+                return
+        if emitted and not scanner.closed:
+            yield from self._stream_interrupted_script(chunk_index=chunk_index, character_name=character_name)
+        if not emitted:
+            yield from self._generate_one(
+                chunk_text,
+                chunk_index=chunk_index,
+                section_title=section_title,
+                image_map=image_map,
+                character_name=character_name,
+                part=part,
+            )
+
+    async def astream_script(
+        self,
+        chunk_text: str,
+        *,
+        chunk_index: int,
+        section_title: Optional[str] = None,
+        image_map: Optional[Dict[str, str]] = None,
+        character_name: str = "奈奈",
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """stream_script 的异步版本（llm.astream），回退到 agenerate_script。"""
+        chunk_text = (chunk_text or "").strip()
+        if not chunk_text:
+            for item in self._fallback_script("这一段好像是空的……你是不是上传了扫描版？", chunk_index=chunk_index):
+                yield item
+            return
+
+        kwargs: Dict[str, Any] = dict(
+            chunk_index=chunk_index, section_title=section_title, image_map=image_map, character_name=character_name
+        )
+        parts = _split_chunk(chunk_text, self.split_chunk_tokens)
+        if len(parts) == 1:
+            async for item in self._astream_one(chunk_text, **kwargs):
+                yield item
+            return
+
+        rest = [
+            asyncio.ensure_future(self._agenerate_one(p, part=(i, len(parts)), **kwargs))
+            for i, p in enumerate(parts[1:], 2)
+        ]
+        try:
+            prev_title = (section_title or "").strip()
+            async for item in self._astream_one(parts[0], part=(1, len(parts)), **kwargs):
+                if item.get("type") == "sub_head":
+                    prev_title = str(item.get("title") or "").strip()
+                yield item
+            for part, task in zip(parts[1:], rest):
+                items = self._join_part(part, await task, prev_title=prev_title, section_title=section_title)
+                prev_title = _last_sub_head_title(items, prev_title)
+                for item in items:
+                    yield item
+        finally:
+            for task in rest:
+                task.cancel()
+
+    async def _astream_one(
+        self,
+        chunk_text: str,
+        *,
+        chunk_index: int,
+        section_title: Optional[str],
+        image_map: Optional[Dict[str, str]],
+        character_name: str,
+        part: Optional[Tuple[int, int]] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        messages = self._build_messages(
+            chunk_text=chunk_text,
+            chunk_index=chunk_index,
+            section_title=section_title,
+            image_map=image_map,
+            character_name=character_name,
+            part=part,
+        )
+        scanner = _JsonArrayItemScanner()
+        emitted = 0
+        try:
+            async for piece in self.llm.astream(messages):
+                for raw in scanner.feed(str(getattr(piece, "content", "") or "")):
+                    for item in self._stream_items(raw, image_map=image_map, character_name=character_name):
+                        emitted += 1
+                        yield item
+        except Exception:
+            if emitted:
+                for item in self._stream_interrupted_script(chunk_index=chunk_index, character_name=character_name):
+                    yield item
+                return
+        if emitted and not scanner.closed:
+            for item in self._stream_interrupted_script(chunk_index=chunk_index, character_name=character_name):
+                yield item
+        if not emitted:
+            script = await self._agenerate_one(
+                chunk_text,
+                chunk_index=chunk_index,
+                section_title=section_title,
+                image_map=image_map,
+                character_name=character_name,
+                part=part,
+            )
+            for item in script:
+                yield item
+
+    def _join_parts(
+        self, parts: List[str], scripts: List[List[Dict[str, Any]]], *, section_title: Optional[str]
+    ) -> List[Dict[str, Any]]:
+        """按原顺序拼接各小段的剧本。"""
+        out: List[Dict[str, Any]] = list(scripts[0])
+        prev_title = _last_sub_head_title(out, (section_title or "").strip())
+        for part, script in zip(parts[1:], scripts[1:]):
+            items = self._join_part(part, script, prev_title=prev_title, section_title=section_title)
+            prev_title = _last_sub_head_title(items, prev_title)
+            out.extend(items)
+        return out
+
+    def _join_part(
+        self, part: str, script: List[Dict[str, Any]], *, prev_title: str, section_title: Optional[str]
+    ) -> List[Dict[str, Any]]:
+        # 模型常在每个小段开头重复一遍章节名或上一个子节标题，去掉；小段以标题行开头时补上对应的 sub_head
+        if script and script[0].get("type") == "sub_head":
+            if str(script[0].get("title") or "").strip() not in {prev_title, (section_title or "").strip()}:
+                return script
+            script = script[1:]
+        heading = _leading_heading(part)
+        if heading and heading != prev_title:
+            return [{"type": "sub_head", "title": heading}, *script]
+        return script
+
+    def _stream_items(
+        self,
+        raw: Any,
+        *,
+        image_map: Optional[Dict[str, str]],
+        character_name: str,
+    ) -> List[Dict[str, Any]]:
+        # 单条规范化：不合格的条目 _normalize_script 会给出兜底脚本，流式场景下直接丢弃
+        normalized = self._normalize_script([raw], character_name=character_name)
+        if is_fallback_script(normalized):
+            return []
+        if image_map:
+            normalized = self._inject_figure_images(normalized, image_map)
+        return normalized
+
+    async def agenerate_scripts(
+        self,
+        chunks: List[Dict[str, Any]],
+        *,
+        character_name: str = "奈奈",
+        concurrency: Optional[int] = None,
+        on_result: Optional[Callable[[int, List[Dict[str, Any]]], None]] = None,
+    ) -> Dict[int, List[Dict[str, Any]]]:
+        """
+        并发为多个 chunk 生成剧本（每个 chunk 一次请求），返回 {chunk_index: 剧本}。
+        chunks 每项格式同 generate_scripts_batch；concurrency 限制同时在途的请求数（默认 max_concurrency），
+        总耗时从各段耗时之和降为约 max(耗时) × ceil(N / concurrency)。
+        on_result 在每段完成时回调（完成顺序，不保证按 chunk_index）。
+        某一段意外出错时只有该段得到兜底剧本，其余段照常返回。
+        正文、章节名与可用图片都相同的 chunk 只请求一次，结果复制给每个重复段。
+        """
+        sem = asyncio.Semaphore(max(1, int(concurrency or self.max_concurrency)))
+        results: Dict[int, List[Dict[str, Any]]] = {}
+        unique, dups = _dedupe_chunks(chunks)
+
+        async def _one(c: Dict[str, Any]) -> None:
+            idx = int(c["chunk_index"])
+            chunk_text = str(c.get("chunk_text") or "")
+            async with sem:
+                try:
+                    script = await self.agenerate_script(
+                        chunk_text,
+                        chunk_index=idx,
+                        section_title=c.get("section_title"),
+                        image_map=c.get("image_map"),
+                        character_name=character_name,
+                    )
+                except Exception as e:
+                    script = self._generation_failed_script(
+                        e, chunk_text=chunk_text.strip(), chunk_index=idx, character_name=character_name
+                    )
+            results[idx] = script
+            if on_result is not None:
+                on_result(idx, script)
+            for dup in dups.get(idx, ()):
+                results[dup] = _copy_script(script)
+                if on_result is not None:
+                    on_result(dup, results[dup])
+
+        await asyncio.gather(*(_one(c) for c in unique))
+        return results
+
+    def _repair_script(
+        self,
+        messages: List[Any],
+        resp: Any,
+        err: Exception,
+        *,
+        llm: Any,
+        json_mode: bool,
+        image_map: Optional[Dict[str, str]],
+        character_name: str,
+    ) -> Optional[List[Dict[str, Any]]]:
+        """把上一条不合法的输出和解析错误交回给模型，只修格式（最多 max_repair_retries 次）；仍失败返回 None。"""
+        for _ in range(self.max_repair_retries):
+            bad_output = str(getattr(resp, "content", "") or "").strip()
+            if not bad_output:
+                return None
+            try:
+                resp = llm.invoke(self._repair_messages(messages, bad_output, err, json_mode=json_mode))
+                return self._script_from_response(resp, image_map=image_map, character_name=character_name)
+            except ValueError as e:
+                err = e
+            except Exception:
+                return None
+        return None
+
+    async def _arepair_script(
+        self,
+        messages: List[Any],
+        resp: Any,
+        err: Exception,
+        *,
+        llm: Any,
+        json_mode: bool,
+        image_map: Optional[Dict[str, str]],
+        character_name: str,
+    ) -> Optional[List[Dict[str, Any]]]:
+        """_repair_script 的异步版本。"""
+        for _ in range(self.max_repair_retries):
+            bad_output = str(getattr(resp, "content", "") or "").strip()
+            if not bad_output:
+                return None
+            try:
+                resp = await llm.ainvoke(self._repair_messages(messages, bad_output, err, json_mode=json_mode))
+                return self._script_from_response(resp, image_map=image_map, character_name=character_name)
+            except ValueError as e:
+                err = e
+            except Exception:
+                return None
+        return None
+
+    def _repair_messages(self, messages: List[Any], bad_output: str, err: Exception, *, json_mode: bool) -> List[Any]:
+        # 接在原对话之后追问：system / user 前缀不变，仍能命中服务端的前缀缓存
+        expected = 'JSON 对象 {"items": [...]}' if json_mode else "JSON 数组"
+        return [
+            *messages,
+            AIMessage(content=bad_output),
+            HumanMessage(
+                content=(
+                    f"上面的输出不是合法的 {expected}（{err}）。"
+                    f"请只输出修复后的完整 {expected}：内容保持不变，只修正格式；"
+                    "不要输出任何额外文本、不要用 ``` 包裹。"
+                )
+            ),
+        ]
+
+    def _build_messages(
+        self,
+        *,
+        chunk_text: str,
+        chunk_index: int,
+        section_title: Optional[str],
+        image_map: Optional[Dict[str, str]],
+        character_name: str,
+        json_mode: Optional[bool] = None,
+        part: Optional[Tuple[int, int]] = None,
+    ) -> List[Any]:
+        return [
+            SystemMessage(content=self._system_prompt(character_name)),
+            HumanMessage(
+                content=self._build_user_prompt(
+                    chunk_text=chunk_text,
+                    chunk_index=chunk_index,
+                    section_title=section_title or "",
+                    image_map=image_map or {},
+                    character_name=character_name,
+                    json_mode=json_mode,
+                    part=part,
+                )
+            ),
+        ]
+
+    def _script_from_response(
+        self,
+        resp: Any,
+        *,
+        image_map: Optional[Dict[str, str]],
+        character_name: str,
+    ) -> List[Dict[str, Any]]:
+        content = (getattr(resp, "content", "") or "").strip()
+        parsed = self._parse_json_list(content)
+        normalized = self._normalize_script(parsed, character_name=character_name)
+        # 兜底：对 dialogue 中提及的图号自动注入 show_image
+        if normalized and image_map:
+            normalized = self._inject_figure_images(normalized, image_map)
+        return normalized
+
+    def _generation_failed_script(
+        self,
+        last_err: Optional[Exception],
+        *,
+        chunk_text: str,
+        chunk_index: int,
+        character_name: str,
+    ) -> List[Dict[str, Any]]:
         msg = (
             "唔……这段作者写得太绕了，我一时没把剧本整理成标准格式。"
             "我们先用简化版继续读下去喵！"
@@ -191,6 +1170,90 @@ class ScriptGenerator:
             msg += f"\n（内部解析失败：{type(last_err).__name__}）"
         return self._fallback_script(msg, chunk_index=chunk_index, character_name=character_name, extra_hint=chunk_text[:260])
 
+    def _stream_interrupted_script(self, *, chunk_index: int, character_name: str) -> List[Dict[str, Any]]:
+        # 流式输出半途断开：前面的条目已经播出，只补一句说明；带 fallback 标记，整段剧本不会被缓存
+        msg = "诶？这一段讲到一半就断掉了……后面的内容先跳过，下次重新生成时再补上喵！"
+        return self._fallback_script(msg, chunk_index=chunk_index, character_name=character_name)
+
+    def generate_scripts_batch(
+        self,
+        chunks: List[Dict[str, Any]],
+        *,
+        character_name: str = "奈奈",
+    ) -> Dict[int, List[Dict[str, Any]]]:
+        """
+        一次 LLM 调用为多个 chunk 生成剧本，返回 {chunk_index: 剧本}。
+        chunks 每项包含 chunk_text / chunk_index / section_title / image_map，
+        分摊提示词与网络往返开销；批量结果里缺失或不可用的 chunk 逐个回退到 generate_script。
+        每次合并请求最多 BATCH_MAX_CHUNKS 节、输出上限按节数放大，超出的节分成几组并发请求。
+        正文、章节名与可用图片都相同的 chunk 只生成一次，结果复制给每个重复段。
+        """
+        results: Dict[int, List[Dict[str, Any]]] = {}
+        chunks, dups = _dedupe_chunks(chunks)
+        pending = [c for c in chunks if str(c.get("chunk_text") or "").strip()]
+        groups = [pending[i : i + BATCH_MAX_CHUNKS] for i in range(0, len(pending), BATCH_MAX_CHUNKS)]
+        groups = [g for g in groups if len(g) >= 2]
+        if len(groups) == 1:
+            results.update(self._generate_batch_group(groups[0], character_name=character_name))
+        elif groups:
+            with ThreadPoolExecutor(max_workers=min(len(groups), self.max_concurrency), thread_name_prefix="p2g-batch") as pool:
+                for part in pool.map(lambda g: self._generate_batch_group(g, character_name=character_name), groups):
+                    results.update(part)
+
+        # 合并请求没覆盖到的节各自单独生成，彼此并发：最坏情况是一次合并往返加一轮并行请求，而不是逐节排队
+        missing = [c for c in chunks if int(c["chunk_index"]) not in results]
+
+        def _one(c: Dict[str, Any]) -> List[Dict[str, Any]]:
+            return self.generate_script(
+                str(c.get("chunk_text") or ""),
+                chunk_index=int(c["chunk_index"]),
+                section_title=c.get("section_title"),
+                image_map=c.get("image_map"),
+                character_name=character_name,
+            )
+
+        if len(missing) == 1:
+            results[int(missing[0]["chunk_index"])] = _one(missing[0])
+        elif missing:
+            with ThreadPoolExecutor(max_workers=min(len(missing), self.max_concurrency), thread_name_prefix="p2g-batch") as pool:
+                for c, script in zip(missing, pool.map(_one, missing)):
+                    results[int(c["chunk_index"])] = script
+        for rep_idx, dup_indices in dups.items():
+            for dup in dup_indices:
+                results[dup] = _copy_script(results[rep_idx])
+        return results
+
+    def _generate_batch_group(self, group: List[Dict[str, Any]], *, character_name: str) -> Dict[int, List[Dict[str, Any]]]:
+        """一次合并请求生成 group 里各节的剧本；只返回拿到了可用剧本的节，出错时返回空 dict。"""
+        try:
+            resp = self.llm.invoke(
+                [
+                    SystemMessage(content=self._system_prompt(character_name)),
+                    HumanMessage(content=self._build_batch_prompt(group, character_name=character_name)),
+                ],
+                # 输出里要装下每一节的剧本：上限按节数放大，不超过服务端允许的单次输出上限
+                max_tokens=min(self.max_tokens * len(group), BATCH_MAX_OUTPUT_TOKENS),
+            )
+            parsed = self._parse_json_dict((getattr(resp, "content", "") or "").strip())
+        except Exception:
+            return {}
+        results: Dict[int, List[Dict[str, Any]]] = {}
+        for c in group:
+            idx = int(c["chunk_index"])
+            items = parsed.get(str(idx))
+            if not isinstance(items, list):
+                continue
+            normalized = self._normalize_script(items, character_name=character_name)
+            if is_fallback_script(normalized):
+                continue
+            if c.get("image_map"):
+                normalized = self._inject_figure_images(normalized, c["image_map"])
+            results[idx] = normalized
+        return results
+
+    def _system_prompt(self, character_name: str) -> str:
+        return _system_prompt_for(character_name)
+
     def _build_user_prompt(
         self,
         *,
@@ -199,47 +1262,105 @@ class ScriptGenerator:
         section_title: str = "",
         image_map: Optional[Dict[str, str]] = None,
         character_name: str = "奈奈",
+        json_mode: Optional[bool] = None,
+        part: Optional[Tuple[int, int]] = None,
     ) -> str:
-        section_line = f"当前章节：{section_title}\n\n" if section_title else ""
+        # json_mode 为 None 时按生成器的 structured_output；part 为 (第几部分, 共几部分)，从 1 开始
+        section_line = SECTION_LINE_TEMPLATE.format(section_title=section_title) + "\n\n" if section_title else ""
         if image_map:
-            figures_line = "可用图片（只能引用这些图号）：" + "、".join(image_map.keys()) + "\n\n"
+            figures_line = FIGURES_LINE_TEMPLATE.format(figure_ids="、".join(image_map.keys())) + "\n\n"
         else:
             figures_line = ""
-        return f"""
-{section_line}{figures_line}输入论文本节全文（chunk #{chunk_index}）：
-\"\"\"{chunk_text}\"\"\"
+        if part is not None:
+            part_line = PART_LINE_TEMPLATE.format(part=part[0], n_parts=part[1]) + "\n\n"
+            text_label = TEXT_LABEL_PART.format(part=part[0], n_parts=part[1])
+        else:
+            part_line, text_label = "", TEXT_LABEL_FULL
+        use_json_mode = self.structured_output if json_mode is None else json_mode
+        return USER_PROMPT_TEMPLATE.format(
+            section_line=section_line,
+            figures_line=figures_line,
+            part_line=part_line,
+            text_label=text_label,
+            chunk_index=chunk_index,
+            chunk_text=chunk_text,
+            output_line=OUTPUT_LINE_JSON_MODE if use_json_mode else OUTPUT_LINE_ARRAY,
+        )
 
-请只输出 JSON 数组（list），不要输出任何额外文本、不要用 ``` 包裹。
+    def _build_batch_prompt(self, chunks: List[Dict[str, Any]], *, character_name: str = "奈奈") -> str:
+        parts: List[str] = []
+        for c in chunks:
+            section_title = str(c.get("section_title") or "")
+            image_map = c.get("image_map") or {}
+            section_line = SECTION_LINE_TEMPLATE.format(section_title=section_title) + "\n" if section_title else ""
+            figures_line = (
+                FIGURES_LINE_TEMPLATE.format(figure_ids="、".join(image_map.keys())) + "\n" if image_map else ""
+            )
+            parts.append(
+                BATCH_CHUNK_TEMPLATE.format(
+                    chunk_index=int(c["chunk_index"]),
+                    section_line=section_line,
+                    figures_line=figures_line,
+                    chunk_text=str(c.get("chunk_text") or "").strip(),
+                )
+            )
+        keys = "、".join(f'"{int(c["chunk_index"])}"' for c in chunks)
+        return BATCH_PROMPT_TEMPLATE.format(n_chunks=len(chunks), chunk_blocks="\n".join(parts), keys=keys)
+
+    def _parse_json_dict(self, raw: str) -> Dict[str, Any]:
+        try:
+            data = _json_loads(_strip_code_fence(raw))
+            if isinstance(data, dict):
+                return data
+        except Exception:
+            pass
 
-约束：
-- type 只能是 dialogue / quiz / choice / sub_head / show_image
-- sub_head 项：仅需 type="sub_head" 与 title="子节标题"（用于长节按层次划分）
-- show_image 项：type="show_image", figure_id（**必须与可用图片列表中的图号完全一致**）, caption（简短说明）。每次 dialogue 提到某图/表时，在该 dialogue 前插入对应 show_image；同一图可多次插入。若无可用图片则不生成。
-- emotion 只能在以下 key 里选一个：char_normal, char_happy, char_angry, char_shy
-- dialogue 项必须包含 speaker,text,emotion,type，其中 speaker 必须是 "{character_name}"
-- quiz 项必须包含：type="quiz", question, options(数组), correct_answer, feedback_correct, feedback_wrong, explanation(解析，50~120字，解释为什么正确答案是对的)
-- choice 项必须包含：type="choice", prompt, options(数组), emotion, explanation(解析，50~120字，针对这道思考题给出{character_name}的观点或思路拓展)
+        # 少见写法（围栏不在首尾、前后夹带说明文字）：按行去掉围栏后取最外层括号内的内容
+        cleaned = _RE_FENCE.sub("", raw.strip())
+        m = _RE_JSON_OBJECT.search(cleaned)
+        if m:
+            try:
+                data = _json_loads(m.group(0))
+                if isinstance(data, dict):
+                    return data
+            except ValueError:
+                pass
 
-若本节内容较多，请用 sub_head 划分子节，再在子节内写 dialogue/quiz/choice。请把解释写进对话文本里，而不是 JSON 外面。
-""".strip()
+        # 被截断或个别节格式有误：保留已完整闭合的那几节
+        salvaged = _salvage_batch_arrays(cleaned)
+        if salvaged:
+            return salvaged
+        raise ValueError("LLM 输出不是 JSON 对象")
 
     def _parse_json_list(self, raw: str) -> List[Any]:
-        cleaned = re.sub(r"^\s*```(?:json)?\s*|\s*```\s*$", "", raw.strip(), flags=re.I | re.M)
-
         try:
-            data = json.loads(cleaned)
+            data = _json_loads(_strip_code_fence(raw))
             if isinstance(data, list):
                 return data
+            # JSON mode 的输出：{"items": [...]}
+            if isinstance(data, dict) and isinstance(data.get("items"), list):
+                return data["items"]
         except Exception:
             pass
 
-        m = re.search(r"\[[\s\S]*\]", cleaned)
+        # 少见写法（围栏不在首尾、前后夹带说明文字）：按行去掉围栏后取最外层括号内的内容
+        cleaned = _RE_FENCE.sub("", raw.strip())
+        err: Optional[ValueError] = None
+        m = _RE_JSON_ARRAY.search(cleaned)
         if m:
-            data = json.loads(m.group(0))
-            if isinstance(data, list):
-                return data
+            try:
+                data = _json_loads(m.group(0))
+                if isinstance(data, list):
+                    return data
+            except ValueError as e:
+                err = e
 
-        raise ValueError("LLM 输出不是 JSON 列表")
+        # 被 max_tokens 截断或个别条目格式有误：逐个取出已完整闭合的顶层对象，只丢掉坏掉的那一条
+        items = _JsonArrayItemScanner().feed(cleaned)
+        if items:
+            return items
+        # 保留 json.loads 的出错位置，修复重试时交给模型参考
+        raise err or ValueError("LLM 输出不是 JSON 列表")
 
     def _normalize_script(self, items: List[Any], character_name: str = "奈奈") -> List[Dict[str, Any]]:
         out: List[Dict[str, Any]] = []
@@ -322,17 +1443,20 @@ class ScriptGenerator:
         return out
 
     def _normalize_option_text(self, value: Any) -> str:
+        # 一次 str() + strip()，之后只移动起点下标，最后切一次片
         text = str(value or "").strip()
         if not text:
             return ""
-
+        start = 0
         for _ in range(3):
-            prev = text
-            text = re.sub(r"^\s*[（(]\s*(?:[A-Za-z]|\d{1,2})\s*[）)]\s*", "", text).strip()
-            text = re.sub(r"^\s*(?:[A-Za-z]|\d{1,2})\s*[\.\)、,:：]\s*", "", text).strip()
-            if text == prev:
+            # 不以标号开头（如中文选项）时无需扫描
+            if start >= len(text) or not _is_option_label_head(text[start]):
+                break
+            nxt = _skip_option_label(text, start)
+            if nxt == start:
                 break
-        return text or str(value).strip()
+            start = nxt
+        return text[start:] or text
 
     def _normalize_correct_answer(self, raw_answer: Any, options: List[str]) -> str:
         if not options:
@@ -351,9 +1475,9 @@ class ScriptGenerator:
         if idx is not None and 0 <= idx < len(options):
             return options[idx]
 
-        for opt in options:
-            if cleaned == str(opt).strip():
-                return opt
+        # options 已经过 _normalize_option_text（去标号、strip），直接比较即可
+        if cleaned in options:
+            return cleaned
 
         return cleaned or options[0]
 
@@ -362,15 +1486,11 @@ class ScriptGenerator:
         if not s:
             return None
 
-        m = re.fullmatch(r"[（(]?\s*([A-Za-z])\s*[）)]?[\.\)、,:：]?\s*", s)
-        if m:
-            return ord(m.group(1).upper()) - ord("A")
-
-        m = re.fullmatch(r"[（(]?\s*(\d{1,2})\s*[）)]?[\.\)、,:：]?\s*", s)
-        if m:
-            return int(m.group(1)) - 1
-
-        return None
+        m = _RE_OPTION_LABEL.fullmatch(s)
+        if m is None:
+            return None
+        letter, digits = m.groups()
+        return ord(letter.upper()) - ord("A") if letter else int(digits) - 1
 
     def _find_mentioned_label(self, text: str, image_map: Dict[str, str]) -> Optional[str]:
         """
@@ -384,16 +1504,8 @@ class ScriptGenerator:
                 return label
         # 数字模式匹配（"Figure 1" ↔ "图1" / "Fig.1" / "figure1" 等）
         for label in image_map:
-            nums = re.findall(r"\d+", label)
-            if not nums:
-                continue
-            num = nums[0]
-            label_lower = label.lower()
-            if re.search(r"tab", label_lower):
-                pats = [rf"tab(?:le)?\.?\s*{num}", rf"表\s*{num}"]
-            else:
-                pats = [rf"fig(?:ure)?\.?\s*{num}", rf"图\s*{num}"]
-            if any(re.search(p, text_lower) for p in pats):
+            pattern = _figure_mention_pattern(label)
+            if pattern is not None and pattern.search(text_lower):
                 return label
         return None
 
@@ -438,5 +1550,6 @@ class ScriptGenerator:
                 "speaker": character_name,
                 "text": text,
                 "emotion": "char_shy" if chunk_index % 2 else "char_normal",
+                "fallback": True,  # 兜底脚本标记：缓存层据此跳过，避免把一次失败永久缓存
             }
         ]
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import os
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+import numpy as np
+
+try:
+    from fastembed import TextEmbedding
+except Exception:  # fastembed 为可选依赖
+    TextEmbedding = None  # type: ignore
+
+# 多语言模型：论文正文可能是中文或中英混排，纯英文模型对中文的向量区分度差，容易误判为近似
+DEFAULT_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+DEFAULT_THRESHOLD = 0.92
+
+
+def semantic_cache_enabled() -> bool:
+    """需显式开启（P2G_SEMANTIC_CACHE=1）且已安装 fastembed。"""
+    flag = (os.getenv("P2G_SEMANTIC_CACHE") or "0").strip().lower() in {"1", "true", "on", "yes"}
+    return flag and TextEmbedding is not None
+
+
+def default_threshold() -> float:
+    try:
+        return float(os.getenv("P2G_SEMANTIC_CACHE_THRESHOLD") or DEFAULT_THRESHOLD)
+    except ValueError:
+        return DEFAULT_THRESHOLD
+
+
+class SemanticScriptCache:
+    """
+    按语义相似度复用剧本的进程内缓存：正文向量与已生成剧本的余弦相似度 ≥ threshold 时直接复用。
+
+    说明：
+    - 用于近似重复的 chunk（作者信息、参考文献、反复出现的样板段落），精确重复由磁盘缓存负责
+    - scope 区分角色 / 模型 / 可用图片等生成条件，只在同一 scope 内比较
+    - 向量化失败一律当作未命中，不影响正常生成
+    """
+
+    def __init__(
+        self,
+        *,
+        threshold: Optional[float] = None,
+        model_name: str = DEFAULT_MODEL,
+        embed_fn: Optional[Callable[[str], Any]] = None,
+        max_entries_per_scope: int = 1024,
+    ) -> None:
+        self.threshold = default_threshold() if threshold is None else threshold
+        self.model_name = model_name
+        self.max_entries_per_scope = max_entries_per_scope
+        self._embed_fn = embed_fn
+        self._model: Any = None
+        self._lock = threading.Lock()
+        self._vectors: Dict[Hashable, np.ndarray] = {}
+        self._scripts: Dict[Hashable, List[List[Dict[str, Any]]]] = {}
+
+    def _embed(self, text: str) -> np.ndarray:
+        if self._embed_fn is not None:
+            vec = np.asarray(self._embed_fn(text), dtype=np.float32)
+        else:
+            with self._lock:
+                if self._model is None:
+                    if TextEmbedding is None:
+                        raise RuntimeError("未安装 fastembed")
+                    self._model = TextEmbedding(self.model_name)
+            vec = np.asarray(next(iter(self._model.embed([text]))), dtype=np.float32)
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else vec
+
+    def get(self, text: str, *, scope: Hashable) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            # 在锁内复制：并发的 add 淘汰旧条目时会原地删除列表头部，下标会错位
+            vectors = self._vectors.get(scope)
+            scripts = list(self._scripts.get(scope) or ())
+        if vectors is None or not scripts:
+            return None
+        try:
+            query = self._embed(text)
+        except Exception:
+            return None
+        sims = vectors @ query
+        best = int(np.argmax(sims))
+        if float(sims[best]) >= self.threshold:
+            return scripts[best]
+        return None
+
+    def add(self, text: str, script: List[Dict[str, Any]], *, scope: Hashable) -> None:
+        try:
+            vec = self._embed(text)
+        except Exception:
+            return
+        with self._lock:
+            vectors = self._vectors.get(scope)
+            scripts = self._scripts.setdefault(scope, [])
+            if vectors is None:
+                vectors = vec[None, :]
+            else:
+                vectors = np.vstack([vectors, vec])
+            scripts.append(script)
+            # 超出上限时丢弃最早的条目
+            if len(scripts) > self.max_entries_per_scope:
+                drop = len(scripts) - self.max_entries_per_scope
+                vectors = vectors[drop:]
+                del scripts[:drop]
+            self._vectors[scope] = vectors